@@ -0,0 +1,12 @@
+"""
+Shared helpers for the SeedDream API functions.
+
+Vercel does not expose files under a leading underscore as endpoints, so this
+package is only importable from the handlers in api/.
+"""
+
+import time
+
+# When the function started importing its code - the start of the import
+# time warmup.py reports
+IMPORT_STARTED = time.perf_counter()
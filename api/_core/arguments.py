@@ -0,0 +1,48 @@
+"""
+Model arguments - how /api/generate and /api/video turn request fields into
+fal arguments, shared with the pipeline steps that call the same models
+"""
+
+from api._core.drafts import IMAGE_SIZES
+
+# The models behind the endpoints; pipeline steps call the same ones
+GENERATE_MODEL = "fal-ai/bytedance/seedream/v4.5/text-to-image"
+EDIT_MODEL = "fal-ai/bytedance/seedream/v4.5/edit"
+VIDEO_MODEL = "fal-ai/bytedance/seedance/v1/pro/image-to-video"
+
+
+def generate_arguments(fields):
+    arguments = {
+        "prompt": fields.get('prompt', ''),
+        # Named sizes pass through; anything else renders at 4K
+        "image_size": generate_size(fields.get('image_size', 'square_hd')),
+        "num_images": fields.get('num_images', 1),
+        "enable_safety_checker": False,
+    }
+
+    seed = fields.get('seed')
+    if seed is not None:
+        arguments["seed"] = int(seed)
+
+    return arguments
+
+
+def generate_size(value):
+    return value if isinstance(value, str) and value in IMAGE_SIZES else "auto_4K"
+
+
+def video_arguments(image_url, fields):
+    arguments = {
+        "prompt": fields.get('prompt', ''),
+        "image_url": image_url,
+        "aspect_ratio": fields.get('aspect_ratio', 'auto'),
+        "resolution": fields.get('resolution', '1080p'),
+        "duration": str(fields.get('duration', '5')),
+        "enable_safety_checker": False,
+    }
+
+    seed = fields.get('seed')
+    if seed is not None:
+        arguments["seed"] = int(seed)
+
+    return arguments
@@ -0,0 +1,95 @@
+"""
+LRU cache with per-entry expiry, optionally persisted to a local SQLite file
+so entries survive a warm restart of the function instance
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    When `path` is given, entries are also written to a SQLite database there
+    and read back on a memory miss. Values must be JSON serializable.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, path=None, table='entries'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.table = table
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+            if self._db is None:
+                return None
+
+            row = self._db.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+
+            value = json.loads(row[0])
+            self._db.execute(f"UPDATE {self.table} SET used_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, row[1], value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remember(key, expires_at, value)
+            if self._db is None:
+                return
+
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+            # Drop expired rows, then the least recently used beyond the limit
+            self._db.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            self._db.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._db.commit()
+
+    def _remember(self, key, expires_at, value):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
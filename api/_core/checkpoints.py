@@ -0,0 +1,72 @@
+"""
+Batch checkpoints - each pair's result is saved to the job store as
+soon as it finishes, under its batch's id. Resubmitting a batch with the
+same idempotency key, or retrying its failed pairs, then only runs the pairs
+that have no completed result yet.
+"""
+
+import time
+import hashlib
+
+from api._core.drafts import size_tag
+from api._core.jobs import get_job_store, new_job_id
+
+
+def batch_id_for(idempotency_key):
+    """The batch id an idempotency key always maps to; a fresh one without a key"""
+    if not idempotency_key:
+        return new_job_id()
+    return "batch_" + hashlib.sha256(str(idempotency_key).encode()).hexdigest()[:32]
+
+
+def pair_key(pair_id, size):
+    """What a checkpoint is filed under: the pair's render recipe and its size"""
+    return pair_id + size_tag(size)
+
+
+def save_batch(batch_id, idempotency_key, poses, outfits, pairs, prompts, seeds, variants, timestamp, size):
+    """Keep what a retry needs to run the batch's pairs again. `pairs` is
+    [(pose_index, outfit_index, prompt_index, seed_index, key)]."""
+    get_job_store().save({
+        "id": batch_id,
+        "kind": "batch",
+        "idempotency_key": idempotency_key,
+        "created_at": time.time(),
+        "poses": [{"name": p["name"], "url": p["url"]} for p in poses],
+        "outfits": [{"name": o["name"], "url": o["url"]} for o in outfits],
+        "pairs": [list(pair) for pair in pairs],
+        "prompts": prompts,
+        "seeds": seeds,
+        "variants": variants,
+        "timestamp": timestamp,
+        "image_size": size,
+    })
+
+
+def get_batch(batch_id):
+    batch = get_job_store().get(batch_id)
+    if batch is None or batch.get("kind") != "batch":
+        return None
+    return batch
+
+
+def checkpoint(batch_id, key, result):
+    """Save one pair's result. One document per pair, so pairs finishing
+    together never overwrite each other."""
+    get_job_store().save({
+        "id": f"{batch_id}/{key}",
+        "kind": "checkpoint",
+        "created_at": time.time(),
+        "result": result,
+    })
+
+
+def completed_pairs(batch_id, keys):
+    """{key: result} for the keys whose pair has completed in this batch"""
+    store = get_job_store()
+    done = {}
+    for key in set(keys):
+        saved = store.get(f"{batch_id}/{key}")
+        if saved and saved.get("kind") == "checkpoint" and saved["result"].get("status") == "completed":
+            done[key] = saved["result"]
+    return done
@@ -0,0 +1,92 @@
+"""
+Draft-then-finalize - a matrix is explored at a cheap size with the seed
+pinned, and only the pairs worth keeping are rendered again at full size
+with the same seed and arguments. Both renders share a pair id.
+"""
+
+import json
+import time
+import secrets
+import hashlib
+
+from api._core.jobs import get_job_store
+from api._core.results import normalize_prompt
+from api._core.uploads import url_hash
+
+FINAL_SIZE = "auto_4K"
+DRAFT_SIZE = "auto_2K"
+IMAGE_SIZES = (
+    "square_hd", "square", "portrait_4_3", "portrait_16_9",
+    "landscape_4_3", "landscape_16_9", "auto_2K", "auto_4K",
+)
+
+
+def is_true(value):
+    """A JSON boolean or a form / query string flag"""
+    return value is True or value in (1, '1', 'true')
+
+
+def image_size(value, default):
+    """A named size or {"width", "height"}; raises ValueError otherwise"""
+    if value in (None, ''):
+        return default
+    if isinstance(value, dict):
+        try:
+            return {"width": int(value["width"]), "height": int(value["height"])}
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("image_size needs integer width and height")
+    if value not in IMAGE_SIZES:
+        raise ValueError(f"image_size must be one of {', '.join(IMAGE_SIZES)} or {{\"width\", \"height\"}}")
+    return value
+
+
+def size_tag(size):
+    """Filename suffix for results that aren't full size"""
+    if size == FINAL_SIZE:
+        return ''
+    if isinstance(size, dict):
+        return f"_{size['width']}x{size['height']}"
+    return f"_{size}"
+
+
+def pin_seed(seed):
+    """Drafts need a fixed seed to be reproducible at full size; pick one if none was given"""
+    if seed not in (None, ''):
+        return int(seed)
+    return secrets.randbelow(2 ** 31)
+
+
+def pair_id(model, arguments):
+    """Id of a render recipe - everything but the output size - so a draft
+    and its final come out with the same one"""
+    identity = {
+        "model": model,
+        "prompt": normalize_prompt(arguments.get('prompt', '')),
+        "images": [url_hash(url) or url for url in arguments.get('image_urls', [])],
+        "seed": arguments.get('seed'),
+        "num_images": arguments.get('num_images', 1),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def save_draft(draft_id, poses, outfits, prompts, seeds, variants, timestamp, size):
+    """Keep what a finalize call needs to re-render pairs of this draft"""
+    get_job_store().save({
+        "id": draft_id,
+        "kind": "draft",
+        "created_at": time.time(),
+        "poses": [{"name": p["name"], "url": p["url"]} for p in poses],
+        "outfits": [{"name": o["name"], "url": o["url"]} for o in outfits],
+        "prompts": prompts,
+        "seeds": seeds,
+        "variants": variants,
+        "timestamp": timestamp,
+        "image_size": size,
+    })
+
+
+def get_draft(draft_id):
+    draft = get_job_store().get(draft_id)
+    if draft is None or draft.get("kind") != "draft":
+        return None
+    return draft
@@ -0,0 +1,259 @@
+"""
+fal access shared by every endpoint - one lazily created keep-alive
+connection pool to fal's queue, storage and result hosts that lives as long
+as the warm function instance
+"""
+
+import os
+import time
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+FAL_API_KEY = os.getenv("FAL_API_KEY")
+
+if FAL_API_KEY:
+    os.environ["FAL_KEY"] = FAL_API_KEY
+
+POOL_SIZE = int(os.getenv("FAL_POOL_SIZE", "32"))
+POOL_KEEPALIVE = float(os.getenv("FAL_POOL_KEEPALIVE", "60"))
+DEFAULT_TIMEOUT = float(os.getenv("FAL_TIMEOUT", "120"))
+# Send every fal request (queue, storage, CDN, result URLs) to this base URL
+# instead, e.g. the stand-in from bench/fake_fal.py; the original host goes
+# along in an X-Fal-Upstream-Host header
+UPSTREAM_URL = os.getenv("FAL_UPSTREAM_URL")
+# Wait on model calls through the process-wide poller in poller.py rather
+# than a polling loop per call; server.py turns this on
+SHARED_POLLER = os.getenv("FAL_SHARED_POLLER", "") in ('1', 'true')
+# Import the fal clients and connect to fal in the background as soon as a
+# function that calls fal is loaded, so a cold start's first request doesn't
+# wait for them
+PREWARM = os.getenv("FAL_PREWARM", "1") in ('1', 'true')
+# Comma-separated URLs warm() connects to; defaults to fal's queue, REST and CDN hosts
+WARM_URLS = [url for url in os.getenv("FAL_WARM_URLS", "").split(',') if url]
+WARM_TIMEOUT = float(os.getenv("FAL_WARM_TIMEOUT", "5"))
+
+_lock = threading.Lock()
+_transport = None
+_client = None
+_http = None
+
+# fal_pool (and with it fal_client and httpx) once imported
+_import_lock = threading.Lock()
+_pool_module = None
+_import_ms = None
+_prewarm_thread = None
+_warmup = {}
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "connections_opened": 0, "tls_handshakes": 0}
+
+
+def load_clients():
+    """Import fal_client, httpx and the pooled clients built on them, once.
+    Nothing imports them before a fal call or warm-up needs them; returns the
+    fal_pool module, or None when fal_client isn't installed."""
+    global _pool_module, _import_ms, fal_client, httpx
+    with _import_lock:
+        if _import_ms is None:
+            started = time.perf_counter()
+            try:
+                from api._core import fal_pool
+                _pool_module = fal_pool
+                fal_client = fal_pool.fal_client
+                httpx = fal_pool.httpx
+            except ImportError:
+                fal_client = None
+                httpx = None
+            _import_ms = round((time.perf_counter() - started) * 1000, 1)
+        return _pool_module
+
+
+def __getattr__(name):
+    # fal.fal_client and fal.httpx, imported on first access
+    if name in ('fal_client', 'httpx'):
+        load_clients()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def config_error():
+    """Error message when fal can't be called from this instance, else None"""
+    if not FAL_API_KEY:
+        return "FAL_API_KEY not configured"
+    # Checked without importing it, which the first fal call does
+    if _pool_module is None and importlib.util.find_spec('fal_client') is None:
+        return "fal_client not installed"
+    return None
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _trace(event, info):
+    if event == "connection.connect_tcp.complete":
+        _count("connections_opened")
+    elif event == "connection.start_tls.complete":
+        _count("tls_handshakes")
+
+
+def on_request(request):
+    """httpx request hook of every pooled client"""
+    _count("requests")
+    request.extensions["trace"] = _trace
+
+
+def get_transport():
+    global _transport
+    with _lock:
+        if _transport is None:
+            _transport = load_clients().SharedTransport()
+        return _transport
+
+
+def get_client():
+    """The shared fal client, created on first use"""
+    global _client
+    if _client is None:
+        client = load_clients().PooledSyncClient(key=FAL_API_KEY, default_timeout=DEFAULT_TIMEOUT)
+        with _lock:
+            if _client is None:
+                _client = client
+    return _client
+
+
+def get_http():
+    """Plain HTTP client on the same pool, for non-fal-client calls to fal hosts"""
+    global _http
+    if _http is None:
+        transport = get_transport()
+        http = httpx.Client(
+            transport=transport,
+            timeout=DEFAULT_TIMEOUT,
+            event_hooks=load_clients().EVENT_HOOKS,
+        )
+        with _lock:
+            if _http is None:
+                _http = http
+    return _http
+
+
+def pool_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    connections = []
+    if _transport is not None:
+        connections = getattr(_transport.pool._pool, 'connections', [])
+    stats["pool_size"] = POOL_SIZE
+    stats["open_connections"] = len(connections)
+    stats["reused_connections"] = max(0, stats["requests"] - stats["connections_opened"])
+    return stats
+
+
+def pool_active():
+    return _transport is not None
+
+
+def close():
+    """Close the pool's connections, e.g. when a self-hosted server shuts down"""
+    if SHARED_POLLER:
+        from api._core import poller
+        poller.close()
+    if _transport is not None:
+        _transport.pool.close()
+
+
+def warm():
+    """Import the fal clients and open a pooled connection to each of
+    WARM_URLS (fal's own hosts by default) so the first real call skips the
+    imports and TLS handshakes; a warm instance just reuses its connections.
+    Returns warm_stats()."""
+    pool_module = load_clients()
+    if pool_module is None:
+        return warm_stats()
+    urls = WARM_URLS or pool_module.default_warm_urls()
+
+    def connect(url):
+        started = time.perf_counter()
+        host = httpx.URL(url).host
+        try:
+            # Any answer will do; the connection stays in the pool
+            get_http().head(url, timeout=WARM_TIMEOUT)
+            _warmup[host] = {"ms": round((time.perf_counter() - started) * 1000, 1)}
+        except Exception as e:
+            _warmup[host] = {"ms": round((time.perf_counter() - started) * 1000, 1), "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        list(pool.map(connect, urls))
+    return warm_stats()
+
+
+def prewarm():
+    """warm() in the background, once per process"""
+    global _prewarm_thread
+    if not PREWARM or not FAL_API_KEY:
+        return
+    with _lock:
+        if _prewarm_thread is None:
+            _prewarm_thread = threading.Thread(target=warm, name='fal-prewarm', daemon=True)
+            _prewarm_thread.start()
+
+
+def warm_stats():
+    """How long the deferred imports and the last warm-up connections took"""
+    return {
+        "clients_imported": _pool_module is not None,
+        "import_ms": _import_ms,
+        "prewarm": "disabled" if not PREWARM else "started" if _prewarm_thread is not None else "not started",
+        "connections": dict(_warmup),
+        "open_connections": pool_stats()["open_connections"],
+    }
+
+
+def pool_header():
+    """Compact pool_stats() for a response header"""
+    return '; '.join(f"{k}={v}" for k, v in pool_stats().items())
+
+
+def submit(application, arguments, **kwargs):
+    return get_client().submit(application, arguments=arguments, **kwargs)
+
+
+def subscribe(application, arguments, **kwargs):
+    on_enqueue = kwargs.pop('on_enqueue', None)
+    on_queue_update = kwargs.pop('on_queue_update', None)
+    with_logs = kwargs.pop('with_logs', False)
+    interval = kwargs.pop('interval', None)
+    handle = submit(application, arguments, **kwargs)
+    if on_enqueue is not None:
+        on_enqueue(handle.request_id)
+    return wait(handle, on_queue_update, with_logs, interval)
+
+
+def wait(handle, on_queue_update=None, with_logs=False, interval=None):
+    """Result of a submitted request, passing each status it goes through
+    to on_queue_update like fal_client's subscribe does"""
+    if SHARED_POLLER:
+        # Imported here: the poller itself needs this module
+        from api._core.poller import get_poller
+        return get_poller().wait(handle, on_queue_update, with_logs)
+
+    options = {} if interval is None else {"interval": interval}
+    for status in handle.iter_events(with_logs=with_logs, **options):
+        if on_queue_update is not None:
+            on_queue_update(status)
+    return handle.get(**options)
+
+
+def status(application, request_id, with_logs=False):
+    return get_client().status(application, request_id, with_logs=with_logs)
+
+
+def result(application, request_id):
+    return get_client().result(application, request_id)
+
+
+def upload(data, content_type, **kwargs):
+    return get_client().upload(data, content_type, **kwargs)
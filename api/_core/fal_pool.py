@@ -0,0 +1,112 @@
+"""
+Pooled fal clients - fal_client's sync client and a plain httpx transport
+running over the shared keep-alive pool. Split out of fal.py because
+fal_client and httpx are most of a function's import time: fal.py only
+imports this module once a fal call (or a warm-up) needs it.
+"""
+
+from datetime import datetime
+
+import fal_client
+import httpx
+
+from api._core import fal, scheduler
+
+
+# Every pooled client counts its requests, and reports 429s to the scheduler
+# even when fal_client retries them without raising
+EVENT_HOOKS = {"request": [fal.on_request], "response": [scheduler.on_response]}
+
+
+class SharedTransport(httpx.BaseTransport):
+    """The process-wide pool; clients built on it must not close it"""
+
+    def __init__(self):
+        self.pool = httpx.HTTPTransport(
+            limits=httpx.Limits(
+                max_connections=fal.POOL_SIZE,
+                max_keepalive_connections=fal.POOL_SIZE,
+                keepalive_expiry=fal.POOL_KEEPALIVE,
+            )
+        )
+
+    def handle_request(self, request):
+        if fal.UPSTREAM_URL:
+            redirect_upstream(request)
+        return self.pool.handle_request(request)
+
+    def close(self):
+        pass
+
+
+class PooledTokenManager(fal_client.client.CDNTokenManager):
+    """CDN token refreshes over the shared pool rather than a throwaway client"""
+
+    def _refresh_token(self):
+        response = fal.get_http().post(self._url, headers=self._headers, json={})
+        response.raise_for_status()
+        data = response.json()
+        return fal_client.client.CDNToken(
+            token=data["token"],
+            token_type=data["token_type"],
+            base_upload_url=data["base_url"],
+            expires_at=datetime.fromisoformat(data["expires_at"]),
+        )
+
+
+class PooledSyncClient(fal_client.SyncClient):
+    """fal's sync client with every HTTP call routed through the shared pool.
+
+    Stock SyncClient keeps one client for queue calls but builds a fresh
+    one (and so a fresh TLS connection) for each CDN upload.
+    """
+
+    def _make_client(self, headers, with_backup=False, **kwargs):
+        transport = fal.get_transport()
+        if with_backup:
+            # Retries unreachable hosts on fal's backup domain
+            transport = fal_client.client.BackupDomainTransport(transport=transport)
+        return httpx.Client(
+            transport=transport,
+            headers={**headers, "User-Agent": fal_client.client.USER_AGENT},
+            timeout=self.default_timeout,
+            event_hooks=EVENT_HOOKS,
+            **kwargs
+        )
+
+    @property
+    def _token_manager(self):
+        manager = self.__dict__.get('_pooled_token_manager')
+        if manager is None:
+            manager = self.__dict__['_pooled_token_manager'] = PooledTokenManager(self._auth)
+        return manager
+
+    @property
+    def _client(self):
+        client = self.__dict__.get('_pooled_client')
+        if client is None:
+            client = self._make_client(
+                {"Authorization": self._auth.header_value},
+                follow_redirects=True,
+                with_backup=True,
+            )
+            self.__dict__['_pooled_client'] = client
+        return client
+
+    def _get_cdn_client(self):
+        token = self._token_manager.get_token()
+        return self._make_client({"Authorization": f"{token.token_type} {token.token}"})
+
+
+def redirect_upstream(request):
+    upstream = httpx.URL(fal.UPSTREAM_URL)
+    request.headers['X-Fal-Upstream-Host'] = request.url.host
+    request.url = request.url.copy_with(scheme=upstream.scheme, host=upstream.host, port=upstream.port)
+    request.headers['Host'] = request.url.netloc.decode('ascii')
+
+
+def default_warm_urls():
+    """fal's queue, REST (CDN tokens) and CDN hosts - what a first model call
+    and a first upload connect to"""
+    client = fal_client.client
+    return [client.QUEUE_URL_FORMAT, client.REST_URL, client.CDN_URL]
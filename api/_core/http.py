@@ -0,0 +1,207 @@
+"""
+Base request handler shared by the API functions - JSON and streamed
+responses, CORS preflight, body parsing and per-request stage timing
+"""
+
+import os
+import json
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from api._core import fal, metrics, warmup
+from api._core.multipart import MultipartReader, boundary_of, is_binary, is_multipart
+from api._core.stream_json import BodyParseError
+
+
+class BaseHandler(BaseHTTPRequestHandler):
+    allowed_methods = 'POST, OPTIONS'
+    allowed_headers = 'Content-Type'
+
+    timer = None
+    status_code = None
+    # Handlers that call fal start warming it up (fal.prewarm) as soon as they
+    # are defined; ones that never do leave fal_client unimported
+    uses_fal = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        warmup.mark_loaded()
+        if cls.uses_fal:
+            fal.prewarm()
+
+    @property
+    def endpoint(self):
+        """Name used in metrics labels, e.g. 'edit' or 'fal-proxy' - the file
+        that defines the `handler` class, whatever name it was imported under"""
+        for cls in type(self).__mro__:
+            if cls.__name__ != 'handler':
+                continue
+            # Function code objects remember their file even when the module
+            # was loaded without a sys.modules entry
+            for attr in vars(cls).values():
+                code = getattr(attr, '__code__', None)
+                if code is not None:
+                    return os.path.splitext(os.path.basename(code.co_filename))[0]
+        return urlparse(self.path).path.rstrip('/').rsplit('/', 1)[-1] or 'index'
+
+    def parse_request(self):
+        # Timing starts once the request line is in, not while a kept-alive
+        # connection sits idle
+        self.timer = metrics.Timer()
+        self.status_code = None
+        return super().parse_request()
+
+    def handle_one_request(self):
+        self.timer = None
+        super().handle_one_request()
+        if self.timer is not None and self.status_code is not None and self.command != 'OPTIONS':
+            self.timer.record(self.endpoint, self.command, self.status_code)
+            warmup.record_request()
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        # Lets operators see connection reuse on the warm instance per response
+        if fal.pool_active():
+            self.send_header('X-Fal-Pool', fal.pool_header())
+        if self.timer is not None and self.timer.stages:
+            self.send_header('Server-Timing', self.timer.header())
+        super().end_headers()
+
+    @property
+    def want_timings(self):
+        """?timings=1 adds a "timings" field to JSON responses"""
+        return self.query.get('timings', [''])[0] in ('1', 'true')
+
+    def send_json(self, data, status=200):
+        if self.timer is None:
+            body = json.dumps(data).encode()
+        else:
+            with self.timer.stage('serialize'):
+                if self.want_timings and isinstance(data, dict):
+                    data = {**data, "timings": self.timer.as_dict()}
+                body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_format(self, query):
+        """'ndjson' or 'sse' when the client asked for streamed results"""
+        requested = query.get('stream', [''])[0]
+        if requested in ('ndjson', 'sse'):
+            return requested
+
+        accept = self.headers.get('Accept', '')
+        if 'text/event-stream' in accept:
+            return 'sse'
+        if 'application/x-ndjson' in accept:
+            return 'ndjson'
+        return None
+
+    def start_stream(self, fmt):
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream' if fmt == 'sse' else 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+    def send_event(self, fmt, event, data):
+        if fmt == 'sse':
+            chunk = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        else:
+            chunk = json.dumps({"type": event, **data}) + "\n"
+        self.wfile.write(chunk.encode())
+        self.wfile.flush()
+
+    def warm_requested(self):
+        """?warm=1 on a GET to a function that calls fal"""
+        return self.uses_fal and self.query.get('warm', [''])[0] in ('1', 'true')
+
+    def send_warm(self):
+        """Answer a keep-warm call once this function's own warm-up is done.
+        Every api/*.py is a separate function with its own instances, so
+        warming one doesn't warm the others."""
+        # Taken first: this request is what makes a cold instance warm
+        instance = warmup.snapshot()
+        with self.timer.stage('warm'):
+            report = fal.warm() if fal.config_error() is None else fal.warm_stats()
+        self.send_json({"endpoint": self.endpoint, "instance": instance, "warmup": report})
+
+    def do_GET(self):
+        # POST-only functions still answer keep-warm calls
+        if not self.warm_requested():
+            return self.send_error(501, f"Unsupported method ({self.command!r})")
+        self.send_warm()
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', self.allowed_methods)
+        self.send_header('Access-Control-Allow-Headers', self.allowed_headers)
+        self.end_headers()
+
+    def public_url(self, path):
+        """Absolute URL of `path` on the host this request came in on"""
+        scheme = self.headers.get('X-Forwarded-Proto', 'http').split(',')[0].strip()
+        host = self.headers.get('X-Forwarded-Host') or self.headers.get('Host')
+        return f"{scheme}://{host}{path}"
+
+    @property
+    def query(self):
+        return parse_qs(urlparse(self.path).query)
+
+    def read_body(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        with self.timer.stage('read'):
+            return self.rfile.read(content_length)
+
+    def read_json(self):
+        body = self.read_body()
+        with self.timer.stage('parse'):
+            return json.loads(body.decode())
+
+    @property
+    def is_form(self):
+        """multipart/form-data or application/octet-stream request"""
+        content_type = self.headers.get('Content-Type', '')
+        return is_multipart(content_type) or is_binary(content_type)
+
+    def read_form(self, on_file, file_field=None, budget=None):
+        """Fields of a multipart/form-data body, as lists of values like
+        parse_qs. File parts are passed to on_file(data, size, filename) as
+        soon as each one has been read and replaced by what it returns.
+
+        An application/octet-stream body is a single file filed under
+        `file_field`, with the other fields taken from the query string.
+        """
+        content_type = self.headers.get('Content-Type', '')
+        if is_binary(content_type):
+            if file_field is None:
+                raise BodyParseError("application/octet-stream is not accepted here; use multipart/form-data")
+            form = self.query
+            content_length = int(self.headers.get('Content-Length', 0))
+            # Reserved before reading, as MultipartReader does per piece, so
+            # concurrent uploads wait for room instead of all landing at once
+            if budget is not None:
+                budget.reserve(content_length)
+            try:
+                data = self.read_body()
+            except Exception:
+                if budget is not None:
+                    budget.release(content_length)
+                raise
+            if budget is not None and len(data) < content_length:
+                budget.release(content_length - len(data))
+            form[file_field] = [on_file(data, len(data), form.get('filename', [None])[0])]
+            return form
+
+        content_length = int(self.headers.get('Content-Length', 0))
+        reader = MultipartReader(self.rfile, content_length, boundary_of(content_type), on_file, budget)
+        with self.timer.stage('read'):
+            return reader.parse()
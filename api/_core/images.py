@@ -0,0 +1,198 @@
+"""
+Image normalization before upload - oversized inputs are downscaled to the
+largest edge the model can use, stripped of metadata and re-encoded, so huge
+phone PNGs don't spend longer uploading than the model spends rendering
+"""
+
+import io
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Pillow, once load_pillow() has imported it
+Image = None
+ImageOps = None
+
+# Opt-in; needs Pillow
+NORMALIZE_IMAGES = os.getenv("IMAGE_NORMALIZE", "").lower() in ("1", "true")
+# auto_4K output never needs more than this many pixels on the long edge
+MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "4096"))
+# Images within MAX_EDGE are still re-encoded once they are at least this big
+REENCODE_BYTES = int(os.getenv("IMAGE_REENCODE_BYTES", str(4 * 1024 * 1024)))
+# WEBP keeps alpha and is accepted by every model endpoint we call
+OUTPUT_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper()
+QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+WORKERS = int(os.getenv("IMAGE_NORMALIZE_WORKERS", "0")) or os.cpu_count() or 1
+
+OUTPUT_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg", "PNG": "image/png"}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def load_pillow():
+    """Import Pillow on first use - normalizing is opt-in, so most instances
+    never pay for the import. False when it isn't installed."""
+    global Image, ImageOps
+    if Image is None:
+        try:
+            from PIL import Image as image_module, ImageOps as image_ops
+        except ImportError:
+            return False
+        Image, ImageOps = image_module, image_ops
+    return True
+
+
+def image_dimensions(data):
+    """(width, height) read from the file header without decoding pixels,
+    or None for formats / files we can't read that way"""
+    head = bytes(data[:32])
+
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            w, h = struct.unpack('<HH', head[26:30])
+            return w & 0x3fff, h & 0x3fff
+        if chunk == b'VP8L':
+            b0, b1, b2, b3 = head[21:25]
+            return 1 + (((b1 & 0x3f) << 8) | b0), 1 + (((b3 & 0xf) << 10) | (b2 << 2) | ((b1 & 0xc0) >> 6))
+        if chunk == b'VP8X':
+            return 1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little')
+        return None
+
+    if head[:2] == b'BM':
+        w, h = struct.unpack('<ii', head[18:26])
+        return w, abs(h)
+
+    if head[:3] == b'\xff\xd8\xff':
+        return _jpeg_dimensions(data)
+
+    return None
+
+
+def _jpeg_dimensions(data):
+    # Walk marker segments up to the first start-of-frame
+    view = memoryview(data)
+    i = 2
+    while i + 9 < len(view):
+        if view[i] != 0xff:
+            return None
+        marker = view[i + 1]
+        if marker == 0xff:
+            # Fill byte
+            i += 1
+            continue
+        if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+            i += 2
+            continue
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            h, w = struct.unpack('>HH', view[i + 5:i + 9])
+            return w, h
+        i += 2 + struct.unpack('>H', view[i + 2:i + 4])[0]
+    return None
+
+
+def needs_normalizing(data, dimensions):
+    if dimensions is not None and max(dimensions) > MAX_EDGE:
+        return True
+    return len(data) >= REENCODE_BYTES
+
+
+def normalize_image(data):
+    """Downscale, strip and re-encode one image. Returns (bytes, report);
+    the original bytes come back whenever the result wouldn't be smaller.
+
+    Module-level so it can run in a worker process.
+    """
+    started = time.perf_counter()
+    dimensions = image_dimensions(data)
+    report = {"original_bytes": len(data), "action": "kept"}
+    if dimensions:
+        report["width"], report["height"] = dimensions
+
+    out = data
+    if needs_normalizing(data, dimensions) and load_pillow():
+        try:
+            out, report = _reencode(data, report)
+        except Exception as e:
+            # Unreadable or exotic input; the model gets it as sent
+            report["error"] = str(e)
+
+    report["bytes"] = len(out)
+    report["saved_bytes"] = len(data) - len(out)
+    report["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return out, report
+
+
+def _reencode(data, report):
+    img = Image.open(io.BytesIO(data))
+    original_edge = max(img.size)
+    if original_edge > MAX_EDGE:
+        scale = MAX_EDGE / original_edge
+        # JPEG can decode straight at 1/2, 1/4 or 1/8 size
+        img.draft('RGB', (int(img.size[0] * scale), int(img.size[1] * scale)))
+
+    # Bake in the EXIF rotation before the EXIF block is dropped
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((MAX_EDGE, MAX_EDGE), Image.LANCZOS, reducing_gap=3.0)
+    resized = max(img.size) < original_edge
+
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+
+    fmt = OUTPUT_FORMAT
+    if fmt == 'JPEG' and has_alpha:
+        fmt = 'PNG'
+
+    out = io.BytesIO()
+    # Only the colour profile survives; EXIF, XMP and text chunks are left behind
+    options = {"icc_profile": img.info.get('icc_profile')} if img.info.get('icc_profile') else {}
+    if fmt in ('WEBP', 'JPEG'):
+        options["quality"] = QUALITY
+    if fmt == 'PNG':
+        options["optimize"] = True
+    img.save(out, format=fmt, **options)
+    encoded = out.getvalue()
+
+    if not resized and len(encoded) >= len(data):
+        return data, report
+
+    report["action"] = "resized" if resized else "reencoded"
+    report["width"], report["height"] = img.size
+    report["format"] = OUTPUT_TYPES.get(fmt, fmt)
+    return encoded, report
+
+
+def get_pool():
+    """Process pool for batch images, falling back to threads where the
+    platform has no working semaphores (e.g. no /dev/shm)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                # Imported here; it brings in multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                _pool = ProcessPoolExecutor(max_workers=WORKERS)
+            except (OSError, NotImplementedError, ImportError) as e:
+                print(f"Image normalization falling back to threads: {e}")
+                _pool = ThreadPoolExecutor(max_workers=WORKERS)
+        return _pool
+
+
+def normalize(data, parallel=False):
+    """normalize_image() in this process, or on the worker pool when `parallel`"""
+    if parallel:
+        return get_pool().submit(normalize_image, bytes(data)).result()
+    return normalize_image(data)
+
+
+def enabled():
+    return NORMALIZE_IMAGES and load_pillow()
@@ -0,0 +1,224 @@
+"""
+Job state - model calls submitted to fal's queue are tracked by request id in
+a pluggable store and filled in by fal's webhooks or, failing that, from fal's
+status/result calls on each poll
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+from api._core import fal
+from api._core.results import remember_result
+
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "/tmp/seedream-jobs.sqlite3")
+# "package.module:ClassName" of a JobStore implementation to use instead of SQLite
+JOB_STORE = os.getenv("JOB_STORE")
+REFRESH_CONCURRENCY = int(os.getenv("JOB_REFRESH_CONCURRENCY", "8"))
+
+FINISHED = ("completed", "failed")
+
+
+class JobStore:
+    """Interface for job persistence.
+
+    Jobs are plain JSON-serializable dicts with an "id" key, so any key/value
+    store (Redis, a KV service, ...) can implement this with a GET and a SET
+    of the serialized document.
+    """
+
+    def get(self, job_id):
+        raise NotImplementedError
+
+    def save(self, job):
+        raise NotImplementedError
+
+
+class SQLiteJobStore(JobStore):
+    """Local SQLite store - fine for one warm instance or `vercel dev`"""
+
+    def __init__(self, path=JOB_STORE_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, job):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, updated_at) VALUES (?, ?, ?)",
+                (job["id"], json.dumps(job), time.time())
+            )
+            self._db.commit()
+
+
+_store = None
+_store_lock = threading.Lock()
+# Serializes read-modify-write of jobs on this instance (webhooks for the
+# pairs of one batch arrive together)
+_update_lock = threading.Lock()
+
+
+def get_job_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if JOB_STORE:
+                module_name, class_name = JOB_STORE.split(':')
+                _store = getattr(importlib.import_module(module_name), class_name)()
+            else:
+                _store = SQLiteJobStore()
+        return _store
+
+
+def store_error():
+    """Why jobs created here couldn't be polled, else None. On Vercel every
+    api/*.py function, and every instance of it, has its own /tmp, so the
+    default SQLite store never reaches /api/jobs; server.py and `vercel dev`
+    serve all functions from one machine."""
+    if JOB_STORE or os.getenv("VERCEL_ENV") not in ("production", "preview"):
+        return None
+    return "Async jobs need a shared job store on Vercel: set JOB_STORE (see README)"
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def new_job(model, pairs, job_id=None, **extra):
+    """Create and persist a job for already-submitted pairs. Pass `job_id`
+    when it had to be known before submitting (webhook URLs carry it)."""
+    job = {
+        "id": job_id or new_job_id(),
+        "model": model,
+        "status": "running",
+        "created_at": time.time(),
+        "pairs": pairs,
+    }
+    job.update(extra)
+    refresh_status(job)
+    get_job_store().save(job)
+    return job
+
+
+def _refresh_pair(model, pair):
+    try:
+        status = fal.status(model, pair["request_id"])
+        if isinstance(status, fal.fal_client.Queued):
+            pair["status"] = "queued"
+            pair["queue_position"] = status.position
+            return
+        if isinstance(status, fal.fal_client.InProgress):
+            pair["status"] = "in_progress"
+            pair.pop("queue_position", None)
+            return
+
+        pair.pop("queue_position", None)
+        if getattr(status, 'error', None):
+            pair["status"] = "failed"
+            pair["error"] = status.error
+            return
+
+        result = fal.result(model, pair["request_id"])
+    except Exception as e:
+        # Leave the pair pending; the next poll tries again
+        pair["last_error"] = str(e)
+        return
+
+    record_result(pair, result)
+
+
+def record_result(pair, result):
+    """Fill a pair in from a finished model result (images or a video)"""
+    images = result.get("images", [])
+    if images:
+        pair["status"] = "completed"
+        pair["image_url"] = images[0].get("url", "")
+        if len(images) > 1:
+            pair["images"] = images
+        remember_result(pair.pop("cache_key", None), result)
+    elif result.get("video"):
+        pair["status"] = "completed"
+        pair["video"] = result["video"]
+    else:
+        pair["status"] = "failed"
+        pair["error"] = "No image returned"
+    pair.pop("queue_position", None)
+    pair.pop("last_error", None)
+
+
+def expand_variants(pair):
+    """One result per image of a pair that asked for several ("variants",
+    each with its own filename); the pair itself otherwise. Variants the
+    model came back short of are failed."""
+    variants = pair.get("variants")
+    if not variants:
+        return [pair]
+    fields = {k: v for k, v in pair.items() if k not in ("variants", "images")}
+    images = pair.get("images") or ([{"url": pair["image_url"]}] if pair.get("image_url") else [])
+    results = []
+    for variant in variants:
+        result = {**fields, **variant}
+        k = variant["variant_index"]
+        if pair.get("status") == "completed":
+            if k < len(images):
+                result["image_url"] = images[k].get("url", "")
+            else:
+                result.pop("image_url", None)
+                result["status"] = "failed"
+                result["error"] = f"Model returned {len(images)} of {len(variants)} images"
+        results.append(result)
+    return results
+
+
+def refresh_status(job):
+    # Counted per image, so pairs with variants count once for each
+    results = [r for p in job["pairs"] for r in expand_variants(p)]
+    job["completed"] = len([r for r in results if r.get("status") == "completed"])
+    job["failed"] = len([r for r in results if r.get("status") == "failed"])
+    job["pending"] = len([r for r in results if r.get("status") not in FINISHED])
+    job["status"] = "running" if job["pending"] else "completed"
+
+
+def update_job(job_id, update):
+    """Apply update(job) to a stored job and persist it; None if there is no such job"""
+    with _update_lock:
+        job = get_job_store().get(job_id)
+        if job is None:
+            return None
+        update(job)
+        refresh_status(job)
+        job["updated_at"] = time.time()
+        get_job_store().save(job)
+        return job
+
+
+def refresh_job(job):
+    """Ask fal about every unfinished pair and persist what changed"""
+    pending = [p for p in job["pairs"] if p.get("status") not in FINISHED and p.get("request_id")]
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(REFRESH_CONCURRENCY, len(pending))) as pool:
+            list(pool.map(lambda pair: _refresh_pair(job["model"], pair), pending))
+
+    with _update_lock:
+        stored = get_job_store().get(job["id"]) or job
+        for pair, current in zip(job["pairs"], stored["pairs"]):
+            if current.get("status") in FINISHED:
+                # A webhook got there while fal was being asked
+                pair.update(current)
+        refresh_status(job)
+        job["updated_at"] = time.time()
+        get_job_store().save(job)
+    return job
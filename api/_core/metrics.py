@@ -0,0 +1,281 @@
+"""
+Request timing and in-process metrics - per-stage timers reported as a
+Server-Timing header, and a registry of counters and histograms rendered in
+Prometheus text format by /api/metrics
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from api._core import fal
+
+# Seconds; covers everything from a header parse to a long 4K render
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+POSITION_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {round(series['sum'], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def sample_lines(name, kind, help, value, **labels):
+    """Exposition lines for a value read at scrape time (pool, scheduler state)"""
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name}{_format_labels(_label_key(labels))} {value}"]
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("seedream_requests_total", "HTTP requests handled, by endpoint, method and status")
+REQUEST_SECONDS = REGISTRY.histogram("seedream_request_seconds", "Total request handling time")
+STAGE_SECONDS = REGISTRY.histogram("seedream_stage_seconds", "Time spent per request stage")
+FAL_QUEUE_SECONDS = REGISTRY.histogram("seedream_fal_queue_seconds", "Time model calls waited in fal's queue")
+FAL_INFERENCE_SECONDS = REGISTRY.histogram("seedream_fal_inference_seconds", "Model inference time reported by fal")
+FAL_QUEUE_POSITION = REGISTRY.histogram("seedream_fal_queue_position", "fal queue position when first seen", POSITION_BUCKETS)
+FAL_LOG_LINES = REGISTRY.counter("seedream_fal_log_lines_total", "Log lines streamed back by fal during model calls")
+
+
+class Timer:
+    """Stage timings for one request.
+
+    Repeated stages add up. Durations measured elsewhere (fal's queue wait,
+    inference time) are added with add(); `details` carries anything else
+    worth returning alongside them (queue position, per-pair timings).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.descriptions = {}
+        self.details = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds, description=None):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            if description:
+                self.descriptions[name] = description
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        """Stage durations in milliseconds, plus the total so far"""
+        with self._lock:
+            timings = {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+            timings.update(self.details)
+        timings["total"] = round(self.elapsed() * 1000, 1)
+        return timings
+
+    def header(self):
+        """Server-Timing header value"""
+        with self._lock:
+            items = list(self.stages.items())
+            descriptions = dict(self.descriptions)
+        parts = []
+        for name, seconds in items:
+            part = f"{name};dur={seconds * 1000:.1f}"
+            if name in descriptions:
+                part += f';desc="{descriptions[name]}"'
+            parts.append(part)
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ', '.join(parts)
+
+    def record(self, endpoint, method, status):
+        """Feed this request into the registry"""
+        REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+        REQUEST_SECONDS.observe(self.elapsed(), endpoint=endpoint)
+        with self._lock:
+            items = list(self.stages.items())
+        for name, seconds in items:
+            STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=name)
+
+
+class QueueTracker:
+    """on_queue_update callback for fal subscribe calls that turns the
+    Queued / InProgress / Completed stream into queue and inference times"""
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.perf_counter()
+        self.queue_position = None
+        self.queue_seconds = None
+        self.inference_seconds = None
+        self.log_lines = 0
+        self._running_since = None
+
+    def __call__(self, status):
+        now = time.perf_counter()
+        if isinstance(status, fal.fal_client.Queued):
+            if self.queue_position is None:
+                self.queue_position = status.position
+                FAL_QUEUE_POSITION.observe(status.position, model=self.model)
+            return
+
+        if self.queue_seconds is None:
+            self.queue_seconds = now - self.started
+            self._running_since = now
+            FAL_QUEUE_SECONDS.observe(self.queue_seconds, model=self.model)
+
+        logs = getattr(status, 'logs', None) or []
+        if isinstance(status, fal.fal_client.InProgress):
+            # In-progress polls repeat the log so far; count only what's new
+            if len(logs) > self.log_lines:
+                FAL_LOG_LINES.inc(len(logs) - self.log_lines, model=self.model)
+                self.log_lines = len(logs)
+            return
+
+        # Completed
+        metrics = getattr(status, 'metrics', None) or {}
+        self.inference_seconds = metrics.get('inference_time') or (now - self._running_since)
+        FAL_INFERENCE_SECONDS.observe(self.inference_seconds, model=self.model)
+
+    def report(self, timer):
+        """Add what was seen to a request Timer"""
+        if self.queue_seconds is not None:
+            description = f"position {self.queue_position}" if self.queue_position is not None else None
+            timer.add('queue', self.queue_seconds, description)
+        if self.inference_seconds is not None:
+            timer.add('inference', self.inference_seconds)
+        if self.queue_position is not None:
+            timer.details["queue_position"] = self.queue_position
+        if self.log_lines:
+            timer.details["log_lines"] = self.log_lines
+
+    def as_dict(self):
+        data = {}
+        if self.queue_seconds is not None:
+            data["queue_ms"] = round(self.queue_seconds * 1000, 1)
+        if self.inference_seconds is not None:
+            data["inference_ms"] = round(self.inference_seconds * 1000, 1)
+        if self.queue_position is not None:
+            data["queue_position"] = self.queue_position
+        if self.log_lines:
+            data["log_lines"] = self.log_lines
+        return data
+
+
+class QueueProgress:
+    """on_queue_update callback that feeds a QueueTracker and reports what
+    changed - a new queue position, the start of inference, new log lines -
+    as emit('progress', {**fields, ...})"""
+
+    def __init__(self, model, fields, emit):
+        self.fields = fields
+        self.emit = emit
+        self.tracker = QueueTracker(model)
+        self.position = None
+        self.running = False
+        self.log_lines = 0
+
+    def __call__(self, status):
+        self.tracker(status)
+        if isinstance(status, fal.fal_client.Queued):
+            if status.position != self.position:
+                self.position = status.position
+                self.emit('progress', {**self.fields, "status": "queued", "queue_position": status.position})
+            return
+
+        if isinstance(status, fal.fal_client.InProgress):
+            # Each poll repeats the whole log so far
+            logs = status.logs or []
+            new = [line.get('message', '') for line in logs[self.log_lines:]]
+            self.log_lines = max(self.log_lines, len(logs))
+            if new or not self.running:
+                self.running = True
+                self.emit('progress', {**self.fields, "status": "in_progress", "logs": new})
@@ -0,0 +1,179 @@
+"""
+Streaming multipart/form-data reader - walks the body straight off the socket
+one part at a time, so file parts go to the upload path as soon as they end
+instead of after the whole request has been buffered
+"""
+
+import io
+from email.message import Message
+from email.parser import BytesHeaderParser
+
+from api._core.stream_json import BodyParseError, PayloadTooLarge
+
+READ_CHUNK = 64 * 1024
+# Part headers and plain form fields are small; anything bigger is a mistake
+MAX_HEADER_BYTES = 16 * 1024
+MAX_FIELD_BYTES = 1024 * 1024
+
+
+def is_multipart(content_type):
+    return content_type.split(';', 1)[0].strip().lower() == 'multipart/form-data'
+
+
+def is_binary(content_type):
+    return content_type.split(';', 1)[0].strip().lower() == 'application/octet-stream'
+
+
+def boundary_of(content_type):
+    message = Message()
+    message['Content-Type'] = content_type
+    boundary = message.get_param('boundary')
+    if not boundary:
+        raise BodyParseError("multipart/form-data without a boundary")
+    return boundary.encode('latin-1')
+
+
+class MultipartReader:
+    """Parse a multipart/form-data body from `fp`, reading at most `length`
+    bytes.
+
+    Parts without a filename are form fields and come back as str. Parts
+    with one are files: their bytes are collected (accounted against
+    `budget`, if given) and handed to `on_file(data, size, filename)`,
+    whose return value takes the part's place. parse() returns every field
+    name mapped to a list of values in body order, like parse_qs.
+    """
+
+    def __init__(self, fp, length, boundary, on_file, budget=None):
+        self.fp = fp
+        self.remaining = length
+        self.on_file = on_file
+        self.budget = budget
+        # The CRLF before a delimiter belongs to it; pretending the body
+        # starts with one lets the first boundary match like the others
+        self.buf = b'\r\n'
+        self.delimiter = b'\r\n--' + boundary
+
+    def parse(self):
+        form = {}
+        # Preamble
+        for _ in self._part_body():
+            pass
+
+        while True:
+            if not self._ensure(2):
+                raise BodyParseError("Unexpected end of multipart body")
+            if self.buf.startswith(b'--'):
+                # Drain the epilogue so a kept-alive connection stays in step
+                while self._fill():
+                    self.buf = b''
+                return form
+            headers = self._headers()
+            name = headers.get_param('name', header='content-disposition')
+            if name is None:
+                raise BodyParseError("Part without a Content-Disposition name")
+
+            filename = headers.get_filename()
+            if filename is None:
+                value = self._field()
+            else:
+                value = self._file(filename)
+            form.setdefault(name, []).append(value)
+
+    # --- buffer handling ---
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        chunk = self.fp.read(min(READ_CHUNK, self.remaining))
+        if not chunk:
+            self.remaining = 0
+            return False
+        self.remaining -= len(chunk)
+        self.buf += chunk
+        return True
+
+    def _ensure(self, n):
+        while len(self.buf) < n:
+            if not self._fill():
+                return False
+        return True
+
+    def _headers(self):
+        # The rest of the boundary line (transport padding) ends at a CRLF
+        while True:
+            end = self.buf.find(b'\r\n')
+            if end != -1:
+                break
+            if len(self.buf) > MAX_HEADER_BYTES or not self._fill():
+                raise BodyParseError("Malformed multipart boundary line")
+        self.buf = self.buf[end + 2:]
+
+        if self._ensure(2) and self.buf.startswith(b'\r\n'):
+            # A part with no headers at all
+            self.buf = self.buf[2:]
+            return BytesHeaderParser().parsebytes(b'')
+
+        while True:
+            end = self.buf.find(b'\r\n\r\n')
+            if end != -1:
+                break
+            if len(self.buf) > MAX_HEADER_BYTES or not self._fill():
+                raise BodyParseError("Malformed multipart part headers")
+        raw = self.buf[:end]
+        self.buf = self.buf[end + 4:]
+        return BytesHeaderParser().parsebytes(raw)
+
+    def _part_body(self):
+        """Yield the current part's bytes up to the next delimiter, in
+        whatever pieces the buffer holds, and leave the buffer just past it"""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buf.find(self.delimiter)
+            if index != -1:
+                if index:
+                    yield self.buf[:index]
+                self.buf = self.buf[index + len(self.delimiter):]
+                return
+            # Hold back what could be the start of a delimiter split across reads
+            if len(self.buf) > keep:
+                yield self.buf[:-keep]
+                self.buf = self.buf[-keep:]
+            if not self._fill():
+                raise BodyParseError("Unexpected end of multipart body")
+
+    # --- parts ---
+
+    def _field(self):
+        raw = b''
+        for piece in self._part_body():
+            raw += piece
+            if len(raw) > MAX_FIELD_BYTES:
+                raise PayloadTooLarge(f"Form field exceeds {MAX_FIELD_BYTES} bytes")
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            raise BodyParseError("Form field is not valid UTF-8")
+
+    def _file(self, filename):
+        out = io.BytesIO()
+        held = 0
+        try:
+            for piece in self._part_body():
+                if self.budget is not None:
+                    self.budget.reserve(len(piece), held)
+                held += len(piece)
+                out.write(piece)
+        except Exception:
+            if self.budget is not None:
+                self.budget.release(held)
+            raise
+
+        # BytesIO hands back its buffer without copying when nothing else references it
+        return self.on_file(out.getvalue(), held, filename)
+
+
+def form_fields(form, lists=()):
+    """parse() / parse_qs output in the shape of the JSON body: names in
+    `lists` keep every value, the rest take their first"""
+    return {name: values if name in lists else values[0] for name, values in form.items()}
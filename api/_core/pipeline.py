@@ -0,0 +1,273 @@
+"""
+Pipeline execution - a small DAG of generate / edit / video / upload steps
+run server-side: a step starts as soon as the steps it references have
+finished, their output URLs are passed straight in, and independent branches
+run side by side
+"""
+
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from api._core import scheduler
+from api._core.arguments import EDIT_MODEL, GENERATE_MODEL, VIDEO_MODEL, generate_arguments, video_arguments
+from api._core.drafts import FINAL_SIZE, image_size
+from api._core.metrics import QueueProgress
+from api._core.results import result_key, cached_result, remember_result
+from api._core.singleflight import coalesce, fingerprint
+from api._core.uploads import upload_base64
+
+MAX_STEPS = int(os.getenv("PIPELINE_MAX_STEPS", "32"))
+# Steps running at once across all branches of one pipeline
+CONCURRENCY = int(os.getenv("PIPELINE_CONCURRENCY", "8"))
+
+# "$step" is a step's main output URL, "$step[1]" its second image
+REFERENCE = re.compile(r'^\$([A-Za-z0-9_-]+)(?:\[(\d+)\])?$')
+STEP_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class PipelineError(ValueError):
+    """A pipeline that can't run as given"""
+
+
+def references(value):
+    """Ids of the steps referenced anywhere in a (nested) field value"""
+    if isinstance(value, str):
+        match = REFERENCE.match(value)
+        return {match.group(1)} if match else set()
+    if isinstance(value, list):
+        return set().union(*(references(v) for v in value))
+    if isinstance(value, dict):
+        return set().union(*(references(v) for v in value.values()))
+    return set()
+
+
+def resolve(value, outputs):
+    """`value` with every reference replaced by the URL it points at"""
+    if isinstance(value, str):
+        match = REFERENCE.match(value)
+        if not match:
+            return value
+        output = outputs[match.group(1)]
+        if match.group(2) is None:
+            return output["url"]
+        images = output.get("images") or []
+        n = int(match.group(2))
+        if n >= len(images):
+            raise PipelineError(f"{value}: step returned {len(images)} image(s)")
+        return images[n].get("url")
+    if isinstance(value, list):
+        return [resolve(v, outputs) for v in value]
+    if isinstance(value, dict):
+        return {k: resolve(v, outputs) for k, v in value.items()}
+    return value
+
+
+def parse(steps):
+    """Check a list of steps and work out what each one waits for.
+
+    Returns (steps by id, dependencies by id, ids in an order where every
+    step comes after its dependencies); raises PipelineError.
+    """
+    if not isinstance(steps, list) or not steps:
+        raise PipelineError("No steps provided")
+    if len(steps) > MAX_STEPS:
+        raise PipelineError(f"Too many steps (max {MAX_STEPS})")
+
+    by_id = {}
+    for i, step in enumerate(steps):
+        if not isinstance(step, dict):
+            raise PipelineError(f"Step {i} is not an object")
+        step_id = str(step.get('id') or f"step{i + 1}")
+        if not STEP_ID.match(step_id):
+            raise PipelineError(f"Step id {step_id!r} may only use letters, digits, _ and -")
+        if step_id in by_id:
+            raise PipelineError(f"Duplicate step id {step_id!r}")
+        if step.get('type') not in RUNNERS:
+            raise PipelineError(f"Step {step_id!r}: type must be one of {', '.join(RUNNERS)}")
+        by_id[step_id] = step
+
+    deps = {}
+    for step_id, step in by_id.items():
+        deps[step_id] = references({k: v for k, v in step.items() if k not in ('id', 'type')})
+        unknown = deps[step_id] - by_id.keys()
+        if unknown:
+            raise PipelineError(f"Step {step_id!r} references unknown step(s): {', '.join(sorted(unknown))}")
+
+    # Kahn's algorithm; whatever never becomes ready is on a cycle
+    order = []
+    waiting = {step_id: set(d) for step_id, d in deps.items()}
+    ready = [step_id for step_id in by_id if not waiting[step_id]]
+    while ready:
+        step_id = ready.pop(0)
+        order.append(step_id)
+        for other in by_id:
+            if step_id in waiting[other]:
+                waiting[other].discard(step_id)
+                if not waiting[other]:
+                    ready.append(other)
+    if len(order) < len(by_id):
+        raise PipelineError(f"Steps form a cycle: {', '.join(s for s in by_id if s not in order)}")
+
+    return by_id, deps, order
+
+
+def image_url(value):
+    """A URL for an image field: URLs as they are, base64 data uploaded"""
+    if not isinstance(value, str) or not value:
+        raise PipelineError("Expected an image URL, base64 data or a $step reference")
+    if value.startswith('http'):
+        return value
+    url, _ = upload_base64(value)
+    return url
+
+
+def call_model(model, arguments, deadline, progress, label, cache=True):
+    """Run one model call - from the result cache when seeded, shared with
+    identical calls in flight, with retries of transient fal errors"""
+    cache_key = result_key(model, arguments) if cache else None
+    result = cached_result(cache_key)
+    if result is not None:
+        return result, True
+
+    def run():
+        return scheduler.subscribe(model, arguments, deadline=deadline, label=label, with_logs=True,
+                                   on_queue_update=progress)
+
+    result, _ = coalesce('pipeline', fingerprint(model, arguments), run)
+    remember_result(cache_key, result)
+    return result, False
+
+
+def image_output(result, cached):
+    images = result.get("images", [])
+    if not images:
+        raise RuntimeError("No image returned")
+    return {"url": images[0].get("url", ""), "images": images, "seed": result.get("seed"), "cached": cached}
+
+
+def with_seed(arguments, fields):
+    seed = fields.get('seed')
+    if seed is not None:
+        arguments["seed"] = int(seed)
+    return arguments
+
+
+def run_generate(fields, deadline, emit, label):
+    if not fields.get('prompt'):
+        raise PipelineError("No prompt provided")
+    arguments = generate_arguments(fields)
+    progress = QueueProgress(GENERATE_MODEL, {"id": label}, emit)
+    return image_output(*call_model(GENERATE_MODEL, arguments, deadline, progress, f'pipeline {label}'))
+
+
+def run_edit(fields, deadline, emit, label):
+    if not fields.get('prompt'):
+        raise PipelineError("No prompt provided")
+    images = fields.get('image_urls') or fields.get('images') or []
+    if isinstance(images, str):
+        images = [images]
+    if not images:
+        raise PipelineError("No images provided")
+    arguments = with_seed({
+        "prompt": fields['prompt'],
+        "image_urls": [image_url(image) for image in images],
+        "num_images": int(fields.get('num_images', 1)),
+        "image_size": image_size(fields.get('image_size'), FINAL_SIZE),
+        "enable_safety_checker": False,
+    }, fields)
+    progress = QueueProgress(EDIT_MODEL, {"id": label}, emit)
+    return image_output(*call_model(EDIT_MODEL, arguments, deadline, progress, f'pipeline {label}'))
+
+
+def run_video(fields, deadline, emit, label):
+    if not fields.get('prompt'):
+        raise PipelineError("No prompt provided")
+    arguments = video_arguments(image_url(fields.get('image_url') or fields.get('image')), fields)
+    progress = QueueProgress(VIDEO_MODEL, {"id": label}, emit)
+    # The result cache keys on image_urls, which a video call doesn't have
+    result, _ = call_model(VIDEO_MODEL, arguments, deadline, progress, f'pipeline {label}', cache=False)
+    if not result.get("video"):
+        raise RuntimeError("No video returned")
+    return {"url": result["video"].get("url", ""), "video": result["video"], "seed": result.get("seed")}
+
+
+def run_upload(fields, deadline, emit, label):
+    image = fields.get('image') or fields.get('url')
+    if isinstance(image, str) and image.startswith('http'):
+        return {"url": image}
+    if not image:
+        raise PipelineError("No image provided")
+    url, cached = upload_base64(image)
+    return {"url": url, "cached": cached}
+
+
+RUNNERS = {
+    "generate": run_generate,
+    "edit": run_edit,
+    "video": run_video,
+    "upload": run_upload,
+}
+
+
+def run_step(step_id, step, fields, deadline, emit):
+    started = time.perf_counter()
+    output = RUNNERS[step["type"]](fields, deadline, emit, step_id)
+    return {**output, "ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+def run(plan, deadline, emit, concurrency=CONCURRENCY):
+    """Run a parse()d pipeline to the end. emit(event, data) is called, from
+    any thread, with a "node" event whenever a step changes status and with
+    "progress" events while its model call is queued or running.
+
+    A step that fails skips everything downstream of it; other branches
+    carry on. Returns the final state of every step, in input order.
+    """
+    by_id, deps, order = plan
+    # "kind", not "type", which NDJSON events use for the event name
+    nodes = {step_id: {"id": step_id, "kind": step["type"], "status": "pending"} for step_id, step in by_id.items()}
+    outputs = {}
+
+    def finish(step_id, **state):
+        nodes[step_id].update(state)
+        emit('node', nodes[step_id])
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(by_id)))) as pool:
+        running = {}
+
+        def start_ready():
+            for step_id in order:
+                node = nodes[step_id]
+                if node["status"] != "pending":
+                    continue
+                blocked = [d for d in deps[step_id] if nodes[d]["status"] in ("failed", "skipped")]
+                if blocked:
+                    # Order is topological, so this reaches the whole subtree in one pass
+                    finish(step_id, status="skipped", error=f"Needs {', '.join(sorted(blocked))}, which did not complete")
+                    continue
+                if any(nodes[d]["status"] != "completed" for d in deps[step_id]):
+                    continue
+                try:
+                    fields = resolve({k: v for k, v in by_id[step_id].items() if k not in ('id', 'type')}, outputs)
+                except PipelineError as e:
+                    finish(step_id, status="failed", error=str(e))
+                    continue
+                finish(step_id, status="running")
+                running[pool.submit(run_step, step_id, by_id[step_id], fields, deadline, emit)] = step_id
+
+        start_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step_id = running.pop(future)
+                try:
+                    outputs[step_id] = future.result()
+                    finish(step_id, status="completed", **outputs[step_id])
+                except Exception as e:
+                    print(f"pipeline: step {step_id} failed: {e}")
+                    finish(step_id, status="failed", error=str(e))
+            start_ready()
+
+    return [nodes[step_id] for step_id in by_id]
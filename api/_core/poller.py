@@ -0,0 +1,142 @@
+"""
+Shared queue poller - one loop checks every fal request the process is
+waiting on, so a waiting call parks on a future instead of polling fal
+itself. Turned on by FAL_SHARED_POLLER (server.py does this): hundreds of
+calls in flight then cost one status sweep per interval over a few pool
+connections rather than a polling loop each.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from api._core import fal
+
+# Seconds between status checks of a waiting request
+POLL_INTERVAL = float(os.getenv("FAL_POLL_INTERVAL", "0.5"))
+# Status requests in flight at once during a sweep
+POLL_CONCURRENCY = int(os.getenv("FAL_POLL_CONCURRENCY", "16"))
+
+
+class Waiter:
+    def __init__(self, handle, on_update, with_logs):
+        self.handle = handle
+        self.on_update = on_update
+        self.with_logs = with_logs
+        self.future = Future()
+
+
+class SharedPoller:
+    """Sweep all waiting requests every `interval`, passing each status to
+    its on_update callback like fal_client's subscribe does, and resolve the
+    request's future with its result (or error) once it has completed"""
+
+    def __init__(self, interval=POLL_INTERVAL, concurrency=POLL_CONCURRENCY):
+        self.interval = interval
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fal-poll')
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._thread = None
+        self._closed = False
+        self.stats = {"waiting": 0, "sweeps": 0, "polls": 0, "completed": 0, "failed": 0}
+
+    def watch(self, handle, on_update=None, with_logs=False):
+        """Future for the result of a submitted request"""
+        waiter = Waiter(handle, on_update, with_logs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Poller is shut down")
+            self._waiting.append(waiter)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='fal-poller', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return waiter.future
+
+    def wait(self, handle, on_update=None, with_logs=False):
+        return self.watch(handle, on_update, with_logs).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._waiting and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                sweep = list(self._waiting)
+
+            started = time.monotonic()
+            try:
+                for _ in self._pool.map(self._poll, sweep):
+                    pass
+            except RuntimeError:
+                # close() shut the pool down mid-sweep
+                return
+            self.stats["sweeps"] += 1
+            self.stats["polls"] += len(sweep)
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def _poll(self, waiter):
+        try:
+            status = waiter.handle.status(with_logs=waiter.with_logs)
+            if waiter.on_update is not None:
+                waiter.on_update(status)
+            if not isinstance(status, fal.fal_client.Completed):
+                return
+            # Raises fal's usual error when the request failed
+            result = waiter.handle.get()
+        except Exception as e:
+            if self._finish(waiter):
+                self.stats["failed"] += 1
+                waiter.future.set_exception(e)
+            return
+        if self._finish(waiter):
+            self.stats["completed"] += 1
+            waiter.future.set_result(result)
+
+    def _finish(self, waiter):
+        """Stop watching `waiter`; False if close() already failed it"""
+        with self._cond:
+            if waiter not in self._waiting:
+                return False
+            self._waiting.remove(waiter)
+            return True
+
+    def snapshot(self):
+        with self._cond:
+            return {**self.stats, "waiting": len(self._waiting), "interval": self.interval}
+
+    def close(self):
+        """Stop polling; anything still waiting fails"""
+        with self._cond:
+            self._closed = True
+            waiting, self._waiting = self._waiting, []
+            self._cond.notify_all()
+        for waiter in waiting:
+            waiter.future.set_exception(RuntimeError("Poller shut down while waiting for fal"))
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_poller = None
+_lock = threading.Lock()
+
+
+def get_poller():
+    global _poller
+    with _lock:
+        if _poller is None:
+            _poller = SharedPoller()
+        return _poller
+
+
+def poller_active():
+    return _poller is not None
+
+
+def close():
+    global _poller
+    with _lock:
+        poller, _poller = _poller, None
+    if poller is not None:
+        poller.close()
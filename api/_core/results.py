@@ -0,0 +1,55 @@
+"""
+Seeded result memoization - a model call with a fixed seed and the same
+prompt, input images and output settings is answered from a local cache
+instead of being paid for again
+"""
+
+import os
+import json
+import hashlib
+
+from api._core.cache import TTLCache
+from api._core.uploads import url_hash
+
+# Opt-in: only seeded calls are ever cached, and only when this is set
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "").lower() in ("1", "true")
+
+RESULT_CACHE = TTLCache(
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", "1024")),
+    ttl=int(os.getenv("RESULT_CACHE_TTL", "86400")),
+    path=os.getenv("RESULT_CACHE_PATH") or None,
+    table='results',
+) if RESULT_CACHE_ENABLED else None
+
+
+def normalize_prompt(prompt):
+    return ' '.join(prompt.split())
+
+
+def result_key(model, arguments):
+    """Cache key for a model call, or None when it can't be memoized"""
+    if RESULT_CACHE is None or arguments.get('seed') is None:
+        return None
+
+    identity = {
+        "model": model,
+        "prompt": normalize_prompt(arguments.get('prompt', '')),
+        # Same bytes uploaded twice get different URLs; key on content where known
+        "images": [url_hash(url) or url for url in arguments.get('image_urls', [])],
+        "seed": arguments['seed'],
+        "image_size": arguments.get('image_size'),
+        "num_images": arguments.get('num_images', 1),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def cached_result(key):
+    if key is None:
+        return None
+    return RESULT_CACHE.get(key)
+
+
+def remember_result(key, result):
+    """Keep a successful result; failures and empty results are retried next time"""
+    if key is not None and result.get('images'):
+        RESULT_CACHE.set(key, result)
@@ -0,0 +1,253 @@
+"""
+Adaptive scheduler for model calls - a process-wide concurrency limit that
+grows additively while fal keeps up and halves on rate limiting (AIMD), plus
+retries of transient failures with jittered exponential backoff inside a
+per-request deadline
+"""
+
+import os
+import random
+import threading
+import time
+
+from api._core import fal
+
+# Concurrency window shared by every model call on the instance
+SCHEDULER_MIN = int(os.getenv("SCHEDULER_MIN_CONCURRENCY", "1"))
+SCHEDULER_MAX = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "32"))
+SCHEDULER_INITIAL = int(os.getenv("SCHEDULER_INITIAL_CONCURRENCY", "8"))
+# Latency above this multiple of the best recent average stops further growth
+LATENCY_FACTOR = float(os.getenv("SCHEDULER_LATENCY_FACTOR", "2"))
+
+RETRY_BASE = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "6"))
+# Seconds a request may spend on retries; stays inside the function's maxDuration
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "280"))
+
+TRANSIENT_STATUS = (408, 425, 429, 500, 502, 503, 504)
+
+# The report dict of the call() running on this thread, for on_response
+_local = threading.local()
+
+
+def status_code(exc):
+    """HTTP status behind a fal_client or httpx error, else None"""
+    code = getattr(exc, 'status_code', None)
+    if code is None:
+        code = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return code
+
+
+def is_transient(exc):
+    code = status_code(exc)
+    if code is not None:
+        return code in TRANSIENT_STATUS
+    if fal.httpx is not None and isinstance(exc, (fal.httpx.TransportError, fal.httpx.TimeoutException)):
+        return True
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def retry_after(exc):
+    """Seconds from a Retry-After header on the error response, if any"""
+    headers = getattr(exc, 'response_headers', None)
+    if headers is None:
+        headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def client_retried(exc):
+    """True when fal_client already retried this status itself (1.x retries
+    408/409/429 up to ten times) - retrying again would stack its attempts
+    on top of ours"""
+    code = status_code(exc)
+    return code is not None and code in fal.fal_client.client.RETRY_CODES
+
+
+def on_response(response):
+    """httpx response hook of the pooled fal clients. 429s are seen here,
+    including the ones fal_client retries internally and never raises."""
+    if response.status_code == 429:
+        get_scheduler().on_throttle()
+        _bump(getattr(_local, 'report', None), "throttles")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AdaptiveScheduler:
+    """Gate model calls through an AIMD concurrency window and retry
+    transient failures.
+
+    The window grows by about one slot per window's worth of successes and is
+    halved on a 429 (at most once per average call latency, so a burst of
+    rejections from the same window counts once).
+    """
+
+    def __init__(self, initial=SCHEDULER_INITIAL, minimum=SCHEDULER_MIN, maximum=SCHEDULER_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.active = 0
+        self.latency = None
+        self.best_latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self.stats = {"calls": 0, "retries": 0, "throttles": 0, "failures": 0, "deadline_exceeded": 0}
+
+    # --- window ---
+
+    def acquire(self, deadline):
+        with self._cond:
+            while self.active >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("Timed out waiting for an upstream slot")
+                self._cond.wait(remaining)
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def on_success(self, seconds):
+        with self._cond:
+            self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+            self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+            # Only grow while latency says fal isn't queueing us
+            if self.latency <= LATENCY_FACTOR * self.best_latency:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.stats["throttles"] += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= (self.latency or 1):
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = now
+
+    # --- calls ---
+
+    def backoff(self, attempt, exc):
+        delay = retry_after(exc)
+        if delay is None:
+            # Full jitter keeps retries from a throttled window from lining up again
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE * 2 ** attempt))
+        return delay
+
+    def call(self, fn, deadline=None, label='fal call', report=None):
+        """Run fn() under the window, retrying transient errors until
+        `deadline` (a time.monotonic() value). `report`, if given, is a dict
+        whose "retries" and "throttles" counts are bumped for this call."""
+        if deadline is None:
+            deadline = time.monotonic() + REQUEST_DEADLINE
+
+        attempt = 0
+        while True:
+            self.acquire(deadline)
+            started = time.monotonic()
+            outer, _local.report = getattr(_local, 'report', None), report
+            try:
+                result = fn()
+            except Exception as e:
+                self.release()
+                if not is_transient(e) or client_retried(e) or attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                    self._count("failures")
+                    raise
+
+                # 429s have already been counted by on_response
+                delay = self.backoff(attempt, e)
+                if time.monotonic() + delay >= deadline:
+                    self._count("deadline_exceeded")
+                    raise
+
+                attempt += 1
+                self._count("retries")
+                _bump(report, "retries")
+                print(f"{label}: transient error ({status_code(e) or type(e).__name__}), "
+                      f"retry {attempt} in {delay:.1f}s, concurrency limit {int(self.limit)}")
+                time.sleep(delay)
+                continue
+            finally:
+                _local.report = outer
+
+            self.release()
+            self._count("calls")
+            self.on_success(time.monotonic() - started)
+            return result
+
+    def _count(self, name):
+        with self._cond:
+            self.stats[name] += 1
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["concurrency_limit"] = int(self.limit)
+            stats["concurrency_max"] = self.maximum
+            stats["active"] = self.active
+            stats["avg_latency"] = round(self.latency, 3) if self.latency is not None else None
+        return stats
+
+
+def _bump(report, name):
+    if report is not None:
+        report[name] = report.get(name, 0) + 1
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = AdaptiveScheduler()
+        return _scheduler
+
+
+def call(fn, deadline=None, label='fal call', report=None):
+    return get_scheduler().call(fn, deadline=deadline, label=label, report=report)
+
+
+def subscribe(application, arguments, deadline=None, label='fal call', report=None, on_queue_update=None,
+              with_logs=False):
+    """fal.subscribe() under call(), retrying only the step that failed.
+    Transient errors while waiting, or while fetching a finished request's
+    result, poll the same request again rather than submitting (and paying
+    for) it twice; only a request whose run fal reports as failed is
+    submitted again."""
+    handles = []
+    failed = []
+
+    def on_update(status):
+        if isinstance(status, fal.fal_client.Completed) and status.error:
+            failed.append(status.error)
+        if on_queue_update is not None:
+            on_queue_update(status)
+
+    def attempt():
+        if not handles:
+            handles.append(fal.submit(application, arguments))
+        failed.clear()
+        try:
+            return fal.wait(handles[0], on_update, with_logs)
+        except Exception:
+            if failed:
+                # The model run itself failed; a retry runs it again
+                handles.clear()
+            raise
+
+    return call(attempt, deadline=deadline, label=label, report=report)
+
+
+def deadline_after(seconds=REQUEST_DEADLINE):
+    return time.monotonic() + seconds
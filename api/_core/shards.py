@@ -0,0 +1,151 @@
+"""
+Sharded batch execution - splits a large pose x outfit matrix into shards
+sized to finish inside one function invocation, runs each shard on its own
+worker invocation of /api/batch and retries the shards that fail
+"""
+
+import os
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from api._core import fal, scheduler
+
+# Where shards are sent; defaults to /api/batch on the host the request came in on
+WORKER_URL = os.getenv("BATCH_WORKER_URL")
+# Seconds one shard is planned to take - well inside maxDuration, and short
+# enough that a round of retries still fits in the coordinator's deadline
+SHARD_SECONDS = float(os.getenv("BATCH_SHARD_SECONDS", "120"))
+# Per-pair latency assumed until workers have reported real ones
+PAIR_SECONDS = float(os.getenv("BATCH_PAIR_SECONDS", "45"))
+MAX_SHARDS = int(os.getenv("BATCH_MAX_SHARDS", "32"))
+SHARD_ATTEMPTS = int(os.getenv("BATCH_SHARD_ATTEMPTS", "3"))
+# Share of a shard's time planned for; the rest absorbs queueing and slow pairs
+HEADROOM = 0.7
+# Time kept back for merging and answering after the last shard returns
+RESPONSE_MARGIN = 5
+
+_http = None
+_http_lock = threading.Lock()
+
+
+class LatencyEstimate:
+    """Moving average of per-pair model latency reported by workers,
+    kept for the life of the warm instance"""
+
+    def __init__(self, initial):
+        self.seconds = initial
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self.samples:
+                return self.seconds
+        # Before any worker has reported, this instance's own calls are the best guess
+        return scheduler.get_scheduler().latency or self.seconds
+
+    def observe(self, seconds):
+        with self._lock:
+            self.seconds = seconds if not self.samples else 0.7 * self.seconds + 0.3 * seconds
+            self.samples += 1
+
+
+PAIR_LATENCY = LatencyEstimate(PAIR_SECONDS)
+
+
+def shard_size(total, concurrency, budget, pair_seconds):
+    """Pairs per shard: as many waves of `concurrency` parallel pairs as fit
+    in `budget` seconds, but never more than MAX_SHARDS shards in all"""
+    waves = max(1, int(budget * HEADROOM // pair_seconds))
+    # Past MAX_SHARDS, shards grow rather than queue behind each other
+    return max(waves * concurrency, math.ceil(total / MAX_SHARDS))
+
+
+def get_http():
+    """HTTP client for worker calls - separate from the fal pool, which may
+    be redirected to a fake upstream"""
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = fal.httpx.Client(limits=fal.httpx.Limits(max_connections=MAX_SHARDS, max_keepalive_connections=MAX_SHARDS))
+        return _http
+
+
+def run_shard(worker_url, body, timeout):
+    response = get_http().post(worker_url, json=body, timeout=timeout, headers={"X-Batch-Shard": "1"})
+    response.raise_for_status()
+    data = response.json()
+    if not data.get("success"):
+        raise RuntimeError(data.get("error") or "Shard failed")
+    return data
+
+
+def run_shards(worker_url, pairs, payload, concurrency, deadline, key=None):
+    """Run `pairs` across worker invocations until every one has a result,
+    SHARD_ATTEMPTS rounds have passed or `deadline` (time.monotonic()) is near.
+
+    `payload(shard_pairs)` builds a worker request body; `key(result)` maps a
+    worker result back to its pair. Each round re-plans shard sizes from the
+    latest latency estimate, so retried shards come out smaller when pairs
+    ran slow. Returns (results by pair, errors by pair, report).
+    """
+    if key is None:
+        key = lambda r: (r.get("pose_index"), r.get("outfit_index"))
+
+    results = {}
+    errors = {}
+    pending = list(pairs)
+    report = {"shards": 0, "retried_shards": 0, "failed_shards": 0, "rounds": 0}
+
+    while pending and report["rounds"] < SHARD_ATTEMPTS:
+        remaining = deadline - time.monotonic() - RESPONSE_MARGIN
+        if remaining <= 0:
+            break
+        # Leave room for a retry round unless this is the last one
+        last_round = report["rounds"] + 1 >= SHARD_ATTEMPTS
+        budget = min(SHARD_SECONDS, remaining if last_round else remaining / 2)
+        pair_seconds = PAIR_LATENCY.get()
+        size = shard_size(len(pending), concurrency, budget, pair_seconds)
+        shards = [pending[i:i + size] for i in range(0, len(pending), size)]
+
+        if report["rounds"]:
+            report["retried_shards"] += len(shards)
+        report["rounds"] += 1
+        report["shards"] += len(shards)
+        report["shard_size"] = size
+        report["pair_seconds"] = round(pair_seconds, 2)
+        print(f"batch: round {report['rounds']}, {len(pending)} pairs in {len(shards)} shard(s) of up to {size} "
+              f"({pair_seconds:.1f}s per pair, {budget:.0f}s budget)")
+
+        pending = []
+        with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            futures = {pool.submit(run_shard, worker_url, payload(shard), remaining): shard for shard in shards}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    report["failed_shards"] += 1
+                    print(f"batch: shard of {len(shard)} pairs failed: {e}")
+                    for pair in shard:
+                        errors[pair] = f"Shard failed: {e}"
+                    pending.extend(shard)
+                    continue
+
+                latency = (data.get("scheduler") or {}).get("avg_latency")
+                if latency:
+                    PAIR_LATENCY.observe(latency)
+                for result in data.get("results", []):
+                    pair = key(result)
+                    if pair in results:
+                        continue
+                    results[pair] = result
+                    errors.pop(pair, None)
+                # Pairs the worker didn't answer for go round again
+                pending.extend(pair for pair in shard if pair not in results)
+
+    for pair in pending:
+        errors.setdefault(pair, "Ran out of time before this pair could be retried")
+    return results, errors, report
@@ -0,0 +1,84 @@
+"""
+In-flight request coalescing - concurrent calls with the same argument
+fingerprint share one upstream call on a warm instance instead of each
+paying for their own
+"""
+
+import json
+import hashlib
+import threading
+
+
+def fingerprint(*parts):
+    """Stable hash of JSON-serializable call arguments, independent of key order"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+
+    Callers that arrive while a call with their key is running wait for it
+    and get its result (or its exception) instead of starting another.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (fn() or the running call's result, shared)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters:
+                print(f"{self.name}: coalesced {call.waiters} request(s) onto call {key[:12]} "
+                      f"({self.coalesced} total on this instance)")
+
+        return call.result, False
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_flight(name):
+    """The process-wide SingleFlight for one kind of call"""
+    with _flights_lock:
+        if name not in _flights:
+            _flights[name] = SingleFlight(name)
+        return _flights[name]
+
+
+def coalesce(name, key, fn):
+    return get_flight(name).do(key, fn)
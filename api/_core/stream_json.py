@@ -0,0 +1,284 @@
+"""
+Incremental JSON request reader - walks a JSON body straight off the socket
+and base64-decodes selected string values in chunks, so large embedded images
+are never held as JSON text, Python str and decoded bytes at the same time
+"""
+
+import io
+import json
+import binascii
+import threading
+
+READ_CHUNK = 64 * 1024
+# Characters of a streamed string looked at before deciding URL vs data URL vs base64
+PREFIX_LIMIT = 512
+# Everything a2b_base64 would skip anyway; dropped up front so chunks stay 4-aligned
+NON_BASE64 = bytes(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='))
+
+
+class BodyParseError(ValueError):
+    pass
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class MemoryBudget:
+    """Caps the decoded image bytes held in memory at once.
+
+    A reservation that doesn't fit waits for others to be released; one that
+    can never fit (a single image bigger than the limit) raises PayloadTooLarge.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def reserve(self, n, held=0):
+        """Reserve n more bytes for a buffer that already holds `held`"""
+        with self._cond:
+            while self.used + n > self.limit:
+                if self.used - held <= 0:
+                    raise PayloadTooLarge(f"Image exceeds the {self.limit} byte memory limit")
+                self._cond.wait()
+            self.used += n
+            self.peak = max(self.peak, self.used)
+
+    def release(self, n):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+class StreamingJSONReader:
+    """Parse one JSON document from `fp`, reading at most `length` bytes.
+
+    String values whose path satisfies `is_image_path(path)` are decoded as
+    base64 (bare or data URL) into memory accounted against `budget`, then
+    handed to `on_image(data, size)`; whatever that returns takes the place
+    of the string in the parsed result. Strings there that look like http(s)
+    URLs are returned unchanged. Paths are tuples of keys and list indexes,
+    e.g. ('poses', 0, 'data').
+    """
+
+    def __init__(self, fp, length, is_image_path, on_image, budget):
+        self.fp = fp
+        self.remaining = length
+        self.is_image_path = is_image_path
+        self.on_image = on_image
+        self.budget = budget
+        self.buf = b''
+        self.pos = 0
+
+    def parse(self):
+        value = self._value(())
+        self._skip_ws()
+        if self._peek() != b'':
+            raise BodyParseError("Extra data after JSON document")
+        return value
+
+    # --- buffer handling ---
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        chunk = self.fp.read(min(READ_CHUNK, self.remaining))
+        if not chunk:
+            self.remaining = 0
+            return False
+        self.remaining -= len(chunk)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while self.pos >= len(self.buf):
+            if not self._fill():
+                return b''
+        return self.buf[self.pos:self.pos + 1]
+
+    def _next(self):
+        c = self._peek()
+        if not c:
+            raise BodyParseError("Unexpected end of JSON body")
+        self.pos += 1
+        return c
+
+    def _skip_ws(self):
+        while self._peek() in (b' ', b'\t', b'\r', b'\n'):
+            self.pos += 1
+
+    def _expect(self, c):
+        self._skip_ws()
+        if self._next() != c:
+            raise BodyParseError(f"Expected {c.decode()!r}")
+
+    # --- grammar ---
+
+    def _value(self, path):
+        self._skip_ws()
+        c = self._peek()
+        if c == b'{':
+            return self._object(path)
+        if c == b'[':
+            return self._array(path)
+        if c == b'"':
+            if self.is_image_path(path):
+                return self._image_string()
+            return self._string()
+        if c == b'':
+            raise BodyParseError("Unexpected end of JSON body")
+        return self._scalar()
+
+    def _object(self, path):
+        self._next()
+        result = {}
+        self._skip_ws()
+        if self._peek() == b'}':
+            self._next()
+            return result
+        while True:
+            self._skip_ws()
+            if self._peek() != b'"':
+                raise BodyParseError("Expected object key")
+            key = self._string()
+            self._expect(b':')
+            result[key] = self._value(path + (key,))
+            self._skip_ws()
+            c = self._next()
+            if c == b'}':
+                return result
+            if c != b',':
+                raise BodyParseError("Expected ',' or '}'")
+
+    def _array(self, path):
+        self._next()
+        result = []
+        self._skip_ws()
+        if self._peek() == b']':
+            self._next()
+            return result
+        while True:
+            result.append(self._value(path + (len(result),)))
+            self._skip_ws()
+            c = self._next()
+            if c == b']':
+                return result
+            if c != b',':
+                raise BodyParseError("Expected ',' or ']'")
+
+    def _scalar(self):
+        token = bytearray()
+        while True:
+            c = self._peek()
+            if not c or c in b' \t\r\n,]}':
+                break
+            token += c
+            self.pos += 1
+        try:
+            return json.loads(bytes(token))
+        except ValueError:
+            raise BodyParseError(f"Invalid JSON value {bytes(token[:32])!r}")
+
+    def _raw_string_parts(self):
+        """Yield the bytes of a JSON string between its quotes, escapes
+        resolved, in whatever pieces the buffer happens to hold"""
+        self._next()  # opening quote
+        while True:
+            if self.pos >= len(self.buf) and not self._fill():
+                raise BodyParseError("Unterminated string")
+            end = len(self.buf)
+            quote = self.buf.find(b'"', self.pos, end)
+            backslash = self.buf.find(b'\\', self.pos, end)
+            stop = min(i for i in (quote, backslash, end) if i != -1)
+            if stop > self.pos:
+                yield self.buf[self.pos:stop]
+                self.pos = stop
+            if stop == quote:
+                self.pos += 1
+                return
+            if stop == backslash:
+                # Make sure the whole escape sequence is buffered
+                while len(self.buf) - self.pos < 6 and self._fill():
+                    pass
+                yield self._escape()
+
+    def _escape(self):
+        escape = self.buf[self.pos:self.pos + 2]
+        if escape == b'\\u':
+            code = self.buf[self.pos + 2:self.pos + 6]
+            self.pos += 6
+            try:
+                return chr(int(code, 16)).encode('utf-8', 'surrogatepass')
+            except ValueError:
+                raise BodyParseError("Invalid \\u escape")
+        self.pos += 2
+        try:
+            return json.loads(b'"' + escape + b'"').encode('utf-8')
+        except ValueError:
+            raise BodyParseError(f"Invalid escape {escape!r}")
+
+    def _string(self):
+        raw = b''.join(self._raw_string_parts())
+        try:
+            # Re-join surrogate pairs that were escaped separately
+            return raw.decode('utf-8', 'surrogatepass').encode('utf-16', 'surrogatepass').decode('utf-16')
+        except UnicodeError:
+            raise BodyParseError("Invalid string encoding")
+
+    def _image_string(self):
+        parts = self._raw_string_parts()
+        prefix = b''
+        for part in parts:
+            prefix += part
+            if len(prefix) >= PREFIX_LIMIT:
+                break
+
+        if prefix.startswith(b'http'):
+            rest = b''.join(parts)
+            return (prefix + rest).decode('utf-8', 'replace')
+
+        # Skip a data URL header; base64 itself never contains a comma
+        comma = prefix.find(b',')
+        if comma != -1:
+            prefix = prefix[comma + 1:]
+
+        out = io.BytesIO()
+        carry = b''
+        held = 0
+        try:
+            for part in _chain(prefix, parts):
+                data = carry + part.translate(None, NON_BASE64)
+                usable = len(data) - len(data) % 4
+                carry = data[usable:]
+                if not usable:
+                    continue
+                decoded = binascii.a2b_base64(data[:usable])
+                self.budget.reserve(len(decoded), held)
+                held += len(decoded)
+                out.write(decoded)
+
+            if carry:
+                # Tolerate missing padding like b64decode's callers usually do
+                decoded = binascii.a2b_base64(carry + b'=' * (-len(carry) % 4))
+                self.budget.reserve(len(decoded), held)
+                held += len(decoded)
+                out.write(decoded)
+        except binascii.Error as e:
+            self.budget.release(held)
+            raise BodyParseError(f"Invalid base64 image data: {e}")
+        except Exception:
+            self.budget.release(held)
+            raise
+
+        # BytesIO hands back its buffer without copying when nothing else references it
+        return self.on_image(out.getvalue(), held)
+
+
+def _chain(first, rest):
+    if first:
+        yield first
+    yield from rest
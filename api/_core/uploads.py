@@ -0,0 +1,154 @@
+"""
+Content-addressed upload cache - identical image bytes are uploaded to fal
+storage once and the returned URL is reused until it is about to expire
+"""
+
+import os
+import binascii
+import hashlib
+
+from api._core import fal, images
+from api._core.cache import TTLCache
+from api._core.singleflight import coalesce
+
+# Seconds fal keeps uploads around; when set, uploads request that lifetime
+# explicitly and cached URLs are retired a little before it runs out
+UPLOAD_EXPIRES_IN = int(os.getenv("UPLOAD_EXPIRES_IN", "0")) or None
+UPLOAD_CACHE_TTL = int(UPLOAD_EXPIRES_IN * 0.9) if UPLOAD_EXPIRES_IN else int(os.getenv("UPLOAD_CACHE_TTL", "21600"))
+
+UPLOAD_CACHE = TTLCache(
+    max_entries=int(os.getenv("UPLOAD_CACHE_SIZE", "512")),
+    ttl=UPLOAD_CACHE_TTL,
+    path=os.getenv("UPLOAD_CACHE_PATH") or None,
+    table='uploads',
+)
+
+# fal URL -> content hash of what was uploaded there, so callers that only
+# hold URLs can still key on image content
+URL_HASHES = TTLCache(max_entries=4 * int(os.getenv("UPLOAD_CACHE_SIZE", "512")), ttl=UPLOAD_CACHE_TTL)
+
+
+# (offset, signature, content type, extension) - first match wins
+IMAGE_SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    (8, b'WEBP', 'image/webp', '.webp'),
+    (0, b'GIF87a', 'image/gif', '.gif'),
+    (0, b'GIF89a', 'image/gif', '.gif'),
+    (8, b'avif', 'image/avif', '.avif'),
+    (8, b'heic', 'image/heic', '.heic'),
+    (8, b'heix', 'image/heic', '.heic'),
+    (8, b'mif1', 'image/heif', '.heif'),
+    (0, b'BM', 'image/bmp', '.bmp'),
+    (0, b'II*\x00', 'image/tiff', '.tiff'),
+    (0, b'MM\x00*', 'image/tiff', '.tiff'),
+)
+
+
+def sniff_image_type(img_bytes):
+    """(content type, extension) from the file's magic bytes"""
+    head = bytes(img_bytes[:16])
+    for offset, signature, content_type, ext in IMAGE_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return content_type, ext
+    return 'application/octet-stream', '.bin'
+
+
+def content_hash(img_bytes):
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def _upload(img_bytes, content_type, file_name):
+    if UPLOAD_EXPIRES_IN:
+        lifecycle = fal.fal_client.StorageSettings(expires_in=UPLOAD_EXPIRES_IN)
+        return fal.upload(img_bytes, content_type, file_name=file_name, lifecycle=lifecycle)
+    return fal.upload(img_bytes, content_type, file_name=file_name)
+
+
+def upload_bytes(img_bytes, parallel=False, report=None):
+    """Upload image bytes (or a memoryview of them) to fal storage straight
+    from memory, unless the same bytes are cached.
+
+    With IMAGE_NORMALIZE on, new images are downscaled/re-encoded first (on
+    the worker pool when `parallel`) and `report`, if given, is filled with
+    what that saved. The cache stays keyed on the bytes as sent.
+
+    Returns (url, cached).
+    """
+    key = content_hash(img_bytes)
+
+    def upload():
+        url = UPLOAD_CACHE.get(key)
+        if url:
+            URL_HASHES.set(url, key)
+            return url, True
+
+        data = img_bytes
+        if not isinstance(data, bytes):
+            # fal's HTTP client only takes bytes
+            data = bytes(data)
+        if images.enabled():
+            data, info = images.normalize(data, parallel)
+            if report is not None:
+                report.update(info)
+
+        content_type, ext = sniff_image_type(data)
+        url = _upload(data, content_type, f"{key[:16]}{ext}")
+
+        UPLOAD_CACHE.set(key, url)
+        URL_HASHES.set(url, key)
+        return url, False
+
+    # Concurrent uploads of the same bytes wait for the first one and share its URL
+    (url, cached), shared = coalesce('upload', key, upload)
+    return url, cached or shared
+
+
+def url_hash(url):
+    """Content hash of an image this instance uploaded to `url`, else None"""
+    return URL_HASHES.get(url)
+
+
+def decode_base64(img_data):
+    """Decode a bare base64 string or a data URL.
+
+    a2b_base64 reads ASCII strings in place, so unlike split(',') plus
+    b64decode the payload is copied at most once (to drop a data URL header).
+    """
+    if isinstance(img_data, str):
+        # Base64 never contains a comma, so one can only end a data URL header
+        comma = img_data.find(',', 0, 256)
+        return binascii.a2b_base64(img_data[comma + 1:] if comma != -1 else img_data)
+
+    view = memoryview(img_data)
+    comma = bytes(view[:256]).find(b',')
+    return binascii.a2b_base64(view[comma + 1:] if comma != -1 else view)
+
+
+def upload_base64(img_data, parallel=False, report=None):
+    """Decode a base64 string or data URL and upload it, returning (url, cached)"""
+    return upload_bytes(decode_base64(img_data), parallel, report)
+
+
+def upload_decoded(img_bytes, size, budget):
+    """Upload an image read off a request body, then hand its bytes back to
+    the MemoryBudget it was counted against; returns (url, cached, report)"""
+    report = {}
+    try:
+        # Normalization (if enabled) runs on the shared worker process pool
+        url, cached = upload_bytes(img_bytes, parallel=True, report=report)
+        return url, cached, report
+    finally:
+        budget.release(size)
+
+
+def upload_summary(cached_flags, reports=()):
+    """Response metadata for per-image cache hit flags and normalization reports"""
+    hits = sum(1 for cached in cached_flags if cached)
+    summary = {"cached": hits, "uploaded": len(cached_flags) - hits}
+
+    reports = [r for r in reports if r]
+    if reports:
+        summary["bytes_saved"] = sum(r["saved_bytes"] for r in reports)
+        summary["normalized"] = reports
+    return summary
@@ -0,0 +1,41 @@
+"""
+Instance state for keeping functions warm - how long the function took to
+import and whether this instance has served a request yet, reported by
+/api/health so a scheduler can tell cold instances from warm ones
+"""
+
+import time
+import threading
+
+from api._core import IMPORT_STARTED
+
+STARTED_AT = time.time()
+
+_lock = threading.Lock()
+_import_ms = None
+_requests = 0
+
+
+def mark_loaded():
+    """Called as handler classes are defined; the first one ends the import"""
+    global _import_ms
+    with _lock:
+        if _import_ms is None:
+            _import_ms = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+
+
+def record_request():
+    global _requests
+    with _lock:
+        _requests += 1
+
+
+def snapshot():
+    with _lock:
+        return {
+            # Cold until a request has been served, so the first one reports it
+            "state": "warm" if _requests else "cold",
+            "import_ms": _import_ms,
+            "uptime_seconds": round(time.time() - STARTED_AT, 1),
+            "requests_served": _requests,
+        }
@@ -0,0 +1,74 @@
+"""
+fal webhooks - model calls submitted with a callback URL instead of being
+polled to completion, so no function instance waits (and bills) while the
+model runs; /api/fal-webhook records the results in the job store
+"""
+
+import os
+import hmac
+import hashlib
+
+from api._core import fal, scheduler
+from api._core.jobs import new_job, new_job_id, store_error
+
+# Public URL of /api/fal-webhook; defaults to the host the request came in on
+WEBHOOK_URL = os.getenv("FAL_WEBHOOK_URL")
+# Make webhook mode the default instead of opting in with ?webhook=1
+WEBHOOKS_DEFAULT = os.getenv("FAL_WEBHOOKS", "").lower() in ("1", "true")
+# Key for the per-job callback tokens; falls back to one derived from the fal key
+WEBHOOK_SECRET = os.getenv("FAL_WEBHOOK_SECRET") or (
+    hashlib.sha256(b"seedream-webhook:" + fal.FAL_API_KEY.encode()).hexdigest() if fal.FAL_API_KEY else None
+)
+# Seconds without a webhook before job polls fall back to asking fal directly
+FALLBACK_AFTER = float(os.getenv("FAL_WEBHOOK_FALLBACK_AFTER", "60"))
+
+
+def job_token(job_id):
+    """HMAC of the job id; only fal (which got it in the webhook URL) can present it"""
+    return hmac.new(WEBHOOK_SECRET.encode(), job_id.encode(), hashlib.sha256).hexdigest()
+
+
+def verify(job_id, token):
+    if not WEBHOOK_SECRET or not job_id or not token:
+        return False
+    return hmac.compare_digest(job_token(job_id), token)
+
+
+def callback_url(base, job_id):
+    """Webhook URL for one job: `base` (or FAL_WEBHOOK_URL) with the job id and
+    its token as path segments, which stay out of logged query strings"""
+    return f"{(WEBHOOK_URL or base).rstrip('/')}/{job_id}/{job_token(job_id)}"
+
+
+def requested(query):
+    """Webhook mode for this request: ?webhook=1, or FAL_WEBHOOKS unless ?webhook=0.
+    FAL_WEBHOOKS only applies where the job store is shared, since the
+    webhook lands on /api/fal-webhook and polls on /api/jobs."""
+    value = query.get('webhook', [''])[0]
+    if value:
+        return value in ('1', 'true')
+    return WEBHOOKS_DEFAULT and store_error() is None
+
+
+def submit_job(model, arguments, base_url, cache_key=None, label='fal call'):
+    """Queue one model call with a webhook back to `base_url` and store a job
+    for it; nothing waits for the model"""
+    job_id = new_job_id()
+    url = callback_url(base_url, job_id)
+    handle = scheduler.call(lambda: fal.submit(model, arguments, webhook_url=url), label=label)
+    pair = {"status": "queued", "request_id": handle.request_id}
+    if cache_key:
+        # Filled in once the webhook brings the result
+        pair["cache_key"] = cache_key
+    return new_job(model, [pair], job_id=job_id, webhook=True)
+
+
+def accepted(job):
+    """202 response body for a job handed to fal"""
+    return {
+        "success": True,
+        "job_id": job["id"],
+        "request_id": job["pairs"][0].get("request_id") if len(job["pairs"]) == 1 else None,
+        "status": job["status"],
+        "status_url": f"/api/jobs/{job['id']}",
+    }
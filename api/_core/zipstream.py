@@ -0,0 +1,79 @@
+"""
+Streaming ZIP writer - entries are written to the response as they are
+added and only the central directory is kept until the end, so an archive
+of any size goes out with one entry's worth of memory. Entries are stored,
+not deflated: images and videos are already compressed.
+"""
+
+import struct
+import time
+import zlib
+
+ZIP64_LIMIT = 0xFFFFFFFF
+# UTF-8 names
+FLAGS = 0x0800
+
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    date = ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    clock = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return clock, date
+
+
+class ZipStream:
+    """Write a ZIP archive through `write(bytes)` without seeking.
+
+    Each entry's size and CRC are known when it is added, so they go in the
+    local header and no data descriptors are needed. Offsets past 4GB get
+    ZIP64 records in the central directory.
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self.offset = 0
+        self.entries = []
+
+    def write(self, data):
+        self._write(data)
+        self.offset += len(data)
+
+    def add(self, name, data, mtime=None):
+        if len(data) >= ZIP64_LIMIT:
+            raise ValueError(f"{name} is too large for a stored ZIP entry")
+        name = name.encode('utf-8')
+        crc = zlib.crc32(data)
+        clock, date = dos_datetime(mtime or time.time())
+        entry = {"name": name, "crc": crc, "size": len(data), "offset": self.offset, "time": clock, "date": date}
+
+        self.write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, FLAGS, 0, clock, date, crc, len(data), len(data), len(name), 0
+        ) + name)
+        self.write(data)
+        self.entries.append(entry)
+
+    def close(self):
+        """Write the central directory"""
+        start = self.offset
+        for entry in self.entries:
+            extra = b''
+            offset = entry["offset"]
+            version = 20
+            if offset >= ZIP64_LIMIT:
+                extra = struct.pack('<HHQ', 0x0001, 8, offset)
+                offset = ZIP64_LIMIT
+                version = 45
+            self.write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, FLAGS, 0, entry["time"], entry["date"],
+                entry["crc"], entry["size"], entry["size"], len(entry["name"]), len(extra), 0, 0, 0, 0, offset
+            ) + entry["name"] + extra)
+
+        size = self.offset - start
+        count = len(self.entries)
+        if count >= 0xFFFF or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            end64 = self.offset
+            self.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, size, start))
+            self.write(struct.pack('<IIQI', 0x07064b50, 0, end64, 1))
+            self.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_LIMIT, ZIP64_LIMIT, 0))
+        else:
+            self.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, start, 0))
@@ -1,184 +1,797 @@
 """
-SeedDream Batch Endpoint - Process multiple poses x outfits
+SeedDream Batch Endpoint - Process multiple poses x outfits, optionally
+swept across several prompts, seeds and variants per pair
 """
 
 import os
-import json
-import tempfile
-import base64
+import re
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime
-from http.server import BaseHTTPRequestHandler
+from functools import partial
+from itertools import chain
 from pathlib import Path
+from urllib.parse import urlparse
 
-try:
-    import fal_client
-except ImportError:
-    fal_client = None
+from api._core import fal, scheduler, webhooks
+from api._core.arguments import EDIT_MODEL
+from api._core.checkpoints import batch_id_for, checkpoint, completed_pairs, get_batch, pair_key, save_batch
+from api._core.drafts import DRAFT_SIZE, FINAL_SIZE, get_draft, image_size, is_true, pair_id, pin_seed, save_draft, size_tag
+from api._core.http import BaseHandler
+from api._core.jobs import expand_variants, new_job, new_job_id, store_error
+from api._core.metrics import QueueTracker
+from api._core.multipart import form_fields
+from api._core.results import result_key, cached_result, remember_result
+from api._core.shards import WORKER_URL, run_shards
+from api._core.singleflight import coalesce, fingerprint
+from api._core.webhooks import callback_url
+from api._core.stream_json import StreamingJSONReader, MemoryBudget, BodyParseError, PayloadTooLarge
+from api._core.uploads import upload_base64, upload_decoded, upload_summary
 
-FAL_API_KEY = os.getenv("FAL_API_KEY")
+MODEL_ID = EDIT_MODEL
+DEFAULT_PROMPT = 'Apply the outfit/clothing from Figure 2 onto the person in Figure 1. Keep the exact pose, face, and background from Figure 1. Only change the clothing to match Figure 2.'
 
-if FAL_API_KEY:
-    os.environ["FAL_KEY"] = FAL_API_KEY
+# Upper bound on in-flight fal requests per batch; callers may ask for less
+MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+# Ceiling on decoded image bytes held at once while reading the request body
+MAX_BUFFERED_BYTES = int(os.getenv("BATCH_MAX_BUFFERED_BYTES", str(256 * 1024 * 1024)))
+# Most images Seedream returns from one call; variants up to this come from
+# a single num_images request per pair
+MAX_VARIANTS = int(os.getenv("BATCH_MAX_VARIANTS", "6"))
 
 
-class handler(BaseHTTPRequestHandler):
-    def send_json(self, data, status=200):
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+class BatchError(ValueError):
+    """A batch request that can't run as given"""
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.code = code
+
+
+def is_image_path(path):
+    """poses[i].data / outfits[i].data are decoded while the body is read"""
+    return len(path) == 3 and path[0] in ('poses', 'outfits') and path[2] == 'data'
+
+
+def read_body(rfile, content_length, pool, budget):
+    """Parse the JSON body incrementally, uploading each embedded image as
+    soon as it has been decoded. Image entries come back as upload futures."""
+
+    def on_image(img_bytes, size):
+        return pool.submit(upload_decoded, img_bytes, size, budget)
+
+    return StreamingJSONReader(rfile, content_length, is_image_path, on_image, budget).parse()
+
+
+def resolve_image(item, default_name):
+    """Turn a pose/outfit entry into {"url", "name"}, uploading base64 data"""
+    if isinstance(item, str) and item.startswith('http'):
+        return {"url": item, "name": default_name}
+    if not isinstance(item, dict):
+        return None
+
+    name = item.get('name', default_name)
+    img_data = item.get('data', '')
+
+    if isinstance(img_data, Future):
+        # Already being uploaded by read_body
+        url, cached, report = img_data.result()
+        return {"url": url, "name": name, "cached": cached, "report": report}
+
+    if img_data.startswith('http'):
+        return {"url": img_data, "name": name}
+
+    # Base64 data
+    report = {}
+    url, cached = upload_base64(img_data, parallel=True, report=report)
+    return {"url": url, "name": name, "cached": cached, "report": report}
+
+
+def build_arguments(pose_data, outfit_data, prompt, seed, size=FINAL_SIZE, num_images=1):
+    arguments = {
+        "prompt": prompt,
+        "image_urls": [pose_data["url"], outfit_data["url"]],
+        "num_images": num_images,
+        "image_size": size,
+        "enable_safety_checker": False,
+    }
+
+    if seed is not None:
+        arguments["seed"] = int(seed)
+
+    return arguments
+
+
+def sweep_axes(data):
+    """(prompts, seeds, variants) a batch is rendered across - "prompts" or
+    the single "prompt", "seeds" or the single "seed", and "variants" images
+    per pair; raises ValueError"""
+    prompts = data.get('prompts')
+    if not prompts:
+        prompts = [data.get('prompt', DEFAULT_PROMPT)]
+    elif not isinstance(prompts, list) or not all(isinstance(p, str) and p.strip() for p in prompts):
+        raise ValueError("prompts must be a list of non-empty strings")
+
+    seeds = data.get('seeds')
+    if not seeds:
+        seeds = [data.get('seed')]
+    try:
+        # A null seed (what an unseeded batch passes on to its shards) lets fal pick
+        seeds = [None if s in (None, '') else int(s) for s in (seeds if isinstance(seeds, list) else [seeds])]
+    except (TypeError, ValueError):
+        raise ValueError("seeds must be a list of integers")
+
+    try:
+        variants = int(data.get('variants') or 1)
+    except (TypeError, ValueError):
+        raise ValueError("variants must be an integer")
+    if not 1 <= variants <= MAX_VARIANTS:
+        raise ValueError(f"variants must be between 1 and {MAX_VARIANTS}; sweep seeds for more")
+    return prompts, seeds, variants
+
+
+def cell_of(result):
+    """The (pose, outfit, prompt, seed) indexes of a pair's result"""
+    return (result.get("pose_index"), result.get("outfit_index"),
+            result.get("prompt_index", 0), result.get("seed_index", 0))
+
+
+def pair_fields(p_idx, pose_data, o_idx, outfit_data, timestamp, size=FINAL_SIZE, prompt_index=None, seed=None,
+                seed_index=None, variant=None):
+    """The identifying fields of a pair's result. The sweep fields (and their
+    filename parts) are only there for the axes a batch actually sweeps."""
+    pose_name = Path(pose_data["name"]).stem
+    outfit_name = Path(outfit_data["name"]).stem
+    fields = {
+        "pose_index": p_idx,
+        "outfit_index": o_idx,
+        "pose_name": pose_name,
+        "outfit_name": outfit_name,
+    }
+    name = f"seedream_{timestamp}_p{p_idx + 1}_{pose_name}_o{o_idx + 1}_{outfit_name}"
+    if prompt_index is not None:
+        fields["prompt_index"] = prompt_index
+        name += f"_prompt{prompt_index + 1}"
+    if seed_index is not None:
+        fields["seed_index"] = seed_index
+        fields["seed"] = seed
+        name += f"_seed{seed}"
+    if variant is not None:
+        fields["variant_index"] = variant
+        name += f"_v{variant + 1}"
+    fields["filename"] = f"{name}{size_tag(size)}.png"
+    return fields
+
+
+class Matrix:
+    """The pairs a batch renders - pose x outfit x prompt x seed, each one fal
+    call for all of its variants - with their arguments and result fields"""
+
+    def __init__(self, poses, outfits, prompts, seeds, variants, timestamp, size):
+        self.poses = poses
+        self.outfits = outfits
+        self.prompts = prompts
+        self.seeds = seeds
+        self.variants = variants
+        self.timestamp = timestamp
+        self.size = size
+
+    def cells(self):
+        """Every pair, pose-major"""
+        return [(p_idx, o_idx, t_idx, s_idx)
+                for p_idx in range(len(self.poses)) for o_idx in range(len(self.outfits))
+                for t_idx in range(len(self.prompts)) for s_idx in range(len(self.seeds))]
+
+    def contains(self, cell):
+        return all(0 <= i < n for i, n in zip(cell, (len(self.poses), len(self.outfits), len(self.prompts), len(self.seeds))))
+
+    def arguments(self, cell):
+        p_idx, o_idx, t_idx, s_idx = cell
+        return build_arguments(self.poses[p_idx], self.outfits[o_idx], self.prompts[t_idx], self.seeds[s_idx],
+                               self.size, self.variants)
+
+    def key(self, cell):
+        """Checkpoint key of a pair"""
+        return pair_key(pair_id(MODEL_ID, self.arguments(cell)), self.size)
+
+    def fields(self, cell, variant=None):
+        p_idx, o_idx, t_idx, s_idx = cell
+        sweep = {}
+        if len(self.prompts) > 1:
+            sweep["prompt_index"] = t_idx
+        if len(self.seeds) > 1:
+            sweep.update(seed_index=s_idx, seed=self.seeds[s_idx])
+        return pair_fields(p_idx, self.poses[p_idx], o_idx, self.outfits[o_idx], self.timestamp, self.size,
+                           variant=variant, **sweep)
+
+    def pair(self, cell):
+        """Fields of a pair's result, with the fields of each of its images
+        under "variants" when it asks for more than one"""
+        fields = self.fields(cell)
+        if self.variants > 1:
+            fields["variants"] = [
+                {"variant_index": k, "filename": self.fields(cell, k)["filename"]} for k in range(self.variants)
+            ]
+        return fields
+
+    def label(self, cell):
+        p_idx, o_idx, t_idx, s_idx = cell
+        label = f'batch p{p_idx + 1} o{o_idx + 1}'
+        if len(self.prompts) > 1:
+            label += f' prompt{t_idx + 1}'
+        if len(self.seeds) > 1:
+            label += f' seed{self.seeds[s_idx]}'
+        return label
+
+
+def stored_matrix(stored, timestamp=None, size=None):
+    """Matrix of a stored draft or batch (drafts from before sweeps kept a
+    single prompt and seed)"""
+    return Matrix(stored["poses"], stored["outfits"], stored.get("prompts") or [stored["prompt"]],
+                  stored.get("seeds") or [stored["seed"]], stored.get("variants", 1),
+                  timestamp or stored["timestamp"], size or stored["image_size"])
+
+
+def stored_keys(batch):
+    """{cell: checkpoint key} of a stored batch (pairs of batches from
+    before sweeps were [pose_index, outfit_index, key])"""
+    return {tuple(pair[:-1]) + (0, 0)[:5 - len(pair)]: pair[-1] for pair in batch["pairs"]}
+
+
+def image_fields(images, variants):
+    """image_url plus, for a pair with variants, every image it returned"""
+    fields = {"image_url": images[0].get("url", "")}
+    if variants > 1:
+        fields["images"] = images
+    return fields
+
+
+def run_pair(cell, arguments, fields, label, deadline=None, trackers=None):
+    """Run one pair through fal's queue and build its result from `fields`.
+    The pair's QueueTracker is stored in `trackers[cell]` when a dict is given."""
+    cache_key = result_key(MODEL_ID, arguments)
+    result = cached_result(cache_key)
+    cached = result is not None
+    report = {}
+    tracker = QueueTracker(MODEL_ID)
+    if trackers is not None:
+        trackers[cell] = tracker
+
+    def run():
+        # Transient 429/5xx are retried with backoff until the batch deadline
+        return scheduler.subscribe(MODEL_ID, arguments, deadline=deadline, label=label, report=report,
+                                   on_queue_update=tracker)
+
+    try:
+        if not cached:
+            # Identical pairs (in this batch or another one) share one fal request
+            result, _ = coalesce('batch', fingerprint(MODEL_ID, arguments), run)
+            remember_result(cache_key, result)
+    except Exception as e:
+        return {
+            **fields,
+            "pair_id": pair_id(MODEL_ID, arguments),
+            "status": "failed",
+            "error": str(e),
+            **report
+        }
+
+    images = result.get("images", [])
+    if not images:
+        return {
+            **fields,
+            "pair_id": pair_id(MODEL_ID, arguments),
+            "status": "failed",
+            "error": "No image returned"
+        }
+
+    return {
+        **fields,
+        "pair_id": pair_id(MODEL_ID, arguments),
+        "status": "completed",
+        **image_fields(images, arguments["num_images"]),
+        "cached": cached,
+        **report
+    }
+
+
+def draft_pairs(matrix, pair_ids):
+    """The cells of `pair_ids` in a stored draft's matrix; raises ValueError
+    for ids the draft didn't render"""
+    if not isinstance(pair_ids, list) or not pair_ids:
+        raise ValueError("Finalizing needs a list of pair_ids from the draft")
+    index = {}
+    for cell in matrix.cells():
+        index.setdefault(pair_id(MODEL_ID, matrix.arguments(cell)), cell)
+    unknown = [str(pid) for pid in pair_ids if pid not in index]
+    if unknown:
+        raise ValueError(f"Not pairs of this draft: {', '.join(unknown)}")
+    return [index[pid] for pid in dict.fromkeys(pair_ids)]
+
+
+def submit_pair(cell, arguments, fields, label, deadline=None, webhook_url=None):
+    """Queue one pair on fal without waiting for it; fal's webhook (if
+    `webhook_url` is given) or the job poller collects it"""
+    pair = dict(fields)
+    pair["pair_id"] = pair_id(MODEL_ID, arguments)
+    cache_key = result_key(MODEL_ID, arguments)
+    result = cached_result(cache_key)
+    if result is not None:
+        pair["status"] = "completed"
+        pair.update(image_fields(result["images"], arguments["num_images"]))
+        pair["cached"] = True
+        return pair
+
+    def submit():
+        return scheduler.call(lambda: fal.submit(MODEL_ID, arguments, webhook_url=webhook_url),
+                              deadline=deadline, label=label)
+
+    try:
+        # Webhooks go to one job, so only pairs of the same job share a request
+        handle, _ = coalesce('batch-submit', fingerprint(MODEL_ID, arguments, webhook_url), submit)
+        pair["status"] = "queued"
+        pair["request_id"] = handle.request_id
+        if cache_key:
+            # The job poller fills the cache once the result is in
+            pair["cache_key"] = cache_key
+    except Exception as e:
+        pair["status"] = "failed"
+        pair["error"] = str(e)
+
+    return pair
+
+
+def save_checkpoint(batch_id, key, result):
+    try:
+        checkpoint(batch_id, key, result)
+    except Exception as e:
+        # A lost checkpoint only means the pair runs again on a retry
+        print(f"Batch {batch_id}: checkpoint of {key} failed: {e}")
 
-    def do_POST(self):
-        if not FAL_API_KEY:
-            return self.send_json({"error": "FAL_API_KEY not configured"}, 500)
 
-        if not fal_client:
-            return self.send_json({"error": "fal_client not installed"}, 500)
+def checkpointed(work, batch_id, key, *args):
+    """work(*args), with the pair's result checkpointed the moment it's in"""
+    result = work(*args)
+    save_checkpoint(batch_id, key, result)
+    return result
 
+
+def add_pair_timings(timer, trackers):
+    """Longest queue wait and inference across the pairs, as request stages"""
+    queued = [t.queue_seconds for t in trackers.values() if t.queue_seconds is not None]
+    inferred = [t.inference_seconds for t in trackers.values() if t.inference_seconds is not None]
+    if queued:
+        timer.add('queue', max(queued), f"max of {len(queued)} pairs")
+    if inferred:
+        timer.add('inference', max(inferred), f"max of {len(inferred)} pairs")
+
+
+def summary_counts(results):
+    return {
+        "total": len(results),
+        "completed": len([r for r in results if r.get("status") == "completed"]),
+        "cached": len([r for r in results if r.get("cached")]),
+        "retries": sum(r.get("retries", 0) for r in results),
+    }
+
+
+def finalize_matrix(draft_id, size, pair_ids):
+    """The matrix of a stored draft, rendered at `size`, and the cells of
+    the pairs picked from it"""
+    stored = get_draft(str(draft_id))
+    if stored is None:
+        raise BatchError("Draft not found", 404)
+    # Finals keep the draft's filenames, minus the size tag
+    matrix = stored_matrix(stored, size=size)
+    try:
+        return matrix, draft_pairs(matrix, pair_ids)
+    except ValueError as e:
+        raise BatchError(str(e))
+
+
+def worker_cells(matrix, pairs):
+    """The cells a shard worker runs, by full-matrix index ([pose_index,
+    outfit_index] for batches without sweeps)"""
+    try:
+        cells = [tuple(int(i) for i in pair) + (0, 0)[:4 - len(pair)] for pair in pairs]
+    except (TypeError, ValueError):
+        raise BatchError("pairs must be [pose_index, outfit_index, ...] lists")
+    if not all(len(cell) == 4 and matrix.contains(cell) for cell in cells):
+        raise BatchError("pairs index outside poses/outfits/prompts/seeds")
+    return cells
+
+
+def draft_links(matrix, draft_id):
+    """Fields tying a draft and its finals together"""
+    linked = {"draft_id": draft_id, "image_size": matrix.size}
+    if len(matrix.seeds) > 1:
+        linked["seeds"] = matrix.seeds
+    else:
+        linked["seed"] = matrix.seeds[0]
+    return linked
+
+
+def resume_pairs(batch_id, idempotency_key, matrix, cells, retried=None):
+    """Check a batch in with checkpoints: a new batch is saved, a retried or
+    resubmitted one gets back the pairs that already completed.
+
+    Returns ({cell: checkpoint key}, {cell: resumed pair})."""
+    if retried is not None:
+        keys = stored_keys(retried)
+    else:
+        keys = {cell: matrix.key(cell) for cell in cells}
+        save_batch(batch_id, idempotency_key, matrix.poses, matrix.outfits,
+                   [cell + (keys[cell],) for cell in cells], matrix.prompts, matrix.seeds, matrix.variants,
+                   matrix.timestamp, matrix.size)
+
+    resumed = {}
+    if retried is not None or idempotency_key:
+        done = completed_pairs(batch_id, keys.values())
+        for cell in cells:
+            saved = done.get(keys[cell])
+            if saved is not None:
+                # Stands in for the pair of this attempt
+                resumed[cell] = {**saved, **matrix.pair(cell), "resumed": True}
+        print(f"Batch {batch_id}: {len(resumed)} pairs resumed from checkpoints, {len(cells) - len(resumed)} to run")
+    return keys, resumed
+
+
+def start_pairs(pool, work, matrix, cells, deadline, batch_id=None, keys=None):
+    """Fan out every pair on `pool`, in order; with a `batch_id`, each
+    result is checkpointed under its key the moment it's in"""
+
+    def start(cell):
+        args = (cell, matrix.arguments(cell), matrix.pair(cell), matrix.label(cell), deadline)
+        if batch_id is not None:
+            return pool.submit(checkpointed, work, batch_id, keys[cell], *args)
+        return pool.submit(work, *args)
+
+    return [start(cell) for cell in cells]
+
+
+class handler(BaseHandler):
+    def with_timings(self, result, trackers):
+        """The pair result, plus its queue/inference timings on ?timings=1"""
+        tracker = trackers.get(cell_of(result))
+        if not self.want_timings or tracker is None or not tracker.as_dict():
+            return result
+        return {**result, "timings": tracker.as_dict()}
+
+    def stream_results(self, fmt, pair_futures, total, uploads, trackers, linked, resumed=()):
+        """Write one event per image as soon as its pair finishes, then a
+        summary. Pairs resumed from checkpoints come first."""
+        self.start_stream(fmt)
+        completed = 0
+        cached = 0
+        retries = 0
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body.decode())
+            finished = (future.result() for future in as_completed(pair_futures))
+            for pair in chain(resumed, finished):
+                retries += pair.get("retries", 0)
+                for result in expand_variants(pair):
+                    if result.get("status") == "completed":
+                        completed += 1
+                    if result.get("cached"):
+                        cached += 1
+                    self.send_event(fmt, 'result', self.with_timings(result, trackers))
+
+            summary = {
+                "success": True,
+                "total": total,
+                "completed": completed,
+                "cached": cached,
+                "retries": retries,
+                "uploads": uploads,
+                "scheduler": scheduler.get_scheduler().snapshot(),
+                **linked
+            }
+            if self.want_timings:
+                # Headers went out before the pairs ran, so timings come last
+                add_pair_timings(self.timer, trackers)
+                summary["timings"] = self.timer.as_dict()
+            self.send_event(fmt, 'summary', summary)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away - don't start pairs nobody will see
+            for future in pair_futures:
+                future.cancel()
+
+    def worker_url(self):
+        """Where shards go: BATCH_WORKER_URL, else this endpoint on the
+        host the coordinator request came in on"""
+        return WORKER_URL or self.public_url(urlparse(self.path).path)
+
+    def send_sharded(self, matrix, cells, max_concurrency, deadline, uploads, linked, batch_id, keys, resumed):
+        """Coordinator: run `cells` as shards on worker invocations and
+        answer with the merged results, plus the `resumed` ones.
+
+        Workers may not share this instance's store, so the coordinator
+        checkpoints each shard's pairs once the shard is back."""
+        # Identical pose/outfit inputs only need rendering once per prompt and seed
+        groups = {}
+        for cell in cells:
+            p_idx, o_idx, t_idx, s_idx = cell
+            groups.setdefault((matrix.poses[p_idx]["url"], matrix.outfits[o_idx]["url"], t_idx, s_idx), []).append(cell)
+        unique = [group[0] for group in groups.values()]
+
+        def payload(cells):
+            return {
+                "poses": [{"name": p["name"], "data": p["url"]} for p in matrix.poses],
+                "outfits": [{"name": o["name"], "data": o["url"]} for o in matrix.outfits],
+                "prompts": matrix.prompts,
+                "seeds": matrix.seeds,
+                "variants": matrix.variants,
+                "image_size": matrix.size,
+                "max_concurrency": max_concurrency,
+                "timestamp": matrix.timestamp,
+                "pairs": [list(cell) for cell in cells]
+            }
+
+        with self.timer.stage('fal'):
+            done, errors, report = run_shards(self.worker_url(), unique, payload, max_concurrency, deadline, key=cell_of)
+
+        pairs = list(resumed.values())
+        for group in groups.values():
+            first = group[0]
+            for cell in group:
+                fields = matrix.pair(cell)
+                if first in done:
+                    pairs.append({**done[first], **fields})
+                else:
+                    pairs.append({**fields, "status": "failed", "error": errors.get(first, "No result")})
+                save_checkpoint(batch_id, keys[cell], pairs[-1])
+        pairs.sort(key=cell_of)
+
+        report["deduplicated"] = len(cells) - len(unique)
+        results = [result for pair in pairs for result in expand_variants(pair)]
+        response = {
+            "success": True,
+            **summary_counts(results),
+            "results": results,
+            "uploads": uploads,
+            "shards": report,
+            **linked
+        }
+        missing = [cell for cell in unique if cell not in done]
+        if not missing:
+            return self.send_json(response)
+
+        # Pairs no shard answered for failed with their shard, not in fal
+        error = errors.get(missing[0], "No result")
+        response.update(success=False, partial=bool(done), error=f"{len(missing)} of {len(unique)} pairs got no shard result: {error}")
+        return self.send_json(response, 200 if done else 502)
+
+    def read_batch(self, upload_pool):
+        """The request fields, with pose and outfit images already uploading"""
+        # Images start uploading while the rest of the body is still being read
+        budget = MemoryBudget(MAX_BUFFERED_BYTES)
+        if self.is_form:
+            # multipart/form-data: "poses" / "outfits" file parts or URL fields
+            def on_file(img_bytes, size, filename):
+                return {"name": filename, "data": upload_pool.submit(upload_decoded, img_bytes, size, budget)}
+
+            return form_fields(self.read_form(on_file, budget=budget), lists=('poses', 'outfits', 'prompts', 'seeds'))
+
+        content_length = int(self.headers.get('Content-Length', 0))
+        with self.timer.stage('read'):
+            return read_body(self.rfile, content_length, upload_pool, budget)
+
+    def upload_matrix(self, data, upload_pool, prompts, seeds, variants, size, draft):
+        """The matrix of a new batch and its upload summary, once every pose
+        and outfit has a URL"""
+        poses_input = data.get('poses', [])
+        outfits_input = data.get('outfits', [])
+        if not poses_input or not outfits_input:
+            raise BatchError("Need both poses and outfits")
+
+        # Upload poses and outfits side by side - convert to URLs if base64
+        pose_futures = [upload_pool.submit(resolve_image, pose, f'pose_{idx+1}') for idx, pose in enumerate(poses_input)]
+        outfit_futures = [upload_pool.submit(resolve_image, outfit, f'outfit_{idx+1}') for idx, outfit in enumerate(outfits_input)]
+        with self.timer.stage('upload'):
+            pose_urls = [p for p in (f.result() for f in pose_futures) if p]
+            outfit_urls = [o for o in (f.result() for f in outfit_futures) if o]
+        uploaded = [i for i in pose_urls + outfit_urls if "cached" in i]
+        uploads = upload_summary([i["cached"] for i in uploaded], [dict(i["report"], name=i["name"]) for i in uploaded if i["report"]])
+        if draft:
+            # Finals have to come out of the same seeds
+            seeds = [pin_seed(seed) for seed in seeds]
+        return Matrix(pose_urls, outfit_urls, prompts, seeds, variants, data.get('timestamp'), size), uploads
+
+    def send_queued(self, matrix, cells, webhook, max_concurrency, deadline, uploads, linked):
+        """?async=1: queue every pair on fal and answer with the job that
+        collects them - from fal's webhooks with ?webhook=1"""
+        job_id = new_job_id()
+        work = submit_pair
+        if webhook:
+            work = partial(submit_pair, webhook_url=callback_url(self.public_url('/api/fal-webhook'), job_id))
+
+        with self.timer.stage('fal'), ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            pairs = [future.result() for future in start_pairs(pool, work, matrix, cells, deadline)]
+
+        job = new_job(MODEL_ID, pairs, job_id=job_id, total=len(cells) * matrix.variants, uploads=uploads, webhook=webhook)
+        return self.send_json({
+            "success": True,
+            "job_id": job["id"],
+            "status": job["status"],
+            "status_url": f"/api/jobs/{job['id']}",
+            "total": job["total"],
+            "uploads": uploads,
+            **linked
+        }, 202)
+
+    def send_pairs(self, matrix, cells, resumed, stream, max_concurrency, deadline, uploads, linked,
+                   batch_id=None, keys=None):
+        """Run the pairs of `cells` that weren't `resumed` and answer with
+        every one's results, streamed as they finish with ?stream. Pairs
+        are checkpointed when a `batch_id` is given; shard workers leave
+        that to their coordinator and answer per pair."""
+        # Queue position and inference time seen for each pair
+        trackers = {}
+        todo = [cell for cell in cells if cell not in resumed]
+        total = len(cells) * matrix.variants
+
+        with self.timer.stage('fal'), ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            pair_futures = start_pairs(pool, partial(run_pair, trackers=trackers), matrix, todo, deadline, batch_id, keys)
+
+            if stream:
+                return self.stream_results(stream, pair_futures, total, uploads, trackers, linked,
+                                           [resumed[cell] for cell in cells if cell in resumed])
+
+            finished = dict(zip(todo, (f.result() for f in pair_futures)))
+            pairs = [resumed.get(cell) or finished[cell] for cell in cells]
+
+        add_pair_timings(self.timer, trackers)
+
+        # Shard workers answer per pair; the coordinator expands
+        results = pairs if batch_id is None else [result for pair in pairs for result in expand_variants(pair)]
+        return self.send_json({
+            "success": True,
+            **summary_counts(results),
+            "total": total,
+            "results": [self.with_timings(r, trackers) for r in results],
+            "uploads": uploads,
+            "scheduler": scheduler.get_scheduler().snapshot(),
+            **linked
+        })
+
+    def do_POST(self):
+        error = fal.config_error()
+        if error:
+            return self.send_json({"error": error}, 500)
+
+        try:
+            # Retries of transient fal errors stop once this passes
+            deadline = scheduler.deadline_after()
 
             # Expected format:
             # {
             #   "poses": [{"name": "pose1.png", "data": "base64..."}, ...] or ["url1", "url2"]
             #   "outfits": [{"name": "outfit1.png", "data": "base64..."}, ...] or ["url1", "url2"]
             #   "prompt": "optional custom prompt",
-            #   "seed": optional_seed
+            #   "seed": optional_seed (with RESULT_CACHE=1, pairs already rendered
+            #           with this seed and inputs come back "cached": true),
+            #   "prompts": optional list of prompts to render every pair with,
+            #   "seeds": optional list of seeds to render every pair with,
+            #   "variants": optional number of images per pair (one fal call
+            #               each, up to BATCH_MAX_VARIANTS),
+            #   "max_concurrency": optional cap on parallel fal requests (per worker
+            #                      when sharded),
+            #   "image_size": optional output size (default auto_4K),
+            #   "draft": true to explore the matrix at auto_2K with a pinned seed,
+            #   "idempotency_key": optional (or an Idempotency-Key header)
             # }
+            # or the same fields as multipart/form-data, with each pose and
+            # outfit image sent as a repeated "poses" / "outfits" file part.
+            #
+            # "results" holds one entry per image, pose-major, then by prompt,
+            # seed and variant; the swept axes add prompt_index, seed_index /
+            # seed and variant_index fields and filename parts.
+            #
+            # A draft answers with a "draft_id" and a "pair_id" on every result.
+            # {"draft_id": ..., "pair_ids": [...]} then re-renders just those
+            # pairs at full size with the draft's inputs, prompt and seed; the
+            # finals carry the same pair ids.
+            #
+            # Each pair's result is checkpointed as soon as it finishes, under the
+            # "batch_id" the response carries. Resubmitting with the same
+            # idempotency key, or {"batch_id": ..., "retry_failed": true}, runs
+            # only the pairs without a completed result; the rest come back from
+            # their checkpoints with "resumed": true.
+            #
+            # With ?async=1 every pair is only queued on fal and a job id is
+            # returned right away; progress comes from GET /api/jobs/<id>, which
+            # fal's webhooks keep up to date with ?webhook=1.
+            # With ?stream=ndjson|sse (or a matching Accept header) each image is
+            # written out as its pair finishes, followed by a summary event.
+            # ?timings=1 adds per-stage timings to the response and to each pair.
+            #
+            # With ?shard=1 this invocation only coordinates: the matrix is split
+            # into shards that each run on their own invocation of this endpoint,
+            # called with "pairs": [[pose_index, outfit_index, prompt_index,
+            # seed_index], ...] (and the coordinator's "timestamp"), and the
+            # shard results are merged.
+            query = self.query
+            run_async = query.get('async', [''])[0] in ('1', 'true')
+            # ?webhook=1 (or ?async=1 with FAL_WEBHOOKS on) queues the pairs
+            # with a webhook, so results arrive without anyone polling fal
+            webhook = query.get('webhook', [''])[0] in ('1', 'true') or (run_async and webhooks.requested(query))
+            run_async = run_async or webhook
+            if run_async and store_error():
+                return self.send_json({"error": store_error()}, 501)
+            stream = None if run_async else self.stream_format(query)
+            sharded = not run_async and query.get('shard', [''])[0] in ('1', 'true')
 
-            poses_input = data.get('poses', [])
-            outfits_input = data.get('outfits', [])
-            prompt = data.get('prompt', 'Apply the outfit/clothing from Figure 2 onto the person in Figure 1. Keep the exact pose, face, and background from Figure 1. Only change the clothing to match Figure 2.')
-            seed = data.get('seed')
-
-            if not poses_input or not outfits_input:
-                return self.send_json({"error": "Need both poses and outfits"}, 400)
-
-            results = []
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-            # Process poses - convert to URLs if base64
-            pose_urls = []
-            for idx, pose in enumerate(poses_input):
-                if isinstance(pose, str) and pose.startswith('http'):
-                    pose_urls.append({"url": pose, "name": f"pose_{idx+1}"})
-                elif isinstance(pose, dict):
-                    name = pose.get('name', f'pose_{idx+1}')
-                    img_data = pose.get('data', '')
-
-                    if img_data.startswith('http'):
-                        pose_urls.append({"url": img_data, "name": name})
-                    else:
-                        # Base64 data
-                        if ',' in img_data:
-                            img_data = img_data.split(',')[1]
-
-                        img_bytes = base64.b64decode(img_data)
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
-                            tmp.write(img_bytes)
-                            tmp_path = tmp.name
-
-                        try:
-                            url = fal_client.upload_file(tmp_path)
-                            pose_urls.append({"url": url, "name": name})
-                        finally:
-                            os.unlink(tmp_path)
-
-            # Process outfits - convert to URLs if base64
-            outfit_urls = []
-            for idx, outfit in enumerate(outfits_input):
-                if isinstance(outfit, str) and outfit.startswith('http'):
-                    outfit_urls.append({"url": outfit, "name": f"outfit_{idx+1}"})
-                elif isinstance(outfit, dict):
-                    name = outfit.get('name', f'outfit_{idx+1}')
-                    img_data = outfit.get('data', '')
-
-                    if img_data.startswith('http'):
-                        outfit_urls.append({"url": img_data, "name": name})
-                    else:
-                        # Base64 data
-                        if ',' in img_data:
-                            img_data = img_data.split(',')[1]
-
-                        img_bytes = base64.b64decode(img_data)
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
-                            tmp.write(img_bytes)
-                            tmp_path = tmp.name
-
-                        try:
-                            url = fal_client.upload_file(tmp_path)
-                            outfit_urls.append({"url": url, "name": name})
-                        finally:
-                            os.unlink(tmp_path)
-
-            # Process each combination
-            for p_idx, pose_data in enumerate(pose_urls):
-                for o_idx, outfit_data in enumerate(outfit_urls):
-                    arguments = {
-                        "prompt": prompt,
-                        "image_urls": [pose_data["url"], outfit_data["url"]],
-                        "num_images": 1,
-                        "image_size": "auto_4K",
-                        "enable_safety_checker": False,
-                    }
-
-                    if seed:
-                        arguments["seed"] = int(seed)
-
-                    try:
-                        result = fal_client.subscribe(
-                            "fal-ai/bytedance/seedream/v4.5/edit",
-                            arguments=arguments,
-                            with_logs=True
-                        )
-
-                        images = result.get("images", [])
-                        if images:
-                            pose_name = Path(pose_data["name"]).stem
-                            outfit_name = Path(outfit_data["name"]).stem
-                            results.append({
-                                "pose_index": p_idx,
-                                "outfit_index": o_idx,
-                                "pose_name": pose_name,
-                                "outfit_name": outfit_name,
-                                "status": "completed",
-                                "image_url": images[0].get("url", ""),
-                                "filename": f"seedream_{timestamp}_p{p_idx + 1}_{pose_name}_o{o_idx + 1}_{outfit_name}.png"
-                            })
-                        else:
-                            results.append({
-                                "pose_index": p_idx,
-                                "outfit_index": o_idx,
-                                "status": "failed",
-                                "error": "No image returned"
-                            })
-
-                    except Exception as e:
-                        results.append({
-                            "pose_index": p_idx,
-                            "outfit_index": o_idx,
-                            "status": "failed",
-                            "error": str(e)
-                        })
-
-            return self.send_json({
-                "success": True,
-                "total": len(poses_input) * len(outfits_input),
-                "completed": len([r for r in results if r.get("status") == "completed"]),
-                "results": results
-            })
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as upload_pool:
+                data = self.read_batch(upload_pool)
+
+                pairs = data.get('pairs')
+                max_concurrency = int(data.get('max_concurrency') or MAX_CONCURRENCY)
+                max_concurrency = max(1, min(max_concurrency, MAX_CONCURRENCY))
+                draft_id = data.get('draft_id')
+                idempotency_key = data.get('idempotency_key') or self.headers.get('Idempotency-Key')
+                retry_id = data.get('batch_id') if is_true(data.get('retry_failed')) else None
+                draft = draft_id is None and (is_true(data.get('draft')) or is_true(query.get('draft', [''])[0]))
+                try:
+                    size = image_size(data.get('image_size'), DRAFT_SIZE if draft else FINAL_SIZE)
+                    prompts, seeds, variants = sweep_axes(data)
+                except ValueError as e:
+                    return self.send_json({"error": str(e)}, 400)
+
+                retried = None
+                worker = False
+                if retry_id is not None:
+                    # Retry: the earlier batch's uploaded inputs and settings
+                    retried = get_batch(str(retry_id))
+                    if retried is None:
+                        return self.send_json({"error": "Batch not found"}, 404)
+                    matrix = stored_matrix(retried)
+                    cells = list(stored_keys(retried))
+                    uploads = upload_summary([])
+                elif draft_id is not None:
+                    # Finalize: only the chosen pairs, with the draft's inputs, prompts and seeds
+                    matrix, cells = finalize_matrix(draft_id, size, data.get('pair_ids'))
+                    uploads = upload_summary([])
+                else:
+                    matrix, uploads = self.upload_matrix(data, upload_pool, prompts, seeds, variants, size, draft)
+                    # A worker invocation runs only the pairs it was given
+                    worker = pairs is not None
+                    cells = worker_cells(matrix, pairs) if worker else matrix.cells()
+
+            batch_id = str(retry_id) if retry_id is not None else batch_id_for(idempotency_key)
+            if idempotency_key and not matrix.timestamp:
+                # A resubmission keeps the first attempt's filenames
+                matrix.timestamp = (get_batch(batch_id) or {}).get("timestamp")
+            # Shards of one batch share the coordinator's timestamp in their filenames
+            matrix.timestamp = re.sub(r'[^\w-]', '', str(matrix.timestamp or '')) or datetime.now().strftime("%Y%m%d_%H%M%S")
+
+            # Ties a draft and its finals, or the attempts at one batch, together
+            # in every kind of response
+            linked = {}
+            if draft:
+                draft_id = new_job_id()
+                save_draft(draft_id, matrix.poses, matrix.outfits, matrix.prompts, matrix.seeds, matrix.variants,
+                           matrix.timestamp, matrix.size)
+            if draft_id is not None:
+                linked = draft_links(matrix, draft_id)
+
+            if run_async:
+                # Async jobs keep their own state instead of checkpoints
+                return self.send_queued(matrix, cells, webhook, max_concurrency, deadline, uploads, linked)
+            if worker:
+                # Shard workers report back to their coordinator, which checkpoints
+                return self.send_pairs(matrix, cells, {}, stream, max_concurrency, deadline, uploads, linked)
+
+            keys, resumed = resume_pairs(batch_id, idempotency_key, matrix, cells, retried)
+            linked = {**linked, "batch_id": batch_id, "resumed": len(resumed) * matrix.variants}
+            if sharded:
+                return self.send_sharded(matrix, [cell for cell in cells if cell not in resumed], max_concurrency,
+                                         deadline, uploads, linked, batch_id, keys, resumed)
+            return self.send_pairs(matrix, cells, resumed, stream, max_concurrency, deadline, uploads, linked,
+                                   batch_id, keys)
 
-        except json.JSONDecodeError:
-            return self.send_json({"error": "Invalid JSON"}, 400)
+        except BatchError as e:
+            return self.send_json({"error": str(e)}, e.code)
+        except BodyParseError as e:
+            return self.send_json({"error": "Invalid request body", "details": str(e)}, 400)
+        except PayloadTooLarge as e:
+            return self.send_json({"error": str(e)}, 413)
         except Exception as e:
             return self.send_json({"error": str(e)}, 500)
@@ -2,87 +2,65 @@
 SeedDream Edit Endpoint - Single image editing
 """
 
-import os
 import json
-import tempfile
-import base64
-from http.server import BaseHTTPRequestHandler
-import cgi
-from io import BytesIO
 
-try:
-    import fal_client
-except ImportError:
-    fal_client = None
+from api._core import fal, scheduler, webhooks
+from api._core.arguments import EDIT_MODEL
+from api._core.drafts import DRAFT_SIZE, FINAL_SIZE, image_size, is_true, pair_id, pin_seed
+from api._core.http import BaseHandler
+from api._core.jobs import store_error
+from api._core.metrics import QueueTracker
+from api._core.multipart import form_fields
+from api._core.results import result_key, cached_result, remember_result
+from api._core.singleflight import coalesce, fingerprint
+from api._core.stream_json import BodyParseError, PayloadTooLarge
+from api._core.uploads import decode_base64, upload_bytes, upload_summary
 
-FAL_API_KEY = os.getenv("FAL_API_KEY")
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+MODEL_ID = EDIT_MODEL
 
-if FAL_API_KEY:
-    os.environ["FAL_KEY"] = FAL_API_KEY
-
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-
-def parse_multipart(handler):
-    """Parse multipart form data"""
-    content_type = handler.headers.get('Content-Type', '')
-
-    if 'multipart/form-data' not in content_type:
-        return None, None
-
-    content_length = int(handler.headers.get('Content-Length', 0))
-    body = handler.rfile.read(content_length)
-
-    # Parse the boundary
-    boundary = content_type.split('boundary=')[1] if 'boundary=' in content_type else None
-    if not boundary:
-        return None, None
-
-    environ = {
-        'REQUEST_METHOD': 'POST',
-        'CONTENT_TYPE': content_type,
-        'CONTENT_LENGTH': content_length,
-    }
-
-    fp = BytesIO(body)
-    form = cgi.FieldStorage(fp=fp, environ=environ, keep_blank_values=True)
-
-    return form, body
-
-
-class handler(BaseHTTPRequestHandler):
-    def send_json(self, data, status=200):
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
-
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
 
+class handler(BaseHandler):
     def do_POST(self):
-        if not FAL_API_KEY:
-            return self.send_json({"error": "FAL_API_KEY not configured"}, 500)
-
-        if not fal_client:
-            return self.send_json({"error": "fal_client not installed"}, 500)
+        error = fal.config_error()
+        if error:
+            return self.send_json({"error": error}, 500)
 
         try:
             content_type = self.headers.get('Content-Type', '')
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
+            cached_flags = []
+            reports = []
+
+            def upload(img_bytes, size, filename):
+                report = {}
+                with self.timer.stage('upload'):
+                    url, cached = upload_bytes(img_bytes, report=report)
+                if report:
+                    self.timer.add('normalize', report["ms"] / 1000)
+                cached_flags.append(cached)
+                reports.append(report)
+                return url
+
+            # Handle multipart/form-data or raw image bytes - each file is
+            # uploaded as soon as its part has been read
+            if self.is_form:
+                data = form_fields(self.read_form(upload, 'images'), lists=('images', 'image_urls'))
+                prompt = data.get('prompt', '')
+                image_urls = data.get('image_urls', []) + data.get('images', [])
+                # Form values are strings; the JSON path gets numbers already
+                try:
+                    num_images = int(data.get('num_images') or 1)
+                    seed = int(data['seed']) if data.get('seed') else None
+                except ValueError:
+                    return self.send_json({"error": "num_images and seed must be integers"}, 400)
+
+                if not prompt:
+                    return self.send_json({"error": "No prompt provided"}, 400)
 
             # Handle JSON requests (with base64 images or URLs)
-            if 'application/json' in content_type:
-                data = json.loads(body.decode())
+            elif 'application/json' in content_type:
+                body = self.read_body()
+                with self.timer.stage('parse'):
+                    data = json.loads(body.decode())
                 prompt = data.get('prompt', '')
                 image_urls = data.get('image_urls', [])
                 images_base64 = data.get('images', [])
@@ -96,58 +74,96 @@ class handler(BaseHTTPRequestHandler):
                 if images_base64 and not image_urls:
                     image_urls = []
                     for img_data in images_base64:
-                        # Handle data URL format
-                        if ',' in img_data:
-                            img_data = img_data.split(',')[1]
-
-                        img_bytes = base64.b64decode(img_data)
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
-                            tmp.write(img_bytes)
-                            tmp_path = tmp.name
-
-                        try:
-                            url = fal_client.upload_file(tmp_path)
-                            image_urls.append(url)
-                        finally:
-                            os.unlink(tmp_path)
-
-                if not image_urls:
-                    return self.send_json({"error": "No images provided"}, 400)
-
-                # Build API arguments
-                arguments = {
-                    "prompt": prompt,
-                    "image_urls": image_urls,
-                    "num_images": num_images,
-                    "image_size": "auto_4K",
-                    "enable_safety_checker": False,
-                }
-
-                if seed:
-                    arguments["seed"] = int(seed)
+                        with self.timer.stage('decode'):
+                            img_bytes = decode_base64(img_data)
+                        image_urls.append(upload(img_bytes, len(img_bytes), None))
 
+            else:
+                return self.send_json({"error": "Content-Type must be application/json, multipart/form-data or application/octet-stream"}, 400)
+
+            if not image_urls:
+                return self.send_json({"error": "No images provided"}, 400)
+
+            # A draft renders small with a pinned seed; sending the same
+            # inputs and seed without "draft" gives the full-size version
+            draft = is_true(data.get('draft'))
+            try:
+                size = image_size(data.get('image_size'), DRAFT_SIZE if draft else FINAL_SIZE)
+            except ValueError as e:
+                return self.send_json({"error": str(e)}, 400)
+            if draft:
+                seed = pin_seed(seed)
+
+            # Build API arguments
+            arguments = {
+                "prompt": prompt,
+                "image_urls": image_urls,
+                "num_images": num_images,
+                "image_size": size,
+                "enable_safety_checker": False,
+            }
+
+            if seed is not None:
+                arguments["seed"] = int(seed)
+
+            # Seeded calls with the same inputs are served from the result cache
+            cache_key = result_key(MODEL_ID, arguments)
+            # Links a draft to its full-size render
+            render = {
+                "pair_id": pair_id(MODEL_ID, arguments),
+                "seed": arguments.get("seed"),
+                "image_size": size,
+            }
+            result = cached_result(cache_key)
+            cached = result is not None
+
+            if not cached and webhooks.requested(self.query):
+                if store_error():
+                    return self.send_json({"error": store_error()}, 501)
+                # Answer right away; fal posts the result to /api/fal-webhook
+                job = webhooks.submit_job(MODEL_ID, arguments, self.public_url('/api/fal-webhook'),
+                                          cache_key, label='edit')
+                return self.send_json({**webhooks.accepted(job), **render}, 202)
+
+            if not cached:
                 # Log the request for debugging
-                print(f"Calling fal-ai/bytedance/seedream/v4.5/edit with {len(image_urls)} images")
+                print(f"Calling {MODEL_ID} with {len(image_urls)} images")
                 print(f"Arguments: {json.dumps({k: v if k != 'image_urls' else f'[{len(v)} urls]' for k, v in arguments.items()})}")
 
-                # Call Fal API
-                result = fal_client.subscribe(
-                    "fal-ai/bytedance/seedream/v4.5/edit",
-                    arguments=arguments,
-                    with_logs=True
-                )
+                # Queue position and log updates become queue/inference timings
+                tracker = QueueTracker(MODEL_ID)
 
-                print(f"Result: {json.dumps(result, default=str)[:500]}")
+                def run():
+                    # Rate-limit aware, with retries of transient fal errors
+                    return scheduler.subscribe(
+                        MODEL_ID,
+                        arguments,
+                        label='edit',
+                        with_logs=True,
+                        on_queue_update=tracker
+                    )
 
-                return self.send_json({
-                    "success": True,
-                    "images": result.get("images", []),
-                    "request_id": result.get("request_id", "")
-                })
-
-            else:
-                return self.send_json({"error": "Content-Type must be application/json"}, 400)
+                # Call Fal API - identical requests already in flight share that call
+                with self.timer.stage('fal'):
+                    result, _ = coalesce('edit', fingerprint(MODEL_ID, arguments), run)
+                tracker.report(self.timer)
 
+                print(f"Result: {json.dumps(result, default=str)[:500]}")
+                remember_result(cache_key, result)
+
+            return self.send_json({
+                "success": True,
+                "images": result.get("images", []),
+                "request_id": result.get("request_id", ""),
+                "cached": cached,
+                **render,
+                "uploads": upload_summary(cached_flags, reports)
+            })
+
+        except BodyParseError as e:
+            return self.send_json({"error": "Invalid request body", "details": str(e)}, 400)
+        except PayloadTooLarge as e:
+            return self.send_json({"error": str(e)}, 413)
         except Exception as e:
             import traceback
             error_details = traceback.format_exc()
@@ -0,0 +1,180 @@
+"""
+ZIP Export - fetches a list of result files and streams them back as one ZIP
+POST /api/export {"files": [{"url": ..., "filename": ...}], "name": "batch.zip"}
+
+Files are fetched a few at a time over the shared fal pool and each one is
+written to the archive as soon as it arrives, so memory holds at most
+EXPORT_CONCURRENCY files whatever the size of the batch. Results from
+/api/batch and /api/video can be passed as-is: "image_url" and "video" are
+read too and failed entries are skipped.
+"""
+
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import parse_qs, urlparse
+
+from api._core import fal
+from api._core.http import BaseHandler
+from api._core.zipstream import ZipStream
+
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "6"))
+MAX_FILES = int(os.getenv("EXPORT_MAX_FILES", "1000"))
+# The endpoint fetches whatever it's given, so only fal's hosts are allowed
+# unless more are listed here (comma-separated)
+ALLOWED_HOSTS = ("fal.media", "fal.ai", "fal.run") + tuple(
+    h.strip().lower() for h in os.getenv("EXPORT_ALLOWED_HOSTS", "").split(',') if h.strip()
+)
+
+
+def host_allowed(url):
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    if parsed.scheme not in ('http', 'https'):
+        return False
+    return any(host == allowed or host.endswith('.' + allowed) for allowed in ALLOWED_HOSTS)
+
+
+def safe_name(name, default):
+    """Archive entry name without directories or characters unzip tools reject"""
+    name = re.sub(r'[\x00-\x1f<>:"/\\|?*]', '_', os.path.basename(str(name or '').replace('\\', '/'))).strip(' .')
+    return name or default
+
+
+def entry_names(files):
+    """Unique entry names in input order: a repeated name gets _2, _3... before
+    its extension"""
+    seen = set()
+    names = []
+    for i, item in enumerate(files):
+        url_name = os.path.basename(urlparse(item["url"]).path)
+        base, ext = os.path.splitext(safe_name(item.get("filename") or url_name, f"file_{i + 1}"))
+        name = base + ext
+        n = 1
+        while name.lower() in seen:
+            n += 1
+            name = f"{base}_{n}{ext}"
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def normalize(files):
+    """[{"url", "filename"}] from the request, skipping entries without a
+    URL (e.g. failed batch pairs); raises ValueError for bad input"""
+    if not isinstance(files, list) or not files:
+        raise ValueError("No files provided")
+    out = []
+    for item in files:
+        if isinstance(item, str):
+            item = {"url": item}
+        if not isinstance(item, dict):
+            raise ValueError("Each file must be a URL or an object with a url")
+        url = item.get("url") or item.get("image_url") or item.get("video_url") or (item.get("video") or {}).get("url")
+        if not url:
+            continue
+        if not host_allowed(url):
+            raise ValueError(f"URL host not allowed: {urlparse(url).hostname}")
+        out.append({"url": url, "filename": item.get("filename")})
+    if not out:
+        raise ValueError("No files with a URL")
+    if len(out) > MAX_FILES:
+        raise ValueError(f"Too many files (max {MAX_FILES})")
+    return out
+
+
+def fetch(url):
+    response = fal.get_http().get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_all(files, concurrency):
+    """Yield (index, data, error) as downloads finish, with at most
+    `concurrency` in flight - a new one only starts once a finished one has
+    been handed over, which is what bounds memory"""
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        queue = iter(enumerate(files))
+        running = {}
+
+        def start():
+            for index, item in queue:
+                running[pool.submit(fetch, item["url"])] = index
+                return
+
+        for _ in range(concurrency):
+            start()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    yield index, future.result(), None
+                except Exception as e:
+                    yield index, None, (str(e).splitlines() or [type(e).__name__])[0]
+                start()
+
+
+class handler(BaseHandler):
+    def read_request(self):
+        """JSON body, or a urlencoded form with the file list as JSON in
+        "files" - what a plain <form> POST sends, which lets the browser
+        save the response straight to disk"""
+        content_type = self.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        if content_type == 'application/x-www-form-urlencoded':
+            form = parse_qs(self.read_body().decode())
+            return {"files": json.loads(form.get('files', ['[]'])[0]), "name": form.get('name', [''])[0]}
+        return self.read_json()
+
+    def do_POST(self):
+        try:
+            if not fal.httpx:
+                return self.send_json({"error": "httpx not installed"}, 500)
+
+            data = self.read_request()
+            files = normalize(data.get('files'))
+            names = entry_names(files)
+            # Goes in a header, so ASCII only
+            archive = re.sub(r'[^\w. -]', '_', safe_name(data.get('name'), 'seedream_results.zip'), flags=re.ASCII)
+            if not archive.lower().endswith('.zip'):
+                archive += '.zip'
+        except json.JSONDecodeError:
+            return self.send_json({"error": "Invalid JSON"}, 400)
+        except ValueError as e:
+            return self.send_json({"error": str(e)}, 400)
+
+        print(f"Export: {len(files)} files to {archive}")
+        # No Content-Length: the archive size isn't known until the last file
+        # is in, so the response ends when the connection closes
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="{archive}"')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        zipfile = ZipStream(self.wfile.write)
+        failed = []
+        try:
+            with self.timer.stage('fetch'):
+                for index, content, error in fetch_all(files, EXPORT_CONCURRENCY):
+                    if error is None:
+                        try:
+                            zipfile.add(names[index], content)
+                            continue
+                        except ValueError as e:
+                            error = str(e)
+                    print(f"Export: {names[index]} failed: {error}")
+                    failed.append(f"{names[index]}\t{files[index]['url']}\t{error}")
+
+            if failed:
+                # Headers are long gone, so the archive itself says what's missing
+                zipfile.add('_missing.txt', ('\n'.join(failed) + '\n').encode())
+            zipfile.close()
+            self.wfile.flush()
+            print(f"Export: {len(files) - len(failed)}/{len(files)} files, {zipfile.offset} bytes")
+        except (BrokenPipeError, ConnectionResetError):
+            # Browser went away; the pool finishes what's in flight and stops
+            print("Export: client disconnected")
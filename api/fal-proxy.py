@@ -1,79 +1,139 @@
 """
 Fal Proxy - Proxies requests to Fal API with credentials
 This allows the browser fal client to work without exposing API keys
+
+Bodies are streamed through in fixed-size chunks in both directions over the
+shared keep-alive pool, so memory stays flat regardless of payload size.
 """
 
 import os
 import json
-from http.server import BaseHTTPRequestHandler
-import urllib.request
-import urllib.error
-
-FAL_API_KEY = os.getenv("FAL_API_KEY")
-
-
-class handler(BaseHTTPRequestHandler):
-    def send_json(self, data, status=200):
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+from urllib.parse import urlparse
+
+from api._core import fal
+from api._core.http import BaseHandler
+
+CHUNK_SIZE = int(os.getenv("FAL_PROXY_CHUNK_SIZE", str(64 * 1024)))
+
+# Seconds to wait on the upstream per route, matched on the longest
+# "host/path" prefix; override with FAL_PROXY_TIMEOUTS='{"queue.fal.run": 30}'
+ROUTE_TIMEOUTS = {
+    "": 300,
+    "queue.fal.run": 60,
+    "rest.fal.ai": 60,
+    "rest.alpha.fal.ai": 60,
+    "v3.fal.media": 300,
+}
+ROUTE_TIMEOUTS.update(json.loads(os.getenv("FAL_PROXY_TIMEOUTS", "{}")))
+
+# Browser headers worth forwarding besides the x-fal-* ones
+FORWARD_HEADERS = (
+    'content-type', 'content-length', 'accept', 'accept-encoding', 'range',
+    'if-match', 'if-none-match', 'if-modified-since', 'if-unmodified-since', 'if-range',
+)
+# Never copied from the upstream response
+HOP_BY_HOP = (
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade',
+)
+
+
+def route_timeout(target_url):
+    url = urlparse(target_url)
+    route = f"{url.hostname}{url.path}"
+    best = max((prefix for prefix in ROUTE_TIMEOUTS if route.startswith(prefix)), key=len)
+    return ROUTE_TIMEOUTS[best]
+
+
+class handler(BaseHandler):
+    allowed_methods = 'GET, POST, PUT, OPTIONS'
+    allowed_headers = 'Content-Type, Authorization, X-Fal-Target-Url, Range, If-None-Match, If-Modified-Since'
 
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Fal-Target-Url')
+        self.send_header('Access-Control-Allow-Methods', self.allowed_methods)
+        self.send_header('Access-Control-Allow-Headers', self.allowed_headers)
         self.send_header('Access-Control-Max-Age', '86400')
         self.end_headers()
 
+    def upstream_headers(self):
+        headers = {}
+        for header, value in self.headers.items():
+            name = header.lower()
+            if name in FORWARD_HEADERS or (name.startswith('x-fal-') and name != 'x-fal-target-url'):
+                headers[header] = value
+        # Hand compressed bodies through untouched rather than re-encoding them
+        headers.setdefault('Accept-Encoding', 'identity')
+        headers['Authorization'] = f'Key {fal.FAL_API_KEY}'
+        return headers
+
+    def iter_body(self, length):
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
     def proxy_request(self, method):
-        if not FAL_API_KEY:
+        if not fal.FAL_API_KEY:
             return self.send_json({"error": "FAL_API_KEY not configured"}, 500)
 
-        try:
-            # Get target URL from header
-            target_url = self.headers.get('X-Fal-Target-Url', '')
-            if not target_url:
-                return self.send_json({"error": "Missing X-Fal-Target-Url header"}, 400)
-
-            # Read body if present
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length) if content_length > 0 else None
-
-            # Create request to Fal
-            req = urllib.request.Request(target_url, data=body, method=method)
-            req.add_header('Authorization', f'Key {FAL_API_KEY}')
+        if not fal.httpx:
+            return self.send_json({"error": "httpx not installed"}, 500)
 
-            # Forward content type
-            content_type = self.headers.get('Content-Type')
-            if content_type:
-                req.add_header('Content-Type', content_type)
+        # Get target URL from header
+        target_url = self.headers.get('X-Fal-Target-Url', '')
+        if not target_url:
+            return self.send_json({"error": "Missing X-Fal-Target-Url header"}, 400)
 
-            # Make request
-            with urllib.request.urlopen(req, timeout=300) as response:
-                response_body = response.read()
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.iter_body(content_length) if content_length > 0 else None
 
-                self.send_response(response.status)
+        try:
+            with fal.get_http().stream(
+                method,
+                target_url,
+                content=body,
+                headers=self.upstream_headers(),
+                timeout=route_timeout(target_url),
+            ) as response:
+                self.send_response(response.status_code)
                 self.send_header('Access-Control-Allow-Origin', '*')
-                for header, value in response.headers.items():
-                    if header.lower() not in ['transfer-encoding', 'content-encoding']:
+                for header, value in response.headers.multi_items():
+                    name = header.lower()
+                    if name not in HOP_BY_HOP and not name.startswith('access-control-'):
                         self.send_header(header, value)
                 self.end_headers()
-                self.wfile.write(response_body)
-
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode() if e.fp else str(e)
-            self.send_response(e.code)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": error_body}).encode())
+
+                # Raw bytes: any Content-Encoding header above still applies
+                for chunk in response.iter_raw(CHUNK_SIZE):
+                    self.wfile.write(chunk)
+
+        except fal.httpx.TimeoutException as e:
+            self.send_error_json(f"Upstream timed out: {e}", 504)
+        except fal.httpx.TransportError as e:
+            self.send_error_json(f"Upstream unavailable: {e}", 502)
+        except (BrokenPipeError, ConnectionResetError):
+            # Browser went away mid-stream; closing the upstream response is enough
+            pass
         except Exception as e:
-            self.send_json({"error": str(e)}, 500)
+            self.send_error_json(str(e), 500)
+
+    def send_error_json(self, message, status):
+        if self.status_code is None:
+            return self.send_json({"error": message}, status)
+        # The upstream status and headers are already out, so a JSON error
+        # would land in the body. Cutting the connection short is how the
+        # browser learns the body is incomplete.
+        print(f"fal-proxy: upstream failed mid-response ({status}): {message}")
+        self.close_connection = True
 
     def do_GET(self):
+        if self.warm_requested():
+            return self.send_warm()
         self.proxy_request('GET')
 
     def do_POST(self):
@@ -0,0 +1,65 @@
+"""
+fal Webhook Receiver - fal calls this when a model call submitted in webhook
+mode finishes; the result is recorded on its job
+POST /api/fal-webhook/<id>/<hmac> (rewritten to ?job=<id>&token=<hmac>)
+"""
+
+import json
+from urllib.parse import urlparse
+
+from api._core.http import BaseHandler
+from api._core.jobs import record_result, update_job
+from api._core.webhooks import verify
+
+
+class handler(BaseHandler):
+    # fal posts results here; nothing calls back out to it
+    uses_fal = False
+
+    def do_POST(self):
+        try:
+            query = self.query
+            job_id = query.get('job', [''])[0]
+            token = query.get('token', [''])[0]
+            if not job_id:
+                # Direct /api/fal-webhook/<id>/<hmac> requests that bypassed the rewrite
+                parts = urlparse(self.path).path.rstrip('/').split('/')
+                if parts[-3:-2] == ['fal-webhook']:
+                    job_id, token = parts[-2], parts[-1]
+            if not verify(job_id, token):
+                return self.send_json({"error": "Invalid webhook token"}, 403)
+
+            # {"request_id": ..., "status": "OK" | "ERROR", "payload": {...}, "error": ...}
+            data = self.read_json()
+            request_id = data.get('request_id')
+            if not request_id:
+                return self.send_json({"error": "No request_id"}, 400)
+
+            found = []
+
+            def update(job):
+                for pair in job["pairs"]:
+                    if pair.get("request_id") != request_id:
+                        continue
+                    found.append(pair)
+                    if data.get('status') == 'OK' and data.get('payload'):
+                        record_result(pair, data['payload'])
+                    else:
+                        pair["status"] = "failed"
+                        pair["error"] = data.get('error') or data.get('payload_error') or "Model call failed"
+                        pair.pop("queue_position", None)
+
+            job = update_job(job_id, update)
+            if job is None or not found:
+                # fal retries failed deliveries, which covers a webhook that
+                # beats the job to the store
+                return self.send_json({"error": "Unknown job or request"}, 404)
+
+            print(f"Webhook: job {job_id} request {request_id} {found[0]['status']} ({job['pending']} pending)")
+            return self.send_json({"success": True, "status": job["status"]})
+
+        except json.JSONDecodeError:
+            return self.send_json({"error": "Invalid JSON"}, 400)
+        except Exception as e:
+            print(f"Webhook error: {e}")
+            return self.send_json({"error": str(e)}, 500)
@@ -2,94 +2,77 @@
 SeedDream Text-to-Image Endpoint - Generate images from text prompts
 """
 
-import os
 import json
-from http.server import BaseHTTPRequestHandler
 
-try:
-    import fal_client
-except ImportError:
-    fal_client = None
+from api._core import fal, scheduler, webhooks
+from api._core.arguments import GENERATE_MODEL, generate_arguments
+from api._core.http import BaseHandler
+from api._core.jobs import store_error
+from api._core.metrics import QueueTracker
+from api._core.results import result_key, cached_result, remember_result
+from api._core.singleflight import coalesce, fingerprint
 
-FAL_API_KEY = os.getenv("FAL_API_KEY")
+MODEL_ID = GENERATE_MODEL
 
-if FAL_API_KEY:
-    os.environ["FAL_KEY"] = FAL_API_KEY
-
-
-class handler(BaseHTTPRequestHandler):
-    def send_json(self, data, status=200):
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
-
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
 
+class handler(BaseHandler):
     def do_POST(self):
-        if not FAL_API_KEY:
-            return self.send_json({"error": "FAL_API_KEY not configured"}, 500)
-
-        if not fal_client:
-            return self.send_json({"error": "fal_client not installed"}, 500)
+        error = fal.config_error()
+        if error:
+            return self.send_json({"error": error}, 500)
 
         try:
             content_type = self.headers.get('Content-Type', '')
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
+            body = self.read_body()
 
             if 'application/json' not in content_type:
                 return self.send_json({"error": "Content-Type must be application/json"}, 400)
 
-            data = json.loads(body.decode())
-            prompt = data.get('prompt', '')
-            image_size = data.get('image_size', 'square_hd')
-            num_images = data.get('num_images', 1)
-            seed = data.get('seed')
-
-            if not prompt:
+            with self.timer.stage('parse'):
+                data = json.loads(body.decode())
+            if not data.get('prompt'):
                 return self.send_json({"error": "No prompt provided"}, 400)
 
-            # Map size options - default to 4K
-            size_map = {
-                "square_hd": "square_hd",
-                "square": "square",
-                "portrait_4_3": "portrait_4_3",
-                "portrait_16_9": "portrait_16_9",
-                "landscape_4_3": "landscape_4_3",
-                "landscape_16_9": "landscape_16_9",
-                "auto_4K": "auto_4K",
-                "auto_2K": "auto_2K",
-            }
-
             # Build API arguments
-            arguments = {
-                "prompt": prompt,
-                "image_size": size_map.get(image_size, "auto_4K"),
-                "num_images": num_images,
-                "enable_safety_checker": False,
-            }
-
-            if seed:
-                arguments["seed"] = int(seed)
-
-            # Call Fal API for text-to-image
-            result = fal_client.subscribe(
-                "fal-ai/bytedance/seedream/v4.5/text-to-image",
-                arguments=arguments,
-                with_logs=True
-            )
+            arguments = generate_arguments(data)
+
+            cache_key = result_key(MODEL_ID, arguments)
+            result = cached_result(cache_key)
+            cached = result is not None
+
+            if not cached and webhooks.requested(self.query):
+                if store_error():
+                    return self.send_json({"error": store_error()}, 501)
+                # Answer right away; fal posts the result to /api/fal-webhook
+                job = webhooks.submit_job(MODEL_ID, arguments, self.public_url('/api/fal-webhook'),
+                                          cache_key, label='generate')
+                return self.send_json(webhooks.accepted(job), 202)
+
+            if not cached:
+                # Queue position and log updates become queue/inference timings
+                tracker = QueueTracker(MODEL_ID)
+
+                def run():
+                    # Rate-limit aware, with retries of transient fal errors
+                    return scheduler.subscribe(
+                        MODEL_ID,
+                        arguments,
+                        label='generate',
+                        with_logs=True,
+                        on_queue_update=tracker
+                    )
+
+                # Call Fal API for text-to-image - identical requests already in flight share that call
+                with self.timer.stage('fal'):
+                    result, _ = coalesce('generate', fingerprint(MODEL_ID, arguments), run)
+                tracker.report(self.timer)
+                remember_result(cache_key, result)
 
             return self.send_json({
                 "success": True,
                 "images": result.get("images", []),
-                "request_id": result.get("request_id", "")
+                "request_id": result.get("request_id", ""),
+                "cached": cached
             })
 
         except Exception as e:
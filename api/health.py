@@ -1,28 +1,31 @@
-"""Health check endpoint"""
+"""
+Health check endpoint
+GET /api/health?warm=1 also does a cold start's warm-up (imports the fal
+clients and connects to fal) before answering. That warms this function
+only; the others answer GET ?warm=1 themselves (BaseHandler.send_warm)
+"""
 
-import os
-import json
-from http.server import BaseHTTPRequestHandler
+from api._core import fal, poller, scheduler, warmup
+from api._core.http import BaseHandler
 
-FAL_API_KEY = os.getenv("FAL_API_KEY")
 
+class handler(BaseHandler):
+    allowed_methods = 'GET, OPTIONS'
+    uses_fal = False
 
-class handler(BaseHTTPRequestHandler):
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-
-        response = {
+        # Taken first: this request is what makes a cold instance warm
+        instance = warmup.snapshot()
+        health = {
             "status": "healthy",
-            "fal_configured": FAL_API_KEY is not None
+            "fal_configured": fal.FAL_API_KEY is not None,
+            "instance": instance,
         }
-        self.wfile.write(json.dumps(response).encode())
-
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        if self.query.get('warm', [''])[0] in ('1', 'true'):
+            with self.timer.stage('warm'):
+                health["warmup"] = fal.warm() if fal.config_error() is None else fal.warm_stats()
+        health["upstream_pool"] = fal.pool_stats()
+        health["scheduler"] = scheduler.get_scheduler().snapshot()
+        if poller.poller_active():
+            health["poller"] = poller.get_poller().snapshot()
+        self.send_json(health)
@@ -0,0 +1,70 @@
+"""
+Jobs Endpoint - Progress and results of async batches and webhook-mode calls
+GET /api/jobs/<id> (routed to /api/jobs?id=<id>)
+"""
+
+import time
+from urllib.parse import urlparse
+
+from api._core import fal
+from api._core.http import BaseHandler
+from api._core.jobs import expand_variants, get_job_store, refresh_job
+from api._core.webhooks import FALLBACK_AFTER
+
+
+class handler(BaseHandler):
+    allowed_methods = 'GET, OPTIONS'
+
+    def do_GET(self):
+        if self.warm_requested():
+            return self.send_warm()
+
+        error = fal.config_error()
+        if error:
+            return self.send_json({"error": error}, 500)
+
+        try:
+            job_id = self.query.get('id', [''])[0]
+            if not job_id:
+                # Direct /api/jobs/<id> requests that bypassed the rewrite
+                job_id = urlparse(self.path).path.rstrip('/').rsplit('/', 1)[-1]
+                if job_id == 'jobs':
+                    job_id = ''
+
+            if not job_id:
+                return self.send_json({"error": "No job id provided"}, 400)
+
+            job = get_job_store().get(job_id)
+            # Drafts and batch checkpoints share the store but aren't jobs
+            if not job or job.get("kind") in ("draft", "batch", "checkpoint"):
+                return self.send_json({"error": "Job not found"}, 404)
+
+            # Webhook jobs are filled in by fal; only ask fal ourselves when
+            # the webhooks seem not to be arriving (or land on another instance)
+            quiet = time.time() - job.get("updated_at", job["created_at"])
+            if job["status"] != "completed" and (not job.get("webhook") or quiet > FALLBACK_AFTER):
+                job = refresh_job(job)
+
+            results = []
+            # One entry per image, for pairs with variants too
+            for pair in (r for p in job["pairs"] for r in expand_variants(p)):
+                result = {k: v for k, v in pair.items() if k not in ("request_id", "last_error", "cache_key")}
+                if pair["status"] != "completed":
+                    # Names and filename are only meaningful once there is an image
+                    for key in ("pose_name", "outfit_name", "filename"):
+                        result.pop(key, None)
+                results.append(result)
+
+            return self.send_json({
+                "success": True,
+                "job_id": job["id"],
+                "status": job["status"],
+                "total": job.get("total", len(job["pairs"])),
+                "completed": job["completed"],
+                "failed": job["failed"],
+                "pending": job["pending"],
+                "results": results
+            })
+
+        except Exception as e:
+            return self.send_json({"error": str(e)}, 500)
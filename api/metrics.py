@@ -0,0 +1,43 @@
+"""Metrics endpoint - request, stage and fal queue metrics in Prometheus text format"""
+
+from api._core import fal, scheduler
+from api._core.http import BaseHandler
+from api._core.metrics import REGISTRY, sample_lines
+
+# pool_stats() keys that only ever go up
+POOL_COUNTERS = ("requests", "connections_opened", "tls_handshakes", "reused_connections")
+SCHEDULER_COUNTERS = ("calls", "retries", "throttles", "failures", "deadline_exceeded")
+
+
+def state_lines():
+    """Connection pool and scheduler state, read at scrape time"""
+    lines = []
+    for key, value in fal.pool_stats().items():
+        kind = 'counter' if key in POOL_COUNTERS else 'gauge'
+        name = f"seedream_fal_pool_{key}" + ("_total" if kind == 'counter' else '')
+        lines.extend(sample_lines(name, kind, f"Upstream connection pool {key.replace('_', ' ')}", value))
+
+    for key, value in scheduler.get_scheduler().snapshot().items():
+        if value is None:
+            continue
+        kind = 'counter' if key in SCHEDULER_COUNTERS else 'gauge'
+        name = f"seedream_scheduler_{key}" + ("_total" if kind == 'counter' else '')
+        lines.extend(sample_lines(name, kind, f"Model call scheduler {key.replace('_', ' ')}", value))
+    return lines
+
+
+class handler(BaseHandler):
+    allowed_methods = 'GET, OPTIONS'
+    uses_fal = False
+
+    def do_GET(self):
+        # Each warm instance keeps its own registry; scrape them all or
+        # expect per-instance numbers
+        body = (REGISTRY.render() + '\n'.join(state_lines()) + '\n').encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
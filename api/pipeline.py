@@ -0,0 +1,84 @@
+"""
+Pipeline Endpoint - runs a DAG of generate / edit / video / upload steps
+server-side, passing outputs from step to step without client round trips
+POST /api/pipeline
+"""
+
+import json
+import threading
+
+from api._core import fal, pipeline, scheduler
+from api._core.http import BaseHandler
+
+
+class handler(BaseHandler):
+    def do_POST(self):
+        error = fal.config_error()
+        if error:
+            return self.send_json({"error": error}, 500)
+
+        try:
+            # Expected format:
+            # {
+            #   "steps": [
+            #     {"id": "model", "type": "generate", "prompt": "...", "seed": 7},
+            #     {"id": "outfit", "type": "upload", "image": "base64..."},
+            #     {"id": "look", "type": "edit", "prompt": "...", "images": ["$model", "$outfit"]},
+            #     {"id": "clip", "type": "video", "prompt": "...", "image": "$look"}
+            #   ]
+            # }
+            # Step fields are those of the matching endpoint. "$id" stands for
+            # a step's output URL (first image, video or upload) and "$id[n]"
+            # for its n-th image; a step runs once everything it references has.
+            #
+            # With ?stream=ndjson|sse (or a matching Accept header) a "node"
+            # event is written whenever a step changes status and "progress"
+            # events while its model call is queued or running, then a summary.
+            data = self.read_json()
+            try:
+                plan = pipeline.parse(data.get('steps'))
+            except pipeline.PipelineError as e:
+                return self.send_json({"error": str(e)}, 400)
+
+            stream = self.stream_format(self.query)
+            deadline = scheduler.deadline_after()
+            write_lock = threading.Lock()
+            gone = threading.Event()
+
+            def emit(event, payload):
+                # Called from the step threads; a vanished client just stops the events
+                if stream is None or gone.is_set():
+                    return
+                try:
+                    with write_lock:
+                        self.send_event(stream, event, payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    gone.set()
+
+            print(f"Pipeline: {len(plan[0])} steps")
+            if stream:
+                self.start_stream(stream)
+
+            with self.timer.stage('fal'):
+                nodes = pipeline.run(plan, deadline, emit)
+
+            summary = {
+                "success": True,
+                "status": "completed" if all(n["status"] == "completed" for n in nodes) else "failed",
+                "completed": len([n for n in nodes if n["status"] == "completed"]),
+                "failed": len([n for n in nodes if n["status"] == "failed"]),
+                "skipped": len([n for n in nodes if n["status"] == "skipped"]),
+                "nodes": nodes,
+                "outputs": {n["id"]: n["url"] for n in nodes if n["status"] == "completed"},
+                "scheduler": scheduler.get_scheduler().snapshot()
+            }
+            if stream:
+                emit('summary', summary)
+                return
+            return self.send_json(summary)
+
+        except json.JSONDecodeError:
+            return self.send_json({"error": "Invalid JSON"}, 400)
+        except Exception as e:
+            print(f"Pipeline error: {e}")
+            return self.send_json({"error": str(e)}, 500)
@@ -1,54 +1,141 @@
 """
 Seedance Video Endpoint - Image to Video generation
+
+One image per request, or a batch: many images with a shared prompt or one
+prompt each, run as concurrent Seedance jobs whose progress can be streamed
+back as it happens
 """
 
 import os
 import json
-import tempfile
-import base64
-from http.server import BaseHTTPRequestHandler
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
-try:
-    import fal_client
-except ImportError:
-    fal_client = None
+from api._core import fal, scheduler, webhooks
+from api._core.arguments import VIDEO_MODEL, video_arguments
+from api._core.http import BaseHandler
+from api._core.jobs import new_job, new_job_id, store_error
+from api._core.metrics import QueueProgress, QueueTracker
+from api._core.multipart import form_fields
+from api._core.stream_json import StreamingJSONReader, MemoryBudget, BodyParseError, PayloadTooLarge
+from api._core.uploads import decode_base64, upload_base64, upload_bytes, upload_decoded, upload_summary
 
-FAL_API_KEY = os.getenv("FAL_API_KEY")
+MODEL_ID = VIDEO_MODEL
 
-if FAL_API_KEY:
-    os.environ["FAL_KEY"] = FAL_API_KEY
+# Upper bound on Seedance jobs in flight per batch; callers may ask for less
+MAX_CONCURRENCY = int(os.getenv("VIDEO_MAX_CONCURRENCY", "4"))
+# Ceiling on decoded image bytes held at once while reading a batch body
+MAX_BUFFERED_BYTES = int(os.getenv("VIDEO_MAX_BUFFERED_BYTES", str(256 * 1024 * 1024)))
+# Any of these in the body makes it a batch
+BATCH_FIELDS = ('items', 'images', 'image_urls', 'prompts')
 
 
-class handler(BaseHTTPRequestHandler):
-    def send_json(self, data, status=200):
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+def is_image_path(path):
+    """images[i] and items[i].image are decoded while the body is read"""
+    if len(path) == 2 and path[0] == 'images':
+        return True
+    return len(path) == 3 and path[0] == 'items' and path[2] == 'image'
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
 
-    def do_POST(self):
-        if not FAL_API_KEY:
-            return self.send_json({"error": "FAL_API_KEY not configured"}, 500)
+def batch_items(data):
+    """One dict of fields per video, in input order: an item's own fields
+    over its entry in "prompts" over the shared top-level fields"""
+    shared = {k: v for k, v in data.items() if k not in BATCH_FIELDS + ('image', 'image_url', 'max_concurrency')}
+    if data.get('items'):
+        entries = [item if isinstance(item, dict) else {"image": item} for item in data['items']]
+    else:
+        # URLs first, then uploads - form requests can't interleave the two
+        entries = [{"image": image} for image in list(data.get('image_urls') or []) + list(data.get('images') or [])]
+
+    prompts = data.get('prompts') or []
+    items = []
+    for index, entry in enumerate(entries):
+        own_prompt = {"prompt": prompts[index]} if index < len(prompts) and prompts[index] else {}
+        items.append({**shared, **own_prompt, **entry})
+    return items
+
+
+def resolve_image(value):
+    """(url, cached, report) for an item's image: an upload already under
+    way, a URL or base64 data"""
+    if isinstance(value, Future):
+        return value.result()
+    if value.startswith('http'):
+        return value, None, {}
+    report = {}
+    url, cached = upload_base64(value, parallel=True, report=report)
+    return url, cached, report
+
+
+def run_item(index, arguments, deadline, emit):
+    """Run one Seedance job to completion and build its result"""
+    report = {}
+    progress = QueueProgress(MODEL_ID, {"index": index}, emit)
+    try:
+        result = scheduler.subscribe(MODEL_ID, arguments, deadline=deadline, label=f'video {index + 1}', report=report,
+                                     with_logs=True, on_queue_update=progress)
+    except Exception as e:
+        return {"index": index, "status": "failed", "error": str(e), **report}
+
+    if not result.get("video"):
+        return {"index": index, "status": "failed", "error": "No video returned", **report}
+
+    return {"index": index, "status": "completed", "video": result["video"], "seed": result.get("seed"), **report}
+
 
-        if not fal_client:
-            return self.send_json({"error": "fal_client not installed"}, 500)
+def submit_item(index, arguments, deadline, webhook_url=None):
+    """Queue one Seedance job on fal without waiting for it"""
+    try:
+        handle = scheduler.call(lambda: fal.submit(MODEL_ID, arguments, webhook_url=webhook_url),
+                                deadline=deadline, label=f'video {index + 1}')
+        return {"index": index, "status": "queued", "request_id": handle.request_id}
+    except Exception as e:
+        return {"index": index, "status": "failed", "error": str(e)}
+
+
+class handler(BaseHandler):
+    def do_POST(self):
+        error = fal.config_error()
+        if error:
+            return self.send_json({"error": error}, 500)
 
         try:
             content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body.decode())
+            cached_flags = []
+            report = {}
+
+            def upload(img_bytes, size, filename):
+                with self.timer.stage('upload'):
+                    url, cached = upload_bytes(img_bytes, report=report)
+                if report:
+                    self.timer.add('normalize', report["ms"] / 1000)
+                cached_flags.append(cached)
+                return url
+
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as upload_pool:
+                # Batch images start uploading while the rest of the body is read
+                budget = MemoryBudget(MAX_BUFFERED_BYTES)
+
+                def on_image(img_bytes, size):
+                    return upload_pool.submit(upload_decoded, img_bytes, size, budget)
+
+                if self.is_form:
+                    # multipart/form-data, or the raw image with fields in the query
+                    # string - each file is uploaded as soon as it has been read
+                    data = form_fields(self.read_form(lambda img_bytes, size, filename: on_image(img_bytes, size), 'image', budget),
+                                       lists=BATCH_FIELDS)
+                    # An empty form field (seed=, say) counts as not given
+                    data = {name: value for name, value in data.items() if value != ''}
+                else:
+                    with self.timer.stage('read'):
+                        data = StreamingJSONReader(self.rfile, content_length, is_image_path, on_image, budget).parse()
+
+                if any(field in data for field in BATCH_FIELDS):
+                    return self.send_batch(data, upload_pool)
 
             # Required fields
             prompt = data.get('prompt', '')
-            image_data = data.get('image')  # base64 or URL
+            image_data = data.get('image')  # base64 or URL (an uploaded URL for form requests)
             image_url = data.get('image_url')  # direct URL
 
             if not prompt:
@@ -56,61 +143,173 @@ class handler(BaseHTTPRequestHandler):
 
             # Handle image - either base64 or URL
             if image_data and not image_url:
-                # Base64 image - upload to fal
-                if ',' in image_data:
-                    image_data = image_data.split(',')[1]
-
-                img_bytes = base64.b64decode(image_data)
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
-                    tmp.write(img_bytes)
-                    tmp_path = tmp.name
-
-                try:
-                    image_url = fal_client.upload_file(tmp_path)
-                finally:
-                    os.unlink(tmp_path)
+                if isinstance(image_data, Future):
+                    with self.timer.stage('upload'):
+                        image_url, cached, report = image_data.result()
+                    if report:
+                        self.timer.add('normalize', report["ms"] / 1000)
+                    cached_flags.append(cached)
+                elif self.is_form:
+                    image_url = image_data
+                else:
+                    # Base64 image - upload to fal
+                    with self.timer.stage('decode'):
+                        img_bytes = decode_base64(image_data)
+                    image_url = upload(img_bytes, len(img_bytes), None)
 
             if not image_url:
                 return self.send_json({"error": "No image provided"}, 400)
 
-            # Optional fields
-            aspect_ratio = data.get('aspect_ratio', 'auto')
-            resolution = data.get('resolution', '1080p')
-            duration = data.get('duration', '5')
-            seed = data.get('seed')
-
             # Build API arguments
-            arguments = {
-                "prompt": prompt,
-                "image_url": image_url,
-                "aspect_ratio": aspect_ratio,
-                "resolution": resolution,
-                "duration": str(duration),
-                "enable_safety_checker": False,
-            }
-
-            if seed:
-                arguments["seed"] = int(seed)
+            arguments = video_arguments(image_url, data)
+
+            if webhooks.requested(self.query):
+                if store_error():
+                    return self.send_json({"error": store_error()}, 501)
+                # Seedance runs for minutes - answer right away and let fal
+                # post the result to /api/fal-webhook
+                job = webhooks.submit_job(MODEL_ID, arguments, self.public_url('/api/fal-webhook'), label='video')
+                return self.send_json({**webhooks.accepted(job), "uploads": upload_summary(cached_flags, [report])}, 202)
 
             print(f"Calling Seedance API with: {arguments}")
 
-            # Call Fal API
-            result = fal_client.subscribe(
-                "fal-ai/bytedance/seedance/v1/pro/image-to-video",
-                arguments=arguments,
-                with_logs=True
-            )
+            # Queue position and log updates become queue/inference timings
+            tracker = QueueTracker(MODEL_ID)
+
+            # Call Fal API - rate-limit aware, with retries of transient fal errors
+            with self.timer.stage('fal'):
+                result = scheduler.subscribe(
+                    MODEL_ID,
+                    arguments,
+                    label='video',
+                    with_logs=True,
+                    on_queue_update=tracker
+                )
+            tracker.report(self.timer)
 
             print(f"Seedance result: {result}")
 
             return self.send_json({
                 "success": True,
                 "video": result.get("video", {}),
-                "request_id": result.get("request_id", "")
+                "request_id": result.get("request_id", ""),
+                "uploads": upload_summary(cached_flags, [report])
             })
 
         except json.JSONDecodeError:
             return self.send_json({"error": "Invalid JSON"}, 400)
+        except BodyParseError as e:
+            return self.send_json({"error": "Invalid request body", "details": str(e)}, 400)
+        except PayloadTooLarge as e:
+            return self.send_json({"error": str(e)}, 413)
         except Exception as e:
             print(f"Seedance error: {str(e)}")
             return self.send_json({"error": str(e)}, 500)
+
+    def send_batch(self, data, upload_pool):
+        """Batch mode.
+
+        {
+          "items": [{"image": "base64 or URL", "prompt": "...", "seed": 1}, ...]
+        }
+        or "images" / "image_urls" lists with a shared "prompt" and/or a
+        "prompts" list, one per image. Top-level aspect_ratio, resolution,
+        duration and seed apply to every item unless it sets its own.
+        "max_concurrency" caps the jobs in flight (VIDEO_MAX_CONCURRENCY at most).
+
+        Results come back in input order, each with its "index". With
+        ?stream=ndjson|sse, "progress" events (queue position, new log lines)
+        and a "result" event per job are written as they happen, then a
+        summary. ?async=1 / ?webhook=1 only queue the jobs and return a job id.
+        """
+        query = self.query
+        deadline = scheduler.deadline_after()
+        run_async = query.get('async', [''])[0] in ('1', 'true')
+        webhook = query.get('webhook', [''])[0] in ('1', 'true') or (run_async and webhooks.requested(query))
+        run_async = run_async or webhook
+        if run_async and store_error():
+            return self.send_json({"error": store_error()}, 501)
+        stream = None if run_async else self.stream_format(query)
+        max_concurrency = int(data.get('max_concurrency') or MAX_CONCURRENCY)
+        max_concurrency = max(1, min(max_concurrency, MAX_CONCURRENCY))
+
+        items = batch_items(data)
+        if not items:
+            return self.send_json({"error": "No images provided"}, 400)
+        for index, item in enumerate(items):
+            if not item.get('prompt'):
+                return self.send_json({"error": f"No prompt provided for item {index}"}, 400)
+            if not (item.get('image_url') or item.get('image')):
+                return self.send_json({"error": f"No image provided for item {index}"}, 400)
+
+        image_futures = [upload_pool.submit(resolve_image, item.get('image_url') or item['image']) for item in items]
+        with self.timer.stage('upload'):
+            resolved = [f.result() for f in image_futures]
+        uploaded = [(cached, report) for _, cached, report in resolved if cached is not None]
+        uploads = upload_summary([cached for cached, _ in uploaded], [report for _, report in uploaded])
+        arguments = [video_arguments(url, item) for (url, _, _), item in zip(resolved, items)]
+        total = len(arguments)
+
+        if run_async:
+            job_id = new_job_id()
+            webhook_url = webhooks.callback_url(self.public_url('/api/fal-webhook'), job_id) if webhook else None
+            with self.timer.stage('fal'), ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+                results = list(pool.map(lambda i: submit_item(i, arguments[i], deadline, webhook_url), range(total)))
+            job = new_job(MODEL_ID, results, job_id=job_id, total=total, uploads=uploads, webhook=webhook)
+            return self.send_json({
+                "success": True,
+                "job_id": job["id"],
+                "status": job["status"],
+                "status_url": f"/api/jobs/{job['id']}",
+                "total": job["total"],
+                "uploads": uploads
+            }, 202)
+
+        print(f"Calling Seedance API for {total} videos, {max_concurrency} at a time")
+
+        write_lock = threading.Lock()
+        gone = threading.Event()
+
+        def emit(event, payload):
+            # Called from the job threads; a vanished client just stops the events
+            if stream is None or gone.is_set():
+                return
+            try:
+                with write_lock:
+                    self.send_event(stream, event, payload)
+            except (BrokenPipeError, ConnectionResetError):
+                gone.set()
+
+        if stream:
+            self.start_stream(stream)
+
+        results = [None] * total
+        with self.timer.stage('fal'), ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            futures = [pool.submit(run_item, index, arguments[index], deadline, emit) for index in range(total)]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result["index"]] = result
+                emit('result', result)
+                if gone.is_set():
+                    # Don't start jobs nobody will see
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+        if gone.is_set():
+            return
+
+        summary = {
+            "success": True,
+            "total": total,
+            "completed": len([r for r in results if r and r["status"] == "completed"]),
+            "failed": len([r for r in results if r and r["status"] == "failed"]),
+            "retries": sum(r.get("retries", 0) for r in results if r),
+            "results": results,
+            "uploads": uploads,
+            "scheduler": scheduler.get_scheduler().snapshot()
+        }
+        if stream:
+            emit('summary', summary)
+            return
+        return self.send_json(summary)
@@ -0,0 +1,365 @@
+"""
+Fake fal - a local stand-in for fal's queue, storage and CDN hosts
+
+Point the API at it with FAL_UPSTREAM_URL=http://127.0.0.1:<port>; every
+request then arrives here with the host it was meant for in an
+X-Fal-Upstream-Host header. Latencies are drawn from configurable
+distributions and a share of calls can fail with 5xx or 429.
+
+    python bench/fake_fal.py --port 8787 --queue lognormal:0.5,0.6 --run fixed:2 --throttle-rate 0.05
+"""
+
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CDN_BASE = "https://v3.fal.media"
+QUEUE_BASE = "https://queue.fal.run"
+
+# A 1x1 PNG; downloads are padded out to the configured result size
+PNG_1X1 = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+def parse_distribution(spec):
+    """'fixed:S', 'uniform:A,B', 'exp:MEAN' or 'lognormal:MEDIAN,SIGMA'
+    (seconds) -> a function returning one sample"""
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',') if v]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / values[0])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+class FakeFal:
+    """Shared state and behaviour knobs for one fake fal server"""
+
+    def __init__(self, queue='fixed:0.2', run='fixed:1', upload='fixed:0.05',
+                 error_rate=0.0, throttle_rate=0.0, result_bytes=256 * 1024):
+        self.config = {
+            "queue": queue, "run": run, "upload": upload,
+            "error_rate": error_rate, "throttle_rate": throttle_rate,
+            "result_bytes": result_bytes,
+        }
+        self.queue_time = parse_distribution(queue)
+        self.run_time = parse_distribution(run)
+        self.upload_time = parse_distribution(upload)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.result_bytes = result_bytes
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            "submits": 0, "status_polls": 0, "results": 0, "uploads": 0, "upload_bytes": 0,
+            "downloads": 0, "throttled": 0, "errors": 0, "tokens": 0, "webhooks": 0, "heads": 0,
+        }
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def fault(self):
+        """Status code for an injected failure on this call, else None"""
+        roll = random.random()
+        if roll < self.throttle_rate:
+            self.count("throttled")
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            self.count("errors")
+            return random.choice((500, 502, 503))
+        return None
+
+    def submit(self, app, arguments, webhook_url=None):
+        request_id = uuid.uuid4().hex
+        now = time.monotonic()
+        queued_until = now + self.queue_time()
+        done_at = queued_until + self.run_time()
+        with self.lock:
+            self.requests[request_id] = {
+                "app": app,
+                "arguments": arguments,
+                "queued_until": queued_until,
+                "done_at": done_at,
+            }
+        self.count("submits")
+        if webhook_url:
+            timer = threading.Timer(done_at - now, self.deliver_webhook, (request_id, webhook_url))
+            timer.daemon = True
+            timer.start()
+        return request_id
+
+    def deliver_webhook(self, request_id, webhook_url):
+        """POST the result to the submitter's webhook like fal does"""
+        body = json.dumps({
+            "request_id": request_id,
+            "gateway_request_id": request_id,
+            "status": "OK",
+            "payload": self.result(request_id),
+        }).encode()
+        request = urllib.request.Request(webhook_url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            urllib.request.urlopen(request, timeout=30).read()
+            self.count("webhooks")
+        except Exception as e:
+            print(f"Webhook to {webhook_url} failed: {e}", file=sys.stderr)
+
+    def status(self, request_id):
+        with self.lock:
+            request = self.requests.get(request_id)
+            if request is None:
+                return None
+            now = time.monotonic()
+            if now < request["queued_until"]:
+                ahead = sum(1 for r in self.requests.values() if now < r["queued_until"] < request["queued_until"])
+                return {"status": "IN_QUEUE", "queue_position": ahead}
+            if now < request["done_at"]:
+                return {"status": "IN_PROGRESS", "logs": [{"message": "Generating...", "level": "INFO"}]}
+            return {
+                "status": "COMPLETED",
+                "logs": [],
+                "metrics": {"inference_time": round(request["done_at"] - request["queued_until"], 3)},
+            }
+
+    def result(self, request_id):
+        with self.lock:
+            request = self.requests.get(request_id)
+        if request is None:
+            return None
+        self.count("results")
+        arguments = request["arguments"]
+        if 'video' in request["app"]:
+            return {"video": {"url": f"{CDN_BASE}/files/bench/{request_id}.mp4"}, "seed": arguments.get("seed", 0)}
+        images = [
+            {"url": f"{CDN_BASE}/files/bench/{request_id}_{i}.png", "content_type": "image/png",
+             "width": 4096, "height": 4096}
+            for i in range(int(arguments.get("num_images", 1)))
+        ]
+        return {"images": images, "seed": arguments.get("seed", random.randint(0, 2 ** 31))}
+
+
+class FakeFalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fal = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fault(self, status):
+        headers = {"Retry-After": "1"} if status == 429 else None
+        message = "Rate limit exceeded" if status == 429 else "Upstream error"
+        self.send_json({"detail": message}, status, headers)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        remaining = length
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/__stats':
+            return self.send_json({"config": self.fal.config, "stats": self.fal.stats})
+        if path.startswith('/files/'):
+            return self.download()
+
+        match = re.search(r'/requests/([0-9a-f]+)(/status)?$', path)
+        if not match:
+            return self.send_json({"detail": "Not found"}, 404)
+
+        request_id, is_status = match.groups()
+        if is_status:
+            self.fal.count("status_polls")
+            status = self.fal.status(request_id)
+        else:
+            status = self.fal.result(request_id)
+        if status is None:
+            return self.send_json({"detail": "Request not found"}, 404)
+        return self.send_json(status)
+
+    def do_HEAD(self):
+        # Connection warm-ups (fal.warm()); real fal hosts answer these too
+        self.fal.count("heads")
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        path = urlparse(self.path).path
+        if path.endswith('/cancel'):
+            return self.send_json({"status": "CANCELLATION_REQUESTED"}, 202)
+        if path.startswith('/storage-put/'):
+            body = self.read_body()
+            self.fal.count("uploads")
+            self.fal.count("upload_bytes", len(body))
+            return self.send_json({})
+        if '/multipart/' in path:
+            body = self.read_body()
+            self.fal.count("upload_bytes", len(body))
+            return self.send_json({}, headers={"ETag": f'"{uuid.uuid4().hex}"'})
+        return self.send_json({"detail": "Not found"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path
+        body = self.read_body()
+
+        if path.startswith('/storage/auth/token'):
+            self.fal.count("tokens")
+            return self.send_json({
+                "token": "bench-token",
+                "token_type": "Bearer",
+                "base_url": CDN_BASE,
+                "expires_at": (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat(),
+            })
+
+        if path.startswith('/files/upload'):
+            return self.upload(path, body)
+        if path.startswith('/storage/upload/initiate'):
+            # Legacy storage fallback: hand out a signed-URL-style PUT target
+            name = uuid.uuid4().hex[:12]
+            return self.send_json({
+                "upload_url": f"{CDN_BASE}/storage-put/{name}",
+                "file_url": f"{CDN_BASE}/files/bench/{name}",
+            })
+        if '/multipart/' in path and path.endswith('/complete'):
+            self.fal.count("uploads")
+            return self.send_json({})
+
+        # Anything else is a queue submit: POST /<app id>
+        fault = self.fal.fault()
+        if fault:
+            return self.send_fault(fault)
+
+        app = path.strip('/')
+        try:
+            arguments = json.loads(body or b'{}')
+        except ValueError:
+            return self.send_json({"detail": "Invalid JSON"}, 422)
+
+        request_id = self.fal.submit(app, arguments, parse_qs(url.query).get('fal_webhook', [None])[0])
+        base = f"{QUEUE_BASE}/{app}/requests/{request_id}"
+        return self.send_json({
+            "request_id": request_id,
+            "response_url": base,
+            "status_url": base + "/status",
+            "cancel_url": base + "/cancel",
+        })
+
+    def upload(self, path, body):
+        time.sleep(self.fal.upload_time())
+        fault = self.fal.fault()
+        if fault:
+            return self.send_fault(fault)
+
+        name = self.headers.get('X-Fal-File-Name') or 'upload.bin'
+        access_url = f"{CDN_BASE}/files/bench/{uuid.uuid4().hex[:12]}_{name}"
+        if path.endswith('/multipart'):
+            return self.send_json({"access_url": access_url, "uploadId": uuid.uuid4().hex})
+
+        self.fal.count("uploads")
+        self.fal.count("upload_bytes", len(body))
+        return self.send_json({"access_url": access_url})
+
+    def download(self):
+        self.fal.count("downloads")
+        size = self.fal.result_bytes
+        start, end = 0, size - 1
+        status = 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', '"bench"')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+
+        payload = PNG_1X1 + b'\x00' * max(0, size - len(PNG_1X1))
+        view = memoryview(payload)[start:end + 1]
+        for offset in range(0, len(view), 64 * 1024):
+            self.wfile.write(view[offset:offset + 64 * 1024])
+
+
+def make_server(port=0, **options):
+    """A ThreadingHTTPServer running a FakeFal; `server.fal` holds its state"""
+    fal = FakeFal(**options)
+    handler = type('Handler', (FakeFalHandler,), {"fal": fal})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    server.fal = fal
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--queue', default='fixed:0.2', help="Queue wait distribution (seconds)")
+    parser.add_argument('--run', default='fixed:1', help="Inference time distribution (seconds)")
+    parser.add_argument('--upload', default='fixed:0.05', help="Storage upload latency distribution (seconds)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of submits/uploads failing with 5xx")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Share of submits/uploads failing with 429")
+    parser.add_argument('--result-bytes', type=int, default=256 * 1024, help="Size of downloadable result files")
+
+
+def fake_options(args):
+    return {
+        "queue": args.queue, "run": args.run, "upload": args.upload,
+        "error_rate": args.error_rate, "throttle_rate": args.throttle_rate,
+        "result_bytes": args.result_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8787)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(args.port, **fake_options(args))
+    print(f"Fake fal listening on http://127.0.0.1:{server.server_port}", file=sys.stderr)
+    print(f"Run the API with FAL_UPSTREAM_URL=http://127.0.0.1:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
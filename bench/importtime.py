@@ -0,0 +1,114 @@
+"""
+Import-time profile - how long each function in api/ takes to import on a
+cold start, and which of its imports that time goes to
+
+Every function is imported in a fresh interpreter under `python -X importtime`
+`--runs` times. The median import time is reported with the function's
+heaviest direct imports (by cumulative time), and with how long the deferred
+fal clients take to load once a fal call needs them. Background warm-up is
+off while profiling. Results are printed as a table and can be written as
+JSON for comparing versions.
+
+    python bench/importtime.py
+    python bench/importtime.py --functions batch,edit --runs 9 --top 3 --output imports.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARKER = '--- function import ---'
+
+# Run in the child: import one function the way the Vercel runtime does, then
+# load the fal clients it defers
+CHILD = '''
+import sys, json, time, importlib.util
+sys.path.insert(0, {root!r})
+spec = importlib.util.spec_from_file_location('function', {path!r})
+module = importlib.util.module_from_spec(spec)
+sys.stderr.write({marker!r} + '\\n')
+started = time.perf_counter()
+spec.loader.exec_module(module)
+import_ms = (time.perf_counter() - started) * 1000
+sys.stderr.write({marker!r} + '\\n')
+from api._core import fal
+clients_ms = None
+# Versions from before the deferred imports load them with the function
+if hasattr(fal, 'load_clients'):
+    started = time.perf_counter()
+    fal.load_clients()
+    clients_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({{"import_ms": import_ms, "clients_ms": clients_ms}}))
+'''
+
+
+def functions():
+    return sorted(f[:-3] for f in os.listdir(os.path.join(ROOT, 'api')) if f.endswith('.py') and not f.startswith('_'))
+
+
+def parse_importtime(stderr):
+    """{module: cumulative ms} of the function's direct imports"""
+    lines = stderr.split(MARKER)[1].splitlines()
+    entries = []
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative) / 1000))
+    if not entries:
+        return {}
+    depth = min(d for d, _, _ in entries)
+    return {name: ms for d, name, ms in entries if d == depth}
+
+
+def profile(name, runs):
+    env = dict(os.environ, FAL_PREWARM='0')
+    env.setdefault('FAL_API_KEY', 'fake')
+    code = CHILD.format(root=ROOT, path=os.path.join(ROOT, 'api', f'{name}.py'), marker=MARKER)
+    import_ms, clients_ms, modules = [], [], {}
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, cwd=ROOT,
+                              capture_output=True, text=True)
+        if proc.returncode:
+            raise RuntimeError(f"{name}: {proc.stderr.strip().splitlines()[-1]}")
+        timings = json.loads(proc.stdout.strip().splitlines()[-1])
+        import_ms.append(timings["import_ms"])
+        clients_ms.append(timings["clients_ms"])
+        for module, ms in parse_importtime(proc.stderr).items():
+            modules.setdefault(module, []).append(ms)
+    return {
+        "function": name,
+        "import_ms": round(statistics.median(import_ms), 1),
+        "clients_ms": round(statistics.median(clients_ms), 1) if None not in clients_ms else None,
+        "imports": {m: round(statistics.median(ms), 1) for m, ms in modules.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--functions', default=','.join(functions()), help="Comma-separated functions to profile")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per function")
+    parser.add_argument('--top', type=int, default=3, help="Heaviest direct imports to list")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'function':<12} {'import ms':>10} {'clients ms':>11}  heaviest imports")
+    for name in args.functions.split(','):
+        result = profile(name, args.runs)
+        results.append(result)
+        heaviest = sorted(result["imports"].items(), key=lambda item: -item[1])[:args.top]
+        print(f"{name:<12} {result['import_ms']:>10} {str(result['clients_ms'] or '-'):>11}  "
+              + ', '.join(f"{m} {ms}" for m, ms in heaviest))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
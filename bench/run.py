@@ -0,0 +1,293 @@
+"""
+Endpoint benchmarks - drive the API handlers against the fake fal server
+
+Each scenario starts a fresh process serving one endpoint with
+FAL_UPSTREAM_URL pointed at bench/fake_fal.py, fires requests at it with a
+fixed concurrency and records latency percentiles, throughput and the
+serving process's peak RSS. Results are printed as a table and written as
+JSON for comparing versions.
+
+    python bench/run.py --endpoints edit,batch --image-kb 256,4096 --batch 2x2,4x5 --output bench.json
+    python bench/run.py --baseline bench.json   # show changes against an earlier run
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import struct
+import random
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import importlib.util
+import multiprocessing
+import http.client
+from http.server import ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_fal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ('edit', 'batch', 'batch-shard', 'generate', 'video', 'upload', 'fal-proxy')
+# Endpoints whose request size depends on --image-kb
+IMAGE_ENDPOINTS = ('edit', 'batch', 'batch-shard', 'video', 'upload')
+# Endpoints that are another function called with a query string: an
+# unseeded ?shard=1 batch, whose shards come back to the same process
+ROUTED = {'batch-shard': ('batch', '/?shard=1')}
+
+
+def make_image(size, seed):
+    """A PNG-signed blob of `size` bytes, unique per seed so upload caches miss"""
+    header = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', 2048, 2048) + b'\x08\x06\x00\x00\x00'
+    rng = random.Random(seed)
+    return header + rng.randbytes(max(0, size - len(header)))
+
+
+def build_request(endpoint, n, image_kb, batch):
+    """(method, headers, body) for the n-th request of a scenario"""
+    def image(k=0):
+        return base64.b64encode(make_image(image_kb * 1024, n * 1000 + k)).decode()
+
+    if endpoint == 'edit':
+        body = {"prompt": "Benchmark edit", "images": [image()]}
+    elif endpoint == 'generate':
+        body = {"prompt": f"Benchmark prompt {n}", "image_size": "auto_4K"}
+    elif endpoint == 'video':
+        body = {"prompt": "Benchmark video", "image": image(), "duration": "5"}
+    elif endpoint == 'upload':
+        body = {"image": image()}
+    elif endpoint in ('batch', 'batch-shard'):
+        poses, outfits = batch
+        body = {
+            "poses": [{"name": f"pose{i}.png", "data": image(i)} for i in range(poses)],
+            "outfits": [{"name": f"outfit{i}.png", "data": image(100 + i)} for i in range(outfits)],
+        }
+    elif endpoint == 'fal-proxy':
+        return 'GET', {"X-Fal-Target-Url": f"https://v3.fal.media/files/bench/{n}.png"}, None
+    else:
+        raise ValueError(f"Unknown endpoint {endpoint!r}")
+
+    return 'POST', {"Content-Type": "application/json"}, json.dumps(body).encode()
+
+
+# --- serving process ---
+
+def serve(endpoint, env, conn, verbose=False):
+    """Child process: serve one api/<endpoint>.py handler until told to stop,
+    then report peak RSS"""
+    os.environ.update(env)
+    if not verbose:
+        # The handlers log every call; keep the report readable
+        sys.stdout = open(os.devnull, 'w')
+    sys.path.insert(0, ROOT)
+    endpoint = ROUTED.get(endpoint, (endpoint,))[0]
+    spec = importlib.util.spec_from_file_location(endpoint.replace('-', '_'), os.path.join(ROOT, 'api', f'{endpoint}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    class Quiet(module.handler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Quiet)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    conn.send({"port": server.server_port, "idle_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    conn.recv()
+    server.shutdown()
+    conn.send({"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+# --- driver ---
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def send(port, method, headers, body, timeout, path='/'):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        started = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        while response.read(64 * 1024):
+            pass
+        return time.perf_counter() - started, response.status
+    finally:
+        conn.close()
+
+
+def run_scenario(endpoint, image_kb, batch, args, upstream):
+    env = {
+        "FAL_API_KEY": "bench-key",
+        "FAL_UPSTREAM_URL": upstream,
+        "JOB_STORE_PATH": os.path.join(args.workdir, 'jobs.sqlite3'),
+    }
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=serve, args=(endpoint, env, child, args.verbose), daemon=True)
+    process.start()
+    ready = parent.recv()
+    port = ready["port"]
+    path = ROUTED.get(endpoint, (endpoint, '/'))[1]
+
+    def one(n):
+        method, headers, body = build_request(endpoint, n, image_kb, batch)
+        try:
+            return send(port, method, headers, body, args.timeout, path)
+        except Exception as e:
+            print(f"  request {n} failed: {e}", file=sys.stderr)
+            return None, None
+
+    # One untimed request so imports and the connection pool are warm
+    if args.warmup:
+        one(-1)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - started
+
+    parent.send('stop')
+    peak = parent.recv()
+    process.join(10)
+
+    latencies = sorted(t for t, status in outcomes if t is not None and status and status < 400)
+    errors = len(outcomes) - len(latencies)
+    result = {
+        "scenario": scenario_name(endpoint, image_kb, batch),
+        "endpoint": endpoint,
+        "image_kb": image_kb if endpoint in IMAGE_ENDPOINTS else None,
+        "batch": f"{batch[0]}x{batch[1]}" if batch else None,
+        "requests": len(outcomes),
+        "errors": errors,
+        "concurrency": args.concurrency,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else None,
+        "idle_rss_mb": round(ready["idle_rss_kb"] / 1024, 1),
+        "peak_rss_mb": round(peak["peak_rss_kb"] / 1024, 1),
+    }
+    for pct in (50, 95, 99):
+        value = percentile(latencies, pct)
+        result[f"p{pct}_ms"] = round(value * 1000, 1) if value is not None else None
+    result["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None
+    return result
+
+
+def scenario_name(endpoint, image_kb, batch):
+    name = endpoint
+    if batch:
+        name += f" {batch[0]}x{batch[1]}"
+    if endpoint in IMAGE_ENDPOINTS:
+        name += f" {image_kb}KB"
+    return name
+
+
+def scenarios(args):
+    for endpoint in args.endpoints:
+        sizes = args.image_kb if endpoint in IMAGE_ENDPOINTS else [None]
+        batches = args.batch if endpoint in ('batch', 'batch-shard') else [None]
+        for image_kb in sizes:
+            for batch in batches:
+                yield endpoint, image_kb, batch
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+COLUMNS = ('scenario', 'requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'peak_rss_mb')
+
+
+def print_table(results, baseline=None):
+    previous = {r["scenario"]: r for r in (baseline or {}).get("results", [])}
+    print('  '.join(f"{c:>14}" if i else f"{c:<24}" for i, c in enumerate(COLUMNS)))
+    for result in results:
+        cells = []
+        for i, column in enumerate(COLUMNS):
+            value = result.get(column)
+            text = '-' if value is None else str(value)
+            before = previous.get(result["scenario"], {}).get(column)
+            if i and isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                text += f" ({(value - before) / before * 100:+.0f}%)"
+            cells.append(f"{text:>14}" if i else f"{text:<24}")
+        print('  '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help="Comma-separated endpoints to benchmark")
+    parser.add_argument('--image-kb', default='256', help="Comma-separated input image sizes in KB")
+    parser.add_argument('--batch', default='2x2', help="Comma-separated POSESxOUTFITS batch sizes")
+    parser.add_argument('--requests', type=int, default=20, help="Timed requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=4, help="Requests in flight at once")
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--no-warmup', dest='warmup', action='store_false')
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Earlier JSON output to compare against")
+    parser.add_argument('--workdir', default='/tmp/seedream-bench')
+    parser.add_argument('--verbose', action='store_true', help="Show the handlers' own logging")
+    fake_fal.add_arguments(parser)
+    args = parser.parse_args()
+
+    args.endpoints = [e for e in args.endpoints.split(',') if e]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+    args.image_kb = [int(v) for v in args.image_kb.split(',')]
+    args.batch = [tuple(int(n) for n in v.split('x')) for v in args.batch.split(',')]
+    os.makedirs(args.workdir, exist_ok=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    upstream = fake_fal.make_server(**fake_fal.fake_options(args))
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}"
+
+    results = []
+    for endpoint, image_kb, batch in scenarios(args):
+        print(f"Running {scenario_name(endpoint, image_kb, batch)} ...", file=sys.stderr)
+        results.append(run_scenario(endpoint, image_kb, batch, args, upstream_url))
+
+    upstream.shutdown()
+
+    report = {
+        "version": git_version(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "fake_fal": upstream.fal.config,
+        },
+        "fake_fal_stats": upstream.fal.stats,
+        "results": results,
+    }
+
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
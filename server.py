@@ -0,0 +1,400 @@
+"""
+Self-hosted server - serves every api/ function, the vercel.json rewrites
+and index.html from one long-running process, or from several pre-forked
+worker processes sharing one listening socket: a threaded server with a
+bounded pool
+
+    FAL_API_KEY=... python server.py --port 8000 --workers 4
+
+An asyncio loop accepts connections and reads request heads, so idle and
+slow clients don't hold threads. Each request then runs its unchanged,
+synchronous handler on a bounded pool of --threads threads and keeps its
+thread until the response is written, model calls included; a batch holds
+one more per pair in flight. Requests past the pool size wait for a free
+thread. Connection pools, caches, the job store and the model call scheduler
+are shared by every request of a worker, and model calls wait on one shared
+poller instead of polling fal each - that saves each call its polling loop,
+not its thread. The scheduler's concurrency limit defaults to --threads here.
+
+SIGTERM / SIGINT stop accepting connections and let requests in flight
+finish (up to --shutdown-timeout seconds) before the worker exits.
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+import asyncio
+import argparse
+import importlib.util
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+# Must be set before api._core.fal is imported
+os.environ.setdefault("FAL_SHARED_POLLER", "1")
+# Threads and connections don't survive a fork, so each worker warms fal up
+# itself once it is running rather than as the routes are loaded
+PREWARM = os.getenv("FAL_PREWARM", "1") in ('1', 'true')
+os.environ["FAL_PREWARM"] = "0"
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+# Requests whose handlers run at once per worker; more wait on the event loop
+THREADS = int(os.getenv("SERVER_THREADS", "256"))
+# Handler threads mostly sit waiting on fal, so they don't need the default 8 MB stack
+THREAD_STACK_KB = int(os.getenv("SERVER_THREAD_STACK_KB", "1024"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SERVER_SHUTDOWN_TIMEOUT", "300"))
+# Seconds a client may take to send the request head, and between body reads
+HEAD_TIMEOUT = float(os.getenv("SERVER_HEAD_TIMEOUT", "30"))
+BODY_TIMEOUT = float(os.getenv("SERVER_BODY_TIMEOUT", "60"))
+MAX_HEAD_BYTES = 64 * 1024
+READ_CHUNK = 64 * 1024
+
+
+def load_routes():
+    """{path: handler class} for every api/*.py function, named the way
+    Vercel names them - /api/index also answers /api"""
+    routes = {}
+    api_dir = os.path.join(ROOT, 'api')
+    for filename in sorted(os.listdir(api_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext != '.py' or name.startswith('_'):
+            continue
+        spec = importlib.util.spec_from_file_location(f"api_{name.replace('-', '_')}", os.path.join(api_dir, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        routes[f"/api/{name}"] = module.handler
+    if "/api/index" in routes:
+        routes["/api"] = routes["/api/index"]
+    return routes
+
+
+def load_rewrites():
+    """[(pattern, destination)] from the vercel.json routes that have a "dest" """
+    try:
+        with open(os.path.join(ROOT, 'vercel.json')) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return []
+    rewrites = []
+    for route in config.get('routes', []):
+        if route.get('dest'):
+            # Vercel takes PCRE named groups; Python spells them (?P<name>...)
+            pattern = re.compile('^' + route['src'].replace('(?<', '(?P<') + '$')
+            rewrites.append((pattern, route['dest']))
+    return rewrites
+
+
+def rewrite(target, rewrites):
+    """The request target after the first matching rewrite, with $name
+    filled in and the original query string carried along"""
+    path, _, query = target.partition('?')
+    for pattern, dest in rewrites:
+        match = pattern.match(path)
+        if not match:
+            continue
+        dest = re.sub(r'\$(\w+)', lambda m: match.groupdict().get(m.group(1)) or '', dest)
+        if query:
+            dest += ('&' if '?' in dest else '?') + query
+        return dest
+    return target
+
+
+class RequestStream(io.RawIOBase):
+    """The request as a handler thread reads it: the head the event loop
+    already has, then the body, pulled off the socket as the handler asks
+    for it and never past Content-Length"""
+
+    def __init__(self, head, reader, length, loop, interim=None):
+        self.head = head
+        self.reader = reader
+        self.remaining = length
+        self.loop = loop
+        # "100 Continue", sent just before the body is first read
+        self.interim = interim
+
+    def readable(self):
+        return True
+
+    async def _read(self, size):
+        if self.interim is not None:
+            self.interim, interim = None, self.interim
+            await interim()
+        return await asyncio.wait_for(self.reader.read(size), BODY_TIMEOUT)
+
+    def readinto(self, buffer):
+        if self.head:
+            n = min(len(buffer), len(self.head))
+            buffer[:n] = self.head[:n]
+            self.head = self.head[n:]
+            return n
+        if self.remaining <= 0:
+            return 0
+        data = asyncio.run_coroutine_threadsafe(self._read(min(len(buffer), self.remaining)), self.loop).result()
+        n = len(data)
+        buffer[:n] = data
+        self.remaining -= n
+        return n
+
+
+class ResponseStream:
+    """Response bytes from a handler thread, written by the event loop; each
+    write waits for the socket to drain, so a slow client slows its handler
+    down rather than filling memory"""
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        if self.writer.is_closing():
+            raise BrokenPipeError("Client disconnected")
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def run_handler(handler_class, rfile, wfile, client_address):
+    """One request through an unchanged BaseHTTPRequestHandler subclass,
+    without the socketserver machinery around it"""
+    handler = handler_class.__new__(handler_class)
+    handler.request = None
+    handler.server = None
+    handler.client_address = client_address
+    handler.rfile = rfile
+    handler.wfile = wfile
+    handler.close_connection = True
+    try:
+        handler.handle_one_request()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+class Server:
+    def __init__(self, sock, routes, rewrites, threads=THREADS):
+        self.sock = sock
+        self.routes = routes
+        self.rewrites = rewrites
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self.idle = set()
+        self.active = set()
+
+    async def respond(self, writer, status, body, content_type='application/json'):
+        writer.write(
+            f"HTTP/1.0 {status} {http.client.responses.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            "Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def serve_static(self, writer, method):
+        try:
+            with open(os.path.join(ROOT, 'index.html'), 'rb') as f:
+                body = f.read()
+        except OSError:
+            return await self.respond(writer, 404, b'{"error": "Not found"}')
+        if method not in ('GET', 'HEAD'):
+            return await self.respond(writer, 405, b'{"error": "Method not allowed"}')
+        await self.respond(writer, 200, b'' if method == 'HEAD' else body, 'text/html; charset=utf-8')
+
+    async def connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.idle.add(task)
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEAD_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                return
+            except asyncio.LimitOverrunError:
+                return await self.respond(writer, 431, b'{"error": "Request head too large"}')
+            finally:
+                self.idle.discard(task)
+            self.active.add(task)
+            await self.dispatch(reader, writer, head)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.active.discard(task)
+            writer.close()
+
+    async def dispatch(self, reader, writer, head):
+        request_line, _, rest = head.partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            return await self.respond(writer, 400, b'{"error": "Bad request line"}')
+        headers = http.client.parse_headers(io.BytesIO(rest))
+
+        path = target.split('?', 1)[0]
+        if path in ('/', '/index.html'):
+            return await self.serve_static(writer, method)
+
+        target = rewrite(target, self.rewrites)
+        handler_class = self.routes.get(target.split('?', 1)[0].rstrip('/') or '/')
+        if handler_class is None:
+            return await self.respond(writer, 404, b'{"error": "Not found"}')
+
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            return await self.respond(writer, 411, b'{"error": "Content-Length required"}')
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            return await self.respond(writer, 400, b'{"error": "Invalid Content-Length"}')
+
+        async def send_continue():
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+
+        interim = None
+        if headers.get('Expect', '').lower() == '100-continue' and version == 'HTTP/1.1':
+            interim = send_continue
+
+        loop = asyncio.get_running_loop()
+        head = f"{method} {target} {version}\r\n".encode('latin-1') + rest
+        rfile = io.BufferedReader(RequestStream(head, reader, length, loop, interim), READ_CHUNK)
+        wfile = ResponseStream(writer, loop)
+        peer = writer.get_extra_info('peername') or ('', 0)
+        await loop.run_in_executor(self.executor, run_handler, handler_class, rfile, wfile, peer[:2])
+        await writer.drain()
+
+    async def run(self, shutdown_timeout=SHUTDOWN_TIMEOUT):
+        """Serve until SIGTERM / SIGINT, then drain. Returns the number of
+        requests still running when the timeout ran out."""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        server = await asyncio.start_server(self.connection, sock=self.sock, limit=MAX_HEAD_BYTES)
+        print(f"Worker {os.getpid()}: serving {len(self.routes)} routes on {format_address(self.sock)}")
+        await stop.wait()
+
+        print(f"Worker {os.getpid()}: shutting down, {len(self.active)} requests in flight")
+        server.close()
+        # Connections that haven't sent a request yet can just go
+        for task in list(self.idle):
+            task.cancel()
+        deadline = time.monotonic() + shutdown_timeout
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        left = len(self.active)
+        if left:
+            print(f"Worker {os.getpid()}: {left} requests still running after {shutdown_timeout:g}s, exiting anyway")
+        self.executor.shutdown(wait=not left, cancel_futures=True)
+        from api._core import fal
+        fal.close()
+        return left
+
+
+def format_address(sock):
+    host, port = sock.getsockname()[:2]
+    return f"http://{host}:{port}"
+
+
+def run_worker(sock, routes, rewrites, threads, shutdown_timeout):
+    if PREWARM:
+        from api._core import fal
+        if fal.config_error() is None:
+            threading.Thread(target=fal.warm, name='fal-prewarm', daemon=True).start()
+    left = asyncio.run(Server(sock, routes, rewrites, threads).run(shutdown_timeout))
+    sys.stdout.flush()
+    if left:
+        # Handler threads can't be interrupted; don't wait for them at exit
+        os._exit(1)
+
+
+def supervise(sock, routes, rewrites, args):
+    """Fork `args.workers` workers and keep that many running until told to
+    stop, then pass the signal on and wait for them to drain"""
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(sock, routes, rewrites, args.threads, args.shutdown_timeout)
+            finally:
+                os._exit(0)
+        return pid
+
+    def on_signal(sig, frame):
+        stopping.append(sig)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    workers = set()
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    for _ in range(args.workers):
+        workers.add(spawn())
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited ({os.waitstatus_to_exitcode(status)}), starting another")
+            # Don't spin if workers die straight after starting
+            time.sleep(1)
+            workers.add(spawn())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help="worker processes (default SERVER_WORKERS or 1)")
+    parser.add_argument('--threads', type=int, default=THREADS, help="requests handled at once per worker")
+    parser.add_argument('--shutdown-timeout', type=float, default=SHUTDOWN_TIMEOUT,
+                        help="seconds to let requests in flight finish on shutdown")
+    args = parser.parse_args()
+
+    if THREAD_STACK_KB:
+        threading.stack_size(THREAD_STACK_KB * 1024)
+
+    # Must be set before api._core.scheduler is imported. Every handler thread
+    # may be waiting on a model call, so Vercel's default of 32 would leave
+    # threads queued behind the scheduler
+    os.environ.setdefault("SCHEDULER_MAX_CONCURRENCY", str(args.threads))
+
+    # Imported before forking so workers share the loaded code, including
+    # the fal clients the functions only import on first use
+    routes = load_routes()
+    rewrites = load_rewrites()
+    from api._core import fal
+    fal.load_clients()
+
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    print(f"Serving {', '.join(sorted(routes))} on {format_address(sock)} with {args.workers} worker(s)")
+
+    if args.workers > 1:
+        supervise(sock, routes, rewrites, args)
+    else:
+        run_worker(sock, routes, rewrites, args.threads, args.shutdown_timeout)
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
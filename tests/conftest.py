@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the functions' shared code the way the functions do: as api._core
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
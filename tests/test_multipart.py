@@ -0,0 +1,116 @@
+import io
+
+import pytest
+
+from api._core import multipart
+from api._core.multipart import MultipartReader, boundary_of, form_fields
+from api._core.stream_json import BodyParseError, MemoryBudget, PayloadTooLarge
+
+BOUNDARY = b'----seedream7MA4YWxkTrZu0gW'
+
+
+class TrickleReader(io.RawIOBase):
+    """A body that arrives `step` bytes per read, like a slow socket"""
+
+    def __init__(self, data, step):
+        self.data = data
+        self.step = step
+
+    def read(self, n=-1):
+        chunk = self.data[:min(n, self.step)]
+        self.data = self.data[len(chunk):]
+        return chunk
+
+
+def encode(parts, boundary=BOUNDARY, preamble=b'', epilogue=b''):
+    """A multipart/form-data body from (name, value, filename) tuples"""
+    body = preamble
+    for name, value, filename in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += b'--' + boundary + b'\r\nContent-Disposition: ' + disposition.encode() + b'\r\n'
+        if filename is not None:
+            body += b'Content-Type: image/png\r\n'
+        body += b'\r\n' + (value if isinstance(value, bytes) else value.encode()) + b'\r\n'
+    return body + b'--' + boundary + b'--\r\n' + epilogue
+
+
+def parse(body, step=7, budget=None, boundary=BOUNDARY, length=None):
+    files = []
+
+    def on_file(data, size, filename):
+        files.append((data, size, filename))
+        return filename
+
+    reader = MultipartReader(TrickleReader(body, step), len(body) if length is None else length,
+                             boundary, on_file, budget)
+    return reader.parse(), files
+
+
+# Contains most of the delimiter, so a split delimiter must not be mistaken for it
+IMAGE = b'\x89PNG\r\n\x1a\n' + b'\r\n--' + BOUNDARY[:-1] + b'X' + bytes(range(256)) * 20 + b'\r\n-'
+
+
+@pytest.mark.parametrize('step', [1, 2, 3, len(BOUNDARY) - 1, len(BOUNDARY) + 4, 1 << 16])
+def test_parts_survive_any_chunking(step, monkeypatch):
+    monkeypatch.setattr(multipart, 'READ_CHUNK', step)
+    body = encode([
+        ('prompt', 'a red coat', None),
+        ('poses', IMAGE, 'pose.png'),
+        ('poses', IMAGE[::-1], 'pose2.png'),
+        ('seed', '42', None),
+    ], preamble=b'ignored preamble\r\n', epilogue=b'ignored epilogue')
+    budget = MemoryBudget(1 << 20)
+    form, files = parse(body, step, budget)
+    assert form == {"prompt": ["a red coat"], "poses": ["pose.png", "pose2.png"], "seed": ["42"]}
+    assert files == [(IMAGE, len(IMAGE), 'pose.png'), (IMAGE[::-1], len(IMAGE), 'pose2.png')]
+    assert budget.used == 2 * len(IMAGE)
+
+
+def test_empty_values_and_unicode_fields():
+    form, files = parse(encode([('prompt', 'café 中文', None), ('empty', '', None), ('file', b'', 'a.png')]))
+    assert form == {"prompt": ["café 中文"], "empty": [""], "file": ["a.png"]}
+    assert files == [(b'', 0, 'a.png')]
+
+
+def test_form_fields_takes_first_values_except_lists():
+    form, _ = parse(encode([('prompt', 'a', None), ('prompt', 'b', None), ('seeds', '1', None), ('seeds', '2', None)]))
+    assert form_fields(form, lists=('seeds',)) == {"prompt": "a", "seeds": ["1", "2"]}
+
+
+def test_boundary_of_reads_quoted_and_bare_boundaries():
+    assert boundary_of('multipart/form-data; boundary=abc') == b'abc'
+    assert boundary_of('multipart/form-data; boundary="a b;c"') == b'a b;c'
+    with pytest.raises(BodyParseError):
+        boundary_of('multipart/form-data')
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'--' + BOUNDARY + b'\r\nContent-Disposition: form-data; name="a"\r\n\r\nno closing delimiter',
+    b'--' + BOUNDARY + b'\r\nContent-Type: text/plain\r\n\r\nno name\r\n--' + BOUNDARY + b'--\r\n',
+    b'--' + BOUNDARY + b'\r\nContent-Disposition: form-data; name="a"\r\n' + b'x' * (multipart.MAX_HEADER_BYTES + 10),
+    b'--' + BOUNDARY + b'\r\nContent-Disposition: form-data; name="a"\r\n\r\n\xff\xfe\r\n--' + BOUNDARY + b'--\r\n',
+])
+def test_malformed_bodies_raise_parse_errors(body):
+    with pytest.raises(BodyParseError):
+        parse(body)
+
+
+def test_truncated_body_is_a_parse_error():
+    body = encode([('poses', IMAGE, 'pose.png')])
+    with pytest.raises(BodyParseError):
+        parse(body, length=len(body) // 2)
+
+
+def test_oversized_field_is_refused():
+    with pytest.raises(PayloadTooLarge):
+        parse(encode([('prompt', 'x' * (multipart.MAX_FIELD_BYTES + 1), None)]), step=1 << 16)
+
+
+def test_file_over_budget_raises_and_releases():
+    budget = MemoryBudget(len(IMAGE) - 1)
+    with pytest.raises(PayloadTooLarge):
+        parse(encode([('poses', IMAGE, 'pose.png')]), step=64, budget=budget)
+    assert budget.used == 0
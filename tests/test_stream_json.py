@@ -0,0 +1,169 @@
+import io
+import json
+import base64
+import threading
+
+import pytest
+
+from api._core import stream_json
+from api._core.stream_json import BodyParseError, MemoryBudget, PayloadTooLarge, StreamingJSONReader
+
+
+class TrickleReader(io.RawIOBase):
+    """A body that arrives `step` bytes per read, like a slow socket"""
+
+    def __init__(self, data, step):
+        self.data = data
+        self.step = step
+
+    def read(self, n=-1):
+        chunk = self.data[:min(n, self.step)]
+        self.data = self.data[len(chunk):]
+        return chunk
+
+
+def parse(body, step=7, is_image_path=lambda path: False, budget=None, length=None):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    images = []
+
+    def on_image(data, size):
+        images.append(data)
+        return {"size": size}
+
+    reader = StreamingJSONReader(TrickleReader(body, step), len(body) if length is None else length,
+                                 is_image_path, on_image, budget or MemoryBudget(1 << 20))
+    return reader.parse(), images
+
+
+DOCUMENTS = [
+    '{}',
+    '[]',
+    '""',
+    '0',
+    '-12.5e3',
+    'true',
+    'null',
+    '{"a": 1, "b": [true, false, null], "c": {"d": "e"}}',
+    ' \n\t{ "nested" : [ [ ], { }, [ 1 , 2 ] ] } \r\n',
+    '{"escapes": "quote \\" backslash \\\\ slash \\/ controls \\b\\f\\n\\r\\t"}',
+    '{"unicode": "caf\\u00e9 \\u4e2d\\u6587 \\ud83d\\ude00", "raw": "café 中文 😀"}',
+    '{"long": "' + 'x' * 5000 + '", "after": 1}',
+    '[' + ', '.join(str(i) for i in range(300)) + ']',
+    '{"key with spaces": {"": ["", "\\u0000"]}}',
+]
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+@pytest.mark.parametrize('step', [1, 2, 3, 5, 64, 1 << 16])
+def test_matches_json_loads(document, step, monkeypatch):
+    monkeypatch.setattr(stream_json, 'READ_CHUNK', max(step, 1))
+    value, _ = parse(document, step)
+    assert value == json.loads(document)
+
+
+@pytest.mark.parametrize('body', [
+    '',
+    '{',
+    '{"a": 1',
+    '{"a" 1}',
+    '{"a": 1,}',
+    '[1 2]',
+    '{"a": "unterminated}',
+    '{"a": tru}',
+    '{"a": 1} {}',
+    '{1: 2}',
+    '"bad \\x escape"',
+    '"bad \\u12zz escape"',
+])
+def test_malformed_bodies_raise_parse_errors(body):
+    with pytest.raises(BodyParseError):
+        parse(body)
+
+
+def test_reads_no_further_than_length():
+    body = b'{"a": 1}' + b'garbage that belongs to the next request'
+    value, _ = parse(body, length=8)
+    assert value == {"a": 1}
+
+
+def test_truncated_body_is_a_parse_error():
+    body = b'{"a": "abcdef"}'
+    with pytest.raises(BodyParseError):
+        parse(body, length=len(body) - 3)
+
+
+def is_image(path):
+    return len(path) == 2 and path[0] == 'images'
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 40
+
+
+@pytest.mark.parametrize('step', [1, 3, 4, 5, 1000])
+@pytest.mark.parametrize('encode', [
+    lambda data: base64.b64encode(data).decode(),
+    lambda data: 'data:image/png;base64,' + base64.b64encode(data).decode(),
+    # Line-wrapped base64, as some encoders write it (JSON-escaped newlines)
+    lambda data: base64.encodebytes(data).decode().replace('\n', '\\n'),
+    # Missing padding
+    lambda data: base64.b64encode(data).decode().rstrip('='),
+])
+def test_images_are_decoded_across_chunk_boundaries(step, encode, monkeypatch):
+    monkeypatch.setattr(stream_json, 'READ_CHUNK', step)
+    data = PNG[:-1]  # a length that needs padding
+    body = json.dumps({"images": [encode(data)], "prompt": "p"}).replace('\\\\n', '\\n')
+    budget = MemoryBudget(1 << 20)
+    value, images = parse(body, step, is_image, budget)
+    assert images == [data]
+    assert value == {"images": [{"size": len(data)}], "prompt": "p"}
+    # The reader reserves; releasing is up to on_image's consumer
+    assert budget.used == len(data)
+
+
+def test_image_urls_are_returned_unchanged():
+    url = 'https://v3.fal.media/files/' + 'a' * 1000 + '.png'
+    value, images = parse(json.dumps({"images": [url]}), 5, is_image)
+    assert value == {"images": [url]}
+    assert images == []
+
+
+def test_strings_outside_image_paths_stay_strings():
+    encoded = base64.b64encode(PNG).decode()
+    value, images = parse(json.dumps({"prompt": encoded, "images": []}), 64, is_image)
+    assert value == {"prompt": encoded, "images": []}
+    assert images == []
+
+
+def test_invalid_base64_releases_its_reservation():
+    budget = MemoryBudget(1 << 20)
+    body = json.dumps({"images": [base64.b64encode(PNG).decode() + 'A']})
+    with pytest.raises(BodyParseError):
+        parse(body, 64, is_image, budget)
+    assert budget.used == 0
+
+
+def test_image_over_budget_raises_and_releases():
+    budget = MemoryBudget(1000)
+    body = json.dumps({"images": [base64.b64encode(PNG).decode()]})
+    with pytest.raises(PayloadTooLarge):
+        parse(body, 64, is_image, budget)
+    assert budget.used == 0
+
+
+def test_budget_waits_for_room_then_reserves():
+    budget = MemoryBudget(100)
+    budget.reserve(80)
+    waiter = threading.Thread(target=budget.reserve, args=(50,))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive() and budget.used == 80
+    budget.release(80)
+    waiter.join(1)
+    assert not waiter.is_alive() and budget.used == 50
+    assert budget.peak == 80
+
+
+def test_budget_refuses_what_can_never_fit():
+    with pytest.raises(PayloadTooLarge):
+        MemoryBudget(100).reserve(101)
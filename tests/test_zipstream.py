@@ -0,0 +1,77 @@
+import io
+import time
+import zipfile
+
+import pytest
+
+from api._core import zipstream
+from api._core.zipstream import ZipStream
+
+ENTRIES = [
+    ("pose1_outfit1.png", b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 50),
+    ("nested/dir/video.mp4", b'\x00\x00\x00\x18ftypmp42' * 100),
+    ("empty.txt", b''),
+    ("名前.png", b'unicode name'),
+]
+
+
+def build(entries, mtime=None):
+    out = io.BytesIO()
+    archive = ZipStream(out.write)
+    for name, data in entries:
+        archive.add(name, data, mtime)
+    archive.close()
+    return out.getvalue(), archive
+
+
+def test_archive_reads_back_with_zipfile():
+    data, archive = build(ENTRIES)
+    assert archive.offset == len(data)
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.testzip() is None
+        assert z.namelist() == [name for name, _ in ENTRIES]
+        for name, content in ENTRIES:
+            assert z.read(name) == content
+            assert z.getinfo(name).compress_type == zipfile.ZIP_STORED
+
+
+def test_writes_go_out_as_entries_are_added():
+    chunks = []
+    archive = ZipStream(chunks.append)
+    archive.add("a.png", b'a' * 1000)
+    # Header and data are out before the archive is closed
+    assert sum(len(c) for c in chunks) == archive.offset > 1000
+    archive.close()
+
+
+def test_empty_archive():
+    data, _ = build([])
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.namelist() == []
+
+
+def test_timestamps_are_kept():
+    mtime = time.mktime((2024, 5, 17, 13, 45, 30, 0, 0, -1))
+    data, _ = build([("a.png", b'a')], mtime)
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.getinfo("a.png").date_time == (2024, 5, 17, 13, 45, 30)
+
+
+def test_dates_before_1980_are_clamped():
+    clock, date = zipstream.dos_datetime(0)
+    assert date >> 9 == 0
+
+
+def test_zip64_central_directory_past_4gb(monkeypatch):
+    # Pretend the limit is tiny so the ZIP64 records are written for a small archive
+    monkeypatch.setattr(zipstream, 'ZIP64_LIMIT', 64)
+    data, _ = build([("a.png", b'a' * 40), ("b.png", b'b' * 40)])
+    assert b'PK\x06\x06' in data and b'PK\x06\x07' in data
+    # The second entry's offset got a ZIP64 extra field
+    assert b'\x01\x00\x08\x00' in data
+
+
+def test_entries_too_large_to_store_are_refused(monkeypatch):
+    monkeypatch.setattr(zipstream, 'ZIP64_LIMIT', 10)
+    with pytest.raises(ValueError):
+        ZipStream(io.BytesIO().write).add("big.bin", b'x' * 10)